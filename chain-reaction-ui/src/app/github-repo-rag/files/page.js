@@ -25,6 +25,7 @@ export default function GithubRepoRAGFilesPage() {
   const [messages, setMessages] = useState([]);
   const [ragLoading, setRagLoading] = useState(false);
   const [currentRequestId, setCurrentRequestId] = useState(null);
+  const [partialResponse, setPartialResponse] = useState('');
 
   const fetchFiles = async () => {
     if (!repoId) return;
@@ -138,8 +139,12 @@ export default function GithubRepoRAGFilesPage() {
         
         if (data.success === 'ok' && data.status) {
           // Check if the response is ready (status is 'success' and response_details exists)
-          if (data.status.status === 'success' && data.status.response_details) {
+          if (data.status.status === 'streaming' && data.status.response_details) {
+            // the answer so far, while the LLM is still generating it
+            setPartialResponse(data.status.response_details.response);
+          } else if (data.status.status === 'success' && data.status.response_details) {
             clearInterval(pollInterval);
+            setPartialResponse('');
             setMessages(prev => [...prev, {
               role: 'assistant',
               content: data.status.response_details.response
@@ -148,6 +153,7 @@ export default function GithubRepoRAGFilesPage() {
             setCurrentRequestId(null);
           } else if (data.status.status === 'error') {
             clearInterval(pollInterval);
+            setPartialResponse('');
             setRagLoading(false);
             setCurrentRequestId(null);
             setMessages(prev => [...prev, {
@@ -159,9 +165,10 @@ export default function GithubRepoRAGFilesPage() {
       } catch (error) {
         console.error('Error polling for response:', error);
         clearInterval(pollInterval);
+        setPartialResponse('');
         setRagLoading(false);
       }
-    }, 2000); // Poll every 2 seconds
+    }, 1000); // Poll every second, the answer streams in
     
     // Stop polling after 2 minutes
     setTimeout(() => {
@@ -391,8 +398,16 @@ export default function GithubRepoRAGFilesPage() {
                 ))
               )}
               
-              {/* Loading indicator */}
-              {ragLoading && (
+              {/* Streaming answer / loading indicator */}
+              {ragLoading && partialResponse && (
+                <div className="p-4 rounded-lg bg-gray-50 mr-12">
+                  <div className="font-semibold mb-1">Assistant</div>
+                  <div className="prose prose-sm max-w-none">
+                    <ReactMarkdown>{partialResponse}</ReactMarkdown>
+                  </div>
+                </div>
+              )}
+              {ragLoading && !partialResponse && (
                 <div className="flex items-center justify-center py-4">
                   <div className="text-gray-500">Processing your question...</div>
                 </div>
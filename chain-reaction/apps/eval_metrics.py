@@ -3,12 +3,13 @@ from database import SessionLocal, gold_qa_table, qdrant_client
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 from apps.github_rag import work_on_rag_request
-from utils.llm import Gemini
+from utils.llm import Gemini, CachedLLM
 import os
 from qdrant_client.models import Filter, FieldCondition, MatchValue
 import uuid
 
-gemini = Gemini(api_key=os.getenv("GEMINI_API_KEY"))
+# judge answers are cached, re-running an eval on unchanged answers costs nothing
+gemini = CachedLLM(Gemini(api_key=os.getenv("GEMINI_API_KEY")))
 
 def evaluate_qa_pair(qa_id: str, repo_id: str):
     """Evaluate a single Q&A pair and return metrics"""
@@ -23,35 +24,39 @@ def evaluate_qa_pair(qa_id: str, repo_id: str):
         question = qa.question
         expected_answer = qa.answer
         
-        # Step 1: Generate actual answer using RAG system
-        messages = [{"role": "user", "content": question, "type": "text"}]
-        context = work_on_rag_request(messages, repo_id)
-        actual_answer = context.get("response", "")
-        
-        # Get relevant chunks from the context
-        relevant_chunks = []
-        if "logs" in context:
-            for log in context["logs"]:
-                if log.get("type") == "retrieval" and "results" in log:
-                    for result in log["results"]:
-                        relevant_chunks.append({
-                            "chunk_id": result.get("id"),
-                            "chunk_text": result.get("raw_chunk_text", ""),
-                            "score": result.get("score", 0),
-                            "file_path": result.get("file_path", "")
-                        })
-        
-        # Step 2: Compute all metrics using a single LLM call
-        metrics = compute_all_metrics(question, expected_answer, actual_answer, relevant_chunks)
-        
-        # Add status to indicate completion
-        metrics["status"] = "completed"
-        
-        return {
-            "actual_answer": actual_answer,
-            "relevant_chunks": relevant_chunks,
-            "metrics": metrics
-        }
+    return evaluate_answer(question, expected_answer, repo_id)
+
+def evaluate_answer(question: str, expected_answer: str, repo_id: str):
+    """Runs the RAG flow for the question and scores its answer against the expected one"""
+    # Step 1: Generate actual answer using RAG system
+    messages = [{"role": "user", "content": question, "type": "text"}]
+    context = work_on_rag_request(messages, repo_id)
+    actual_answer = context.get("response", "")
+    
+    # Get relevant chunks from the context
+    relevant_chunks = []
+    if "logs" in context:
+        for log in context["logs"]:
+            if log.get("type") == "retrieval" and "results" in log:
+                for result in log["results"]:
+                    relevant_chunks.append({
+                        "chunk_id": result.get("id"),
+                        "chunk_text": result.get("raw_chunk_text", ""),
+                        "score": result.get("score", 0),
+                        "file_path": result.get("file_path", "")
+                    })
+    
+    # Step 2: Compute all metrics using a single LLM call
+    metrics = compute_all_metrics(question, expected_answer, actual_answer, relevant_chunks)
+    
+    # Add status to indicate completion
+    metrics["status"] = "completed"
+    
+    return {
+        "actual_answer": actual_answer,
+        "relevant_chunks": relevant_chunks,
+        "metrics": metrics
+    }
 
 def compute_all_metrics(question: str, expected_answer: str, actual_answer: str, relevant_chunks: list):
     """Compute all evaluation metrics in a single LLM call"""
@@ -174,15 +174,16 @@ Next steps:
 """
 
 import uuid
-from database import repo_table, file_table, engine, github_queue, rag_requests_table, rag_queue, qa_queue, gold_qa_batch_table, gold_qa_table
+from database import repo_table, file_table, engine, qdrant_client, github_queue, rag_requests_table, rag_queue, qa_queue, gold_qa_batch_table, gold_qa_table
 from sqlalchemy.orm import Session
 from sqlalchemy import select, func, insert, update
-from main import Block, Chain
-from utils.llm import Mistral, Gemini
+from main import Block, AsyncBlock, Chain
+from utils.cache import RedisCache
+from utils.llm import Mistral, Gemini, AsyncGemini, AsyncMistral, AsyncRouter
+from utils.retry import RetryPolicy
 import os
 from dotenv import load_dotenv
 import time
-from qdrant_client import QdrantClient
 from qdrant_client.models import Filter, FieldCondition, MatchValue
 
 load_dotenv()
@@ -238,6 +239,16 @@ def ingest_repo(repo_url: str):
                         "job_id": job_id,
                         "repo_id": repo_id,
                     }
+            else:
+                # ingested before: bring it up to date with the branch, only what changed is downloaded and embedded
+                job_id = f"repo-resync-{repo_id}"
+                existing_job = github_queue.fetch_job(job_id)
+                if not existing_job or existing_job.get_status() in ("finished", "failed", "stopped", "canceled"):
+                    job_creation_info = {
+                        "job_id": job_id,
+                        "repo_id": repo_id,
+                        "resync": True,
+                    }
             return repo_id, job_creation_info
         else:
             # create a new repo
@@ -327,18 +338,15 @@ def get_rag_request_status(request_id: str):
 # RAG Action Block. Takes in user's query + current context and decides what to do next
 class EmbeddingGenBlock(Block):
     def __init__(self, logging: bool = False):
-        super().__init__(name="EmbeddingGenBlock", description="EmbeddingGenBlock is a block that generates an embedding for a given text.", retries=3, retry_delay=1, logging=logging)
+        # same text -> same embedding. cache it in redis so repeated questions (rag + evals) skip the embedding call
+        super().__init__(name="EmbeddingGenBlock", description="EmbeddingGenBlock is a block that generates an embedding for a given text.", retry_policy=RetryPolicy(max_attempts=3, base_delay=1), logging=logging, cache=RedisCache(prefix="block-cache:"), cache_ttl=7 * 24 * 3600)
         # self.embeddings_model = Mistral(api_key=os.getenv("MISTRAL_API_KEY"), model="codestral-embed")
         self.embeddings_model = Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-embedding-001")
-        self.delay = 1
 
     def prepare(self, context: dict):
         return context["text"]
     
     def execute(self, context, prepare_response):
-        # increase delay with exponential backoff
-        time.sleep(self.delay)
-        self.delay *= 2
         # return ["success", self.embeddings_model.generate_embeddings(prepare_response, "codestral-embed")]
         return ["success", self.embeddings_model.generate_embeddings(prepare_response, "gemini-embedding-001")]
     
@@ -354,7 +362,8 @@ class VectorSearchBlock(Block):
     def __init__(self, repo_id: uuid.UUID, logging: bool = False):
         super().__init__(name="VectorSearchBlock", description="VectorSearchBlock is a block that searches the vector database for a given embedding.", retries=3, retry_delay=1, logging=logging)
         self.repo_id = repo_id
-        self.qdrant = QdrantClient(host=os.getenv("QDRANT_HOST"), port=int(os.getenv("QDRANT_PORT")))
+        # shared client from database.py, keeps one connection pool per process instead of one per request
+        self.qdrant = qdrant_client
 
     def prepare(self, context: dict):
         return context["embedding"]
@@ -393,21 +402,23 @@ class VectorSearchBlock(Block):
         return "default"
 
     
-class LLMBlock(Block):
+class LLMBlock(AsyncBlock):
+    """
+    Streams the answer. When context has an "on_token" callable it is called with the answer so far every time a new
+    piece arrives (starting over from "" if an attempt is retried), so the caller can show it while it is generated.
+    """
     def __init__(self, logging: bool = False):
-        super().__init__(name="LLMBlock", description="LLMBlock is a block that generates a response using a given prompt and context.", retries=3, retry_delay=1, logging=logging)
-        # self.mistral = Mistral(api_key=os.getenv("MISTRAL_API_KEY"), model="mistral-large-latest")
-        self.gemini = Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash")
-        self.mistral = self.gemini
-        self.llm_council = 0
-
-    def prepare(self, context: dict):
+        super().__init__(name="LLMBlock", description="LLMBlock is a block that generates a response using a given prompt and context.", retry_policy=RetryPolicy(max_attempts=3, base_delay=1), logging=logging)
+        # streams from whichever provider has been answering fastest, falls back to the other one on errors
+        self.llm = AsyncRouter([
+            AsyncGemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash"),
+            AsyncMistral(api_key=os.getenv("MISTRAL_API_KEY"), model="mistral-large-latest")
+        ])
+
+    async def prepare(self, context: dict):
         return [[], context["text"]] if "chunks" not in context else [context["chunks"], context["text"]]
     
-    def execute(self, context, prepare_response):
-        self.llm_council += 1
-        self.llm_council = self.llm_council % 3
-
+    async def execute(self, context, prepare_response):
         chunks, query = prepare_response
         # if the chunks are empty, then raise an error
         if not chunks or len(chunks) == 0:
@@ -440,21 +451,27 @@ class LLMBlock(Block):
         """
 
         # generate a response using the chunks
-        llm = self.gemini if self.llm_council == 0 else self.mistral
-
-        response = llm.generate_text([{"role": "user", "content": prompt, "type": "text"}])
+        on_token = context.get("on_token")
+        start_time = time.time()
+        response = ""
+        async for delta in self.llm.stream_text([{"role": "user", "content": prompt, "type": "text"}]):
+            if not response:
+                context["first_token_ms"] = (time.time() - start_time) * 1000
+            response += delta
+            if on_token:
+                on_token(response)
 
         return ["success", response]
     
-    def execute_fallback(self, context, prepare_response, error):
+    async def execute_fallback(self, context, prepare_response, error):
         return ["error", str(error)]
     
-    def post_process(self, context, prepare_response, execute_response):
+    async def post_process(self, context, prepare_response, execute_response):
         context["response"] = execute_response[1]
         context["status"] = execute_response[0]
         return "default"
 
-def work_on_rag_request(messages: list[dict], repo_id: uuid.UUID):
+def work_on_rag_request(messages: list[dict], repo_id: uuid.UUID, on_token=None):
     # create a new flow run
     embedding = EmbeddingGenBlock()
     vector_search = VectorSearchBlock(repo_id)
@@ -463,8 +480,12 @@ def work_on_rag_request(messages: list[dict], repo_id: uuid.UUID):
     vector_search >> llm
 
     # create a new flow run
-    flow = Chain(name="RAGFlow", starting_block=embedding)
-    context = {"text": messages[-1]["content"]}
+    # under rq's default 180s job timeout, so a hung provider ends in the blocks' fallbacks and not a killed job
+    flow = Chain(name="RAGFlow", starting_block=embedding, deadline=150)
+    # logs are stored with the response in rag_requests, keep only block summaries and failures
+    context = {"text": messages[-1]["content"], "log_level": os.getenv("RAG_LOG_LEVEL", "summary")}
+    if on_token is not None:
+        context["on_token"] = on_token
     flow.run(context)
     return context
 
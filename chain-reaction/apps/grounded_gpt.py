@@ -1,6 +1,6 @@
 from main import Block
 from utils.search import DuckDuckGoSearch, BraveSearch
-from utils.llm import Mistral, Gemini
+from utils.llm import Mistral, Gemini, Router
 import os
 from dotenv import load_dotenv
 import json
@@ -55,11 +55,10 @@ class Draft(Block):
     def __init__(self, retries: int = 1):
         super().__init__(name="Draft", description="Draft is a block that drafts an answer.", retries=retries)
 
-        self.llms = [
+        self.llm = Router([
             Mistral(api_key=os.getenv("MISTRAL_API_KEY"), model="mistral-large-latest"),
             Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash")
-        ]
-        self.rotate_token = 0
+        ])
     
     def prepare(self, context: dict):
         return {
@@ -72,10 +71,6 @@ class Draft(Block):
             # Nothing to draft here
             return "No query to draft for"
         
-        # rotate llms
-        self.rotate_token = (self.rotate_token + 1) % len(self.llms)
-        llm = self.llms[self.rotate_token]
-
         prompt = f"""
         You are a helpful assistant that drafts an answer to a question.
         The question is: {prepare_response["query"]}
@@ -87,7 +82,7 @@ class Draft(Block):
         Please be accurate and to the point.
         """
 
-        return llm.generate_text(messages=[
+        return self.llm.generate_text(messages=[
             {
                 "role": "user",
                 "content": prompt,
@@ -107,11 +102,10 @@ class Main(Block):
     def __init__(self):
         super().__init__(name="Main", description="Main is a block that combines the draft and the search results to form an answer.")
 
-        self.llms = [
+        self.llm = Router([
             Mistral(api_key=os.getenv("MISTRAL_API_KEY"), model="mistral-large-latest"),
             Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash")
-        ]
-        self.rotate_token = 0
+        ])
     
     def prepare(self, context):
         return {
@@ -124,10 +118,6 @@ class Main(Block):
             # Nothing to draft here
             return "No query to draft for"
         
-        # rotate llms
-        self.rotate_token = (self.rotate_token + 1) % len(self.llms)
-        llm = self.llms[self.rotate_token]
-
         prompt = f"""
         ### INSTRUCTIONS ###
         You are a helpful assistant that uses the search tools to answer user's query. Your job is to decide whether to search more or stop since we have enough information to answer the query.
@@ -170,7 +160,7 @@ class Main(Block):
 
         """
 
-        response = llm.generate_text(messages=[
+        response = self.llm.generate_text(messages=[
             {
                 "role": "user",
                 "content": prompt,
@@ -179,7 +169,7 @@ class Main(Block):
         ])
 
         try:
-            return llm.parse_response(response)
+            return self.llm.parse_response(response)
         except Exception as e:
             return {
                 "thinking": f"""Error parsing response: {str(e)} \n\n Response: {response}""",
@@ -4,8 +4,9 @@ import os
 from tracemalloc import start
 
 import requests
-from utils.llm import Mistral, Gemini, get_data_url_and_mimetype
+from utils.llm import Mistral, Gemini, Router, get_data_url_and_mimetype
 from main import Block, Chain
+from utils.deadline import request_timeout
 import json
 import re
 import dotenv
@@ -41,6 +42,8 @@ class Config:
         self.get_object_url = "https://collectionapi.metmuseum.org/public/collection/v1/objects/"
         self.mistral = Mistral(api_key=os.getenv("MISTRAL_API_KEY"), model="mistral-medium-latest")
         self.gemini = Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash")
+        # both models read images, the router picks the faster / healthier one per call
+        self.llm = Router([self.mistral, self.gemini])
         self.departments = {
             "departments": [
                 {
@@ -125,7 +128,7 @@ class Config:
 class GetObjectBlock(Block):
     def __init__(self, logging: bool = False):
         self.config = Config()
-        super().__init__(name="GetObjectBlock", description="Get an object from the MET Museum's collection given an object ID", retries=3, logging=logging)
+        super().__init__(name="GetObjectBlock", description="Get an object from the MET Museum's collection given an object ID", retries=3, timeout=20, logging=logging)
     
     def prepare(self, context):
         return {"object_id": context["tool_input"]["object_id"]}
@@ -133,7 +136,7 @@ class GetObjectBlock(Block):
     def execute(self, context, prepare_response):
         object_id = prepare_response["object_id"]
 
-        response = requests.get(self.config.get_object_url + object_id)
+        response = requests.get(self.config.get_object_url + object_id, timeout=request_timeout(15))
         response.raise_for_status()
 
         return ["success", response.json()]
@@ -193,7 +196,7 @@ class GetObjectBlock(Block):
 class SearchForObjectsBlock(Block):
     def __init__(self, logging: bool = False):
         self.config = Config()
-        super().__init__(name="SearchForObjectsBlock", description="Search for objects in the MET Museum's collection given a search query", retries=3, logging=logging)
+        super().__init__(name="SearchForObjectsBlock", description="Search for objects in the MET Museum's collection given a search query", retries=3, timeout=20, logging=logging)
 
     def prepare(self, context):
         return {"tool_input": context["tool_input"]}
@@ -220,7 +223,7 @@ class SearchForObjectsBlock(Block):
 
         print(self.config.search_objects_url + "?" + url_part)
 
-        response = requests.get(self.config.search_objects_url + "?" + url_part)
+        response = requests.get(self.config.search_objects_url + "?" + url_part, timeout=request_timeout(15))
         response.raise_for_status()
 
         return ["success", response.json()]
@@ -249,23 +252,18 @@ class SearchForObjectsBlock(Block):
 class UnderstandImageBlock(Block):
     def __init__(self, logging: bool = False):
         self.config = Config()
-        self.mistral = self.config.mistral
-        self.gemini = self.config.gemini
+        self.llm = self.config.llm
         super().__init__(name="UnderstandImageBlock", description="Understand the image of an object given an image URL", retries=3, logging=logging)
 
     def prepare(self, context):
-        self.running_tokens = 0
         return {"image_url": context["tool_input"]["image_url"]}
 
     def execute(self, context, prepare_response):
-        self.running_tokens += 1
-        self.running_tokens = self.running_tokens % 2
-
         image_url = prepare_response["image_url"]
 
         # get image data url and mimetype
         print(f"Fetching image from: {image_url}")
-        data_url, mimetype = get_data_url_and_mimetype(image_url)
+        data_url, mimetype = get_data_url_and_mimetype(image_url, max_side=self.llm.max_image_side())
         print(f"Image fetched successfully. Mimetype: {mimetype}")
 
         # get image description
@@ -290,11 +288,8 @@ class UnderstandImageBlock(Block):
         ]
 
 
-        llm = self.mistral if self.running_tokens == 0 else self.gemini
-        print(f"Using LLM: {llm.__class__.__name__} with model: {llm.model}")
-
         try:
-            response = llm.generate_text(messages, model=llm.model)
+            response = self.llm.generate_text(messages)
             print(f"LLM response received: {response[:100]}...")
         except Exception as e:
             print(f"LLM error: {e}")
@@ -327,20 +322,13 @@ class UnderstandImageBlock(Block):
 class ReplyBlock(Block):
     def __init__(self, logging: bool = False):
         self.config = Config()
-        self.mistral = self.config.mistral
-        self.gemini = self.config.gemini
+        self.llm = self.config.llm
         super().__init__(name="ReplyBlock", description="Reply to the user's query given the context", retries=3, logging=logging)
 
     def prepare(self, context):
-        self.running_tokens = 0
         return {"query": context["query"], "history": context["history"]}
 
     def execute(self, context, prepare_response):
-        self.running_tokens += 1
-        self.running_tokens = self.running_tokens % 2
-
-        llm = self.mistral if self.running_tokens == 0 else self.gemini
-
         prompt = f"""
         You are a helpful assistant that can answer questions about the MET Museum's collection.
         You are given a query and a history of the context.
@@ -360,7 +348,7 @@ class ReplyBlock(Block):
             }
         ]
 
-        response = llm.generate_text(messages, model=llm.model, max_tokens=1000)
+        response = self.llm.generate_text(messages, max_tokens=1000)
 
         return ["success", response]
 
@@ -390,20 +378,13 @@ class ReplyBlock(Block):
 class AgentBlock(Block):
     def __init__(self, logging: bool = False):
         self.config = Config()
-        self.mistral = self.config.mistral
-        self.gemini = self.config.gemini
+        self.llm = self.config.llm
         super().__init__(name="AgentBlock", description="Agent block", retries=3, logging=logging)
 
     def prepare(self, context):
-        self.running_tokens = 0
         return {"query": context["query"], "history": context["history"]}
 
     def execute(self, context, prepare_response):
-        self.running_tokens += 1
-        self.running_tokens = self.running_tokens % 2
-
-        llm = self.mistral if self.running_tokens == 0 else self.gemini
-
         prompt = f"""
         You are a helpful assistant that can answer questions about the MET Museum's collection.
         You have few tools at your disposal.
@@ -469,7 +450,7 @@ class AgentBlock(Block):
             }
         ]
 
-        response = llm.generate_text(messages, model=llm.model, max_tokens=1000)
+        response = self.llm.generate_text(messages, max_tokens=1000)
 
         return ["success", response]
     
@@ -522,7 +503,7 @@ agent_block - "SearchForObjectsBlock" >> search_for_objects_block
 agent_block - "ReplyBlock" >> reply_block
 agent_block - "UnderstandImageBlock" >> understand_image_block
 
-chain = Chain(starting_block=agent_block)
+chain = Chain(starting_block=agent_block, deadline=120)
 context = {
     "query": "Tell me about the european art department at the MET Museum. What are some of the most famous artworks in the department?",
     "history": ""
@@ -7,23 +7,31 @@ For each chunk in a file, it:
 2. Generates questions if score is above threshold
 3. Evolves questions using various strategies
 4. Generates answers using context
+
+Each stage is a MapBlock over a per-item block, so the chunks / questions of a stage are worked on
+concurrently (max_concurrency at a time) and an item that keeps failing is dropped instead of failing the stage.
 """
 
 import uuid
+import json
 import random
-import time
-from database import engine, gold_qa_table
+from database import engine, gold_qa_table, qdrant_client
 from sqlalchemy.orm import Session
 from sqlalchemy import select, insert
-from main import Block, Chain
-from utils.llm import Mistral, Gemini
+from main import Block, Chain, MapBlock
+from utils.llm import Mistral, Gemini, CachedLLM
+from utils.events import serialize_logs
+from utils.checkpoint import CheckpointStore, RedisCheckpointStore
+from utils.retry import RetryPolicy
 import os
 from dotenv import load_dotenv
-from qdrant_client import QdrantClient
 from qdrant_client.models import Filter, FieldCondition, MatchValue
 
 load_dotenv()
 
+# shared by the per item llm blocks. backs off with jitter so a 429 doesn't make every item retry at the same moment
+LLM_RETRY_POLICY = RetryPolicy(max_attempts=3, base_delay=1, max_delay=20)
+
 # Evolution strategies
 EVOLUTION_STRATEGIES = [
     "reasoning",
@@ -35,285 +43,320 @@ EVOLUTION_STRATEGIES = [
     "inbreadth"
 ]
 
-class ChunkScoringBlock(Block):
-    """Scores chunks for their suitability to generate Q&A pairs"""
+class ScoreChunkBlock(Block):
+    """Scores a single chunk for its suitability to generate Q&A pairs"""
     
     def __init__(self, logging: bool = False):
         super().__init__(
-            name="ChunkScoringBlock",
-            description="Scores chunks based on clarity, depth, structure, and relevance",
-            retries=3,
-            retry_delay=1,
+            name="ScoreChunkBlock",
+            description="Scores a chunk based on clarity, depth, structure, and relevance",
+            retry_policy=LLM_RETRY_POLICY,
             logging=logging
         )
-        self.gemini = Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash")
+        self.gemini = CachedLLM(Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash"))
     
     def prepare(self, context: dict):
-        return context.get("chunks", [])
+        return context["item"]
     
     def execute(self, context, prepare_response):
-        chunks = prepare_response
-        scored_chunks = []
+        chunk = prepare_response
+        prompt = f"""
+        Score the following code chunk for its suitability to generate meaningful Q&A pairs.
         
-        for chunk in chunks:
-            prompt = f"""
-            Score the following code chunk for its suitability to generate meaningful Q&A pairs.
-            
-            CHUNK:
-            {chunk['text']}
-            
-            Score each criterion from 0 to 1:
-            1. Clarity: How well-written and understandable is the chunk?
-            2. Depth: How much meaningful information does the chunk contain?
-            3. Structure: How well-structured is the chunk?
-            4. Relevance: How relevant is this chunk to understanding the codebase?
-            
-            Return ONLY a JSON object with this format:
-            {{
-                "clarity": 0.8,
-                "depth": 0.7,
-                "structure": 0.9,
-                "relevance": 0.8,
-                "overall": 0.8
-            }}
-            """
-            
-            response = self.gemini.generate_text([{"role": "user", "content": prompt, "type": "text"}])
-            
-            try:
-                import json
-                # Clean the response to extract JSON
-                response_text = response.strip()
-                # Try to find JSON in the response
-                if "{" in response_text and "}" in response_text:
-                    json_start = response_text.find("{")
-                    json_end = response_text.rfind("}") + 1
-                    json_str = response_text[json_start:json_end]
-                    scores = json.loads(json_str)
-                else:
-                    raise ValueError("No JSON found in response")
-                
-                chunk['scores'] = scores
-                chunk['overall_score'] = scores.get('overall', 
-                    (scores.get('clarity', 0) + scores.get('depth', 0) + 
-                     scores.get('structure', 0) + scores.get('relevance', 0)) / 4)
-                print(f"Chunk scored: {chunk['overall_score']:.2f} - {chunk['text'][:50]}...")
-            except Exception as e:
-                print(f"Error parsing scores: {e}, Response: {response}")
-                # Default scores if parsing fails
-                chunk['scores'] = {
-                    "clarity": 0.5,
-                    "depth": 0.5,
-                    "structure": 0.5,
-                    "relevance": 0.5,
-                    "overall": 0.5
-                }
-                chunk['overall_score'] = 0.5
-            
-            scored_chunks.append(chunk)
-            time.sleep(0.5)  # Rate limiting
+        CHUNK:
+        {chunk['text']}
+        
+        Score each criterion from 0 to 1:
+        1. Clarity: How well-written and understandable is the chunk?
+        2. Depth: How much meaningful information does the chunk contain?
+        3. Structure: How well-structured is the chunk?
+        4. Relevance: How relevant is this chunk to understanding the codebase?
+        
+        Return ONLY a JSON object with this format:
+        {{
+            "clarity": 0.8,
+            "depth": 0.7,
+            "structure": 0.9,
+            "relevance": 0.8,
+            "overall": 0.8
+        }}
+        """
+        
+        response = self.gemini.generate_text([{"role": "user", "content": prompt, "type": "text"}])
         
-        return ["success", scored_chunks]
+        try:
+            # Clean the response to extract JSON
+            response_text = response.strip()
+            # Try to find JSON in the response
+            if "{" in response_text and "}" in response_text:
+                json_start = response_text.find("{")
+                json_end = response_text.rfind("}") + 1
+                json_str = response_text[json_start:json_end]
+                scores = json.loads(json_str)
+            else:
+                raise ValueError("No JSON found in response")
+        except Exception as e:
+            print(f"Error parsing scores: {e}, Response: {response}")
+            # Default scores if parsing fails
+            scores = {
+                "clarity": 0.5,
+                "depth": 0.5,
+                "structure": 0.5,
+                "relevance": 0.5,
+                "overall": 0.5
+            }
+        
+        return ["success", scores]
     
     def execute_fallback(self, context, prepare_response, error):
         return ["error", str(error)]
     
     def post_process(self, context, prepare_response, execute_response):
+        chunk = prepare_response
         if execute_response[0] == "success":
-            context["scored_chunks"] = execute_response[1]
-            # Filter chunks with score above threshold
-            threshold = context.get("score_threshold", 0.5)
-            context["suitable_chunks"] = [
-                chunk for chunk in execute_response[1]
-                if chunk['overall_score'] >= threshold
-            ]
-            print(f"ChunkScoringBlock: {len(execute_response[1])} chunks scored, {len(context['suitable_chunks'])} suitable (threshold: {threshold})")
-            if context["suitable_chunks"]:
-                print(f"Sample scores: {[chunk['overall_score'] for chunk in execute_response[1][:3]]}")
+            scores = execute_response[1]
+            chunk['scores'] = scores
+            chunk['overall_score'] = scores.get('overall', 
+                (scores.get('clarity', 0) + scores.get('depth', 0) + 
+                 scores.get('structure', 0) + scores.get('relevance', 0)) / 4)
+            print(f"Chunk scored: {chunk['overall_score']:.2f} - {chunk['text'][:50]}...")
+            context["result"] = chunk
+        else:
+            print(f"Error scoring chunk: {execute_response[1]}")
         return "default"
 
-class QuestionGenerationBlock(Block):
-    """Generates questions for suitable chunks using related context"""
+class ChunkScoringBlock(MapBlock):
+    """Scores chunks for their suitability to generate Q&A pairs"""
+    
+    def __init__(self, max_concurrency: int = 4, logging: bool = False):
+        super().__init__(
+            name="ChunkScoringBlock",
+            description="Scores chunks based on clarity, depth, structure, and relevance",
+            item_block=ScoreChunkBlock(logging=logging),
+            items_key="chunks",
+            max_concurrency=max_concurrency,
+            logging=logging
+        )
+    
+    def post_process(self, context, prepare_response, execute_response):
+        scored_chunks = [chunk for chunk in execute_response if chunk is not None]
+        context["scored_chunks"] = scored_chunks
+        # Filter chunks with score above threshold
+        threshold = context.get("score_threshold", 0.5)
+        context["suitable_chunks"] = [
+            chunk for chunk in scored_chunks
+            if chunk['overall_score'] >= threshold
+        ]
+        print(f"ChunkScoringBlock: {len(scored_chunks)} chunks scored, {len(context['suitable_chunks'])} suitable (threshold: {threshold})")
+        if context["suitable_chunks"]:
+            print(f"Sample scores: {[chunk['overall_score'] for chunk in scored_chunks[:3]]}")
+        return "default"
+
+class GenerateQuestionBlock(Block):
+    """Generates a question for a single chunk using related context"""
     
     def __init__(self, repo_id: uuid.UUID, logging: bool = False):
         super().__init__(
-            name="QuestionGenerationBlock",
-            description="Generates questions using chunk and related context",
-            retries=3,
-            retry_delay=1,
+            name="GenerateQuestionBlock",
+            description="Generates a question using a chunk and related context",
+            retry_policy=LLM_RETRY_POLICY,
             logging=logging
         )
         self.repo_id = repo_id
-        self.gemini = Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash")
+        self.gemini = CachedLLM(Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash"))
         self.mistral = Mistral(api_key=os.getenv("MISTRAL_API_KEY"), model="codestral-embed")
-        self.qdrant = QdrantClient(host=os.getenv("QDRANT_HOST"), port=int(os.getenv("QDRANT_PORT")))
+        self.qdrant = qdrant_client
     
     def prepare(self, context: dict):
-        return context.get("suitable_chunks", [])
+        return context["item"]
     
     def execute(self, context, prepare_response):
-        chunks = prepare_response
-        qa_pairs = []
+        chunk = prepare_response
+        # Get related chunks using vector search
+        # embedding = self.mistral.generate_embeddings(chunk['text'], "codestral-embed")
+        embedding = self.gemini.generate_embeddings(chunk['text'], "gemini-embedding-001")
         
-        if not chunks:
-            print(f"QuestionGenerationBlock: No suitable chunks received")
-            return ["success", []]
+        results = self.qdrant.search(
+            collection_name="chunks",
+            query_vector=embedding,
+            limit=5,
+            with_payload=True,
+            query_filter=Filter(
+                must=[FieldCondition(key="repo_id", match=MatchValue(value=str(self.repo_id)))]
+            )
+        )
         
-        print(f"QuestionGenerationBlock: Processing {len(chunks)} chunks")
+        # Build context from related chunks
+        related_context = "\n\n".join([
+            f"File: {result.payload['file_path']}\n{result.payload['raw_chunk_text']}"
+            for result in results[1:]  # Skip the first one as it's likely the same chunk
+        ])
         
-        for chunk in chunks:
-            # Get related chunks using vector search
-            # embedding = self.mistral.generate_embeddings(chunk['text'], "codestral-embed")
-            embedding = self.gemini.generate_embeddings(chunk['text'], "gemini-embedding-001")
-            
-            results = self.qdrant.search(
-                collection_name="chunks",
-                query_vector=embedding,
-                limit=5,
-                with_payload=True,
-                query_filter=Filter(
-                    must=[FieldCondition(key="repo_id", match=MatchValue(value=str(self.repo_id)))]
-                )
-            )
-            
-            # Build context from related chunks
-            related_context = "\n\n".join([
-                f"File: {result.payload['file_path']}\n{result.payload['raw_chunk_text']}"
-                for result in results[1:]  # Skip the first one as it's likely the same chunk
-            ])
-            
-            prompt = f"""
-            Generate a high-quality question about the following code chunk.
-            
-            TARGET CHUNK:
-            {chunk['text']}
-            
-            RELATED CONTEXT FROM CODEBASE:
-            {related_context}
-            
-            Requirements:
-            1. The question should be answerable using the target chunk and related context
-            2. The question should be clear and self-contained
-            3. The question should be relevant to understanding the codebase
-            4. Focus on "how", "why", or "what" questions that require understanding
-            
-            Return ONLY the question text, nothing else.
-            """
-            
-            question = self.gemini.generate_text([{"role": "user", "content": prompt, "type": "text"}], model = "gemini-2.0-flash")
-            
-            qa_pairs.append({
-                "chunk": chunk,
-                "question": question.strip(),
-                "related_context": related_context
-            })
-            
-            time.sleep(0.5)  # Rate limiting
+        prompt = f"""
+        Generate a high-quality question about the following code chunk.
+        
+        TARGET CHUNK:
+        {chunk['text']}
         
-        return ["success", qa_pairs]
+        RELATED CONTEXT FROM CODEBASE:
+        {related_context}
+        
+        Requirements:
+        1. The question should be answerable using the target chunk and related context
+        2. The question should be clear and self-contained
+        3. The question should be relevant to understanding the codebase
+        4. Focus on "how", "why", or "what" questions that require understanding
+        
+        Return ONLY the question text, nothing else.
+        """
+        
+        question = self.gemini.generate_text([{"role": "user", "content": prompt, "type": "text"}], model = "gemini-2.0-flash")
+        
+        return ["success", {
+            "chunk": chunk,
+            "question": question.strip(),
+            "related_context": related_context
+        }]
     
     def execute_fallback(self, context, prepare_response, error):
         return ["error", str(error)]
     
     def post_process(self, context, prepare_response, execute_response):
         if execute_response[0] == "success":
-            context["qa_pairs"] = execute_response[1]
+            context["result"] = execute_response[1]
+        else:
+            print(f"Error generating question: {execute_response[1]}")
         return "default"
 
-class QuestionScoringBlock(Block):
-    """Scores generated questions for quality"""
+class QuestionGenerationBlock(MapBlock):
+    """Generates questions for suitable chunks using related context"""
+    
+    def __init__(self, repo_id: uuid.UUID, max_concurrency: int = 4, logging: bool = False):
+        super().__init__(
+            name="QuestionGenerationBlock",
+            description="Generates questions using chunk and related context",
+            item_block=GenerateQuestionBlock(repo_id, logging=logging),
+            items_key="suitable_chunks",
+            max_concurrency=max_concurrency,
+            logging=logging
+        )
+        self.repo_id = repo_id
+    
+    def prepare(self, context: dict):
+        chunks = super().prepare(context)
+        if not chunks:
+            print(f"QuestionGenerationBlock: No suitable chunks received")
+        else:
+            print(f"QuestionGenerationBlock: Processing {len(chunks)} chunks")
+        return chunks
+    
+    def post_process(self, context, prepare_response, execute_response):
+        context["qa_pairs"] = [qa for qa in execute_response if qa is not None]
+        return "default"
+
+class ScoreQuestionBlock(Block):
+    """Scores a single generated question for quality"""
     
     def __init__(self, logging: bool = False):
         super().__init__(
-            name="QuestionScoringBlock",
-            description="Scores questions for self-containment and clarity",
-            retries=3,
-            retry_delay=1,
+            name="ScoreQuestionBlock",
+            description="Scores a question for self-containment and clarity",
+            retry_policy=LLM_RETRY_POLICY,
             logging=logging
         )
-        self.gemini = Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash")
+        self.gemini = CachedLLM(Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash"))
     
     def prepare(self, context: dict):
-        return context.get("qa_pairs", [])
+        return context["item"]
     
     def execute(self, context, prepare_response):
-        qa_pairs = prepare_response
-        scored_qa_pairs = []
+        qa = prepare_response
+        prompt = f"""
+        Score the following question for quality.
         
-        if not qa_pairs:
-            return ["success", []]
+        QUESTION: {qa['question']}
         
-        for qa in qa_pairs:
-            prompt = f"""
-            Score the following question for quality.
-            
-            QUESTION: {qa['question']}
-            
-            Score each criterion from 0 to 1:
-            1. Self-containment: Can the question be understood without additional context?
-            2. Clarity: Is the question clear and unambiguous?
-            
-            Return ONLY a JSON object with this format:
-            {{
-                "self_containment": 0.8,
-                "clarity": 0.9,
-                "overall": 0.85
-            }}
-            """
-            
-            response = self.gemini.generate_text([{"role": "user", "content": prompt, "type": "text"}])
-            
-            try:
-                import json
-                # Clean the response to extract JSON
-                response_text = response.strip()
-                if "{" in response_text and "}" in response_text:
-                    json_start = response_text.find("{")
-                    json_end = response_text.rfind("}") + 1
-                    json_str = response_text[json_start:json_end]
-                    scores = json.loads(json_str)
-                else:
-                    raise ValueError("No JSON found in response")
-                
-                qa['question_score'] = scores.get('overall', 
-                    (scores.get('self_containment', 0) + scores.get('clarity', 0)) / 2)
-            except Exception as e:
-                print(f"Error parsing question scores: {e}, Response: {response}")
-                qa['question_score'] = 0.5
+        Score each criterion from 0 to 1:
+        1. Self-containment: Can the question be understood without additional context?
+        2. Clarity: Is the question clear and unambiguous?
+        
+        Return ONLY a JSON object with this format:
+        {{
+            "self_containment": 0.8,
+            "clarity": 0.9,
+            "overall": 0.85
+        }}
+        """
+        
+        response = self.gemini.generate_text([{"role": "user", "content": prompt, "type": "text"}])
+        
+        try:
+            # Clean the response to extract JSON
+            response_text = response.strip()
+            if "{" in response_text and "}" in response_text:
+                json_start = response_text.find("{")
+                json_end = response_text.rfind("}") + 1
+                json_str = response_text[json_start:json_end]
+                scores = json.loads(json_str)
+            else:
+                raise ValueError("No JSON found in response")
             
-            scored_qa_pairs.append(qa)
-            time.sleep(0.5)  # Rate limiting
+            question_score = scores.get('overall', 
+                (scores.get('self_containment', 0) + scores.get('clarity', 0)) / 2)
+        except Exception as e:
+            print(f"Error parsing question scores: {e}, Response: {response}")
+            question_score = 0.5
         
-        return ["success", scored_qa_pairs]
+        return ["success", question_score]
     
     def execute_fallback(self, context, prepare_response, error):
         return ["error", str(error)]
     
     def post_process(self, context, prepare_response, execute_response):
+        qa = prepare_response
         if execute_response[0] == "success":
-            # Filter questions with score above threshold
-            threshold = context.get("question_threshold", 0.5)
-            context["good_qa_pairs"] = [
-                qa for qa in execute_response[1]
-                if qa['question_score'] >= threshold
-            ]
+            qa['question_score'] = execute_response[1]
+            context["result"] = qa
+        else:
+            print(f"Error scoring question: {execute_response[1]}")
         return "default"
 
-class QuestionEvolutionBlock(Block):
-    """Evolves questions using various strategies"""
+class QuestionScoringBlock(MapBlock):
+    """Scores generated questions for quality"""
+    
+    def __init__(self, max_concurrency: int = 4, logging: bool = False):
+        super().__init__(
+            name="QuestionScoringBlock",
+            description="Scores questions for self-containment and clarity",
+            item_block=ScoreQuestionBlock(logging=logging),
+            items_key="qa_pairs",
+            max_concurrency=max_concurrency,
+            logging=logging
+        )
+    
+    def post_process(self, context, prepare_response, execute_response):
+        # Filter questions with score above threshold
+        threshold = context.get("question_threshold", 0.5)
+        context["good_qa_pairs"] = [
+            qa for qa in execute_response
+            if qa is not None and qa['question_score'] >= threshold
+        ]
+        return "default"
+
+class EvolveQuestionBlock(Block):
+    """Evolves a single question using two randomly picked strategies"""
     
     def __init__(self, logging: bool = False):
         super().__init__(
-            name="QuestionEvolutionBlock",
-            description="Evolves questions to make them more complex and comprehensive",
-            retries=3,
-            retry_delay=1,
+            name="EvolveQuestionBlock",
+            description="Evolves a question to make it more complex and comprehensive",
+            retry_policy=LLM_RETRY_POLICY,
             logging=logging
         )
-        self.gemini = Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash")
+        self.gemini = CachedLLM(Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash"))
     
     def prepare(self, context: dict):
-        return context.get("good_qa_pairs", [])
+        return context["item"]
     
     def get_evolution_prompt(self, strategy: str, question: str):
         base_prompt = """Rewrite this question to be clear and concise, like a developer would ask it.
@@ -341,96 +384,117 @@ class QuestionEvolutionBlock(Block):
         )
     
     def execute(self, context, prepare_response):
-        qa_pairs = prepare_response
-        evolved_qa_pairs = []
-        
-        if not qa_pairs:
-            return ["success", []]
+        qa = prepare_response
+        # Randomly select 2 evolution strategies
+        strategies = random.sample(EVOLUTION_STRATEGIES, 2)
+        evolved_question = qa['question']
         
-        for qa in qa_pairs:
-            # Randomly select 2 evolution strategies
-            strategies = random.sample(EVOLUTION_STRATEGIES, 2)
-            evolved_question = qa['question']
-            
-            for strategy in strategies:
-                prompt = self.get_evolution_prompt(strategy, evolved_question)
-                prompt += "\n\nReturn ONLY the improved question, nothing else."
-                
-                evolved_question = self.gemini.generate_text([{
-                    "role": "user",
-                    "content": prompt,
-                    "type": "text"
-                }])
-                time.sleep(0.5)  # Rate limiting
+        for strategy in strategies:
+            prompt = self.get_evolution_prompt(strategy, evolved_question)
+            prompt += "\n\nReturn ONLY the improved question, nothing else."
             
-            qa['evolved_question'] = evolved_question.strip()
-            qa['evolution_strategy'] = "+".join(strategies)
-            evolved_qa_pairs.append(qa)
+            evolved_question = self.gemini.generate_text([{
+                "role": "user",
+                "content": prompt,
+                "type": "text"
+            }])
         
-        return ["success", evolved_qa_pairs]
+        return ["success", [evolved_question.strip(), strategies]]
     
     def execute_fallback(self, context, prepare_response, error):
         return ["error", str(error)]
     
     def post_process(self, context, prepare_response, execute_response):
+        qa = prepare_response
         if execute_response[0] == "success":
-            context["evolved_qa_pairs"] = execute_response[1]
+            evolved_question, strategies = execute_response[1]
+            qa['evolved_question'] = evolved_question
+            qa['evolution_strategy'] = "+".join(strategies)
+            context["result"] = qa
+        else:
+            print(f"Error evolving question: {execute_response[1]}")
         return "default"
 
-class AnswerGenerationBlock(Block):
-    """Generates answers for evolved questions using context"""
+class QuestionEvolutionBlock(MapBlock):
+    """Evolves questions using various strategies"""
+    
+    def __init__(self, max_concurrency: int = 4, logging: bool = False):
+        super().__init__(
+            name="QuestionEvolutionBlock",
+            description="Evolves questions to make them more complex and comprehensive",
+            item_block=EvolveQuestionBlock(logging=logging),
+            items_key="good_qa_pairs",
+            max_concurrency=max_concurrency,
+            logging=logging
+        )
+    
+    def post_process(self, context, prepare_response, execute_response):
+        context["evolved_qa_pairs"] = [qa for qa in execute_response if qa is not None]
+        return "default"
+
+class GenerateAnswerBlock(Block):
+    """Generates an answer for a single evolved question using context"""
     
     def __init__(self, logging: bool = False):
         super().__init__(
-            name="AnswerGenerationBlock",
-            description="Generates comprehensive answers using chunk and related context",
-            retries=3,
-            retry_delay=1,
+            name="GenerateAnswerBlock",
+            description="Generates a comprehensive answer using chunk and related context",
+            retry_policy=LLM_RETRY_POLICY,
             logging=logging
         )
-        self.gemini = Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash")
+        self.gemini = CachedLLM(Gemini(api_key=os.getenv("GEMINI_API_KEY"), model="gemini-2.0-flash"))
     
     def prepare(self, context: dict):
-        return context.get("evolved_qa_pairs", [])
+        return context["item"]
     
     def execute(self, context, prepare_response):
-        qa_pairs = prepare_response
-        final_qa_pairs = []
+        qa = prepare_response
+        prompt = f"""
+        Answer the following question about the codebase.
         
-        if not qa_pairs:
-            return ["success", []]
+        QUESTION: {qa['evolved_question']}
         
-        for qa in qa_pairs:
-            prompt = f"""
-            Answer the following question about the codebase.
-            
-            QUESTION: {qa['evolved_question']}
-            
-            TARGET CODE:
-            {qa['chunk']['text']}
-            
-            RELATED CONTEXT:
-            {qa['related_context']}
-            
-            Provide a comprehensive, accurate answer based on the code and context provided.
-            Be specific and include relevant details from the code.
-            """
-            
-            answer = self.gemini.generate_text([{"role": "user", "content": prompt, "type": "text"}])
-            
-            qa['answer'] = answer.strip()
-            final_qa_pairs.append(qa)
-            
-            time.sleep(0.5)  # Rate limiting
+        TARGET CODE:
+        {qa['chunk']['text']}
         
-        return ["success", final_qa_pairs]
+        RELATED CONTEXT:
+        {qa['related_context']}
+        
+        Provide a comprehensive, accurate answer based on the code and context provided.
+        Be specific and include relevant details from the code.
+        """
+        
+        answer = self.gemini.generate_text([{"role": "user", "content": prompt, "type": "text"}])
+        
+        return ["success", answer.strip()]
     
     def execute_fallback(self, context, prepare_response, error):
         return ["error", str(error)]
     
     def post_process(self, context, prepare_response, execute_response):
+        qa = prepare_response
         if execute_response[0] == "success":
-            context["final_qa_pairs"] = execute_response[1]
+            qa['answer'] = execute_response[1]
+            context["result"] = qa
+        else:
+            print(f"Error generating answer: {execute_response[1]}")
+        return "default"
+
+class AnswerGenerationBlock(MapBlock):
+    """Generates answers for evolved questions using context"""
+    
+    def __init__(self, max_concurrency: int = 4, logging: bool = False):
+        super().__init__(
+            name="AnswerGenerationBlock",
+            description="Generates comprehensive answers using chunk and related context",
+            item_block=GenerateAnswerBlock(logging=logging),
+            items_key="evolved_qa_pairs",
+            max_concurrency=max_concurrency,
+            logging=logging
+        )
+    
+    def post_process(self, context, prepare_response, execute_response):
+        context["final_qa_pairs"] = [qa for qa in execute_response if qa is not None]
         return "default"
 
 class SaveQABlock(Block):
@@ -453,13 +517,16 @@ class SaveQABlock(Block):
     def execute(self, context, prepare_response):
         qa_pairs = prepare_response
         
+        # serialized once, every Q&A pair of the file stores the same flow logs
+        logs = serialize_logs(context.get("logs"))
+        
         with Session(engine) as session:
             for qa in qa_pairs:
                 # Extract logs for this Q&A pair
                 flow_logs = {
                     "timing": context.get("timing", {}),
                     "chain_timing": context.get("chain_timing", {}),
-                    "logs": context.get("logs", []),
+                    "logs": logs,
                     "chunk_text": qa['chunk']['text'][:200] + "..." if len(qa['chunk']['text']) > 200 else qa['chunk']['text'],
                     "related_context": qa.get('related_context', '')[:500] + "..." if len(qa.get('related_context', '')) > 500 else qa.get('related_context', ''),
                     "original_question": qa.get('question', ''),
@@ -490,12 +557,42 @@ class SaveQABlock(Block):
             context["saved_count"] = execute_response[1]
         return "default"
 
+def build_qa_flow(repo_id: uuid.UUID, batch_id: uuid.UUID, file_id: uuid.UUID, save_block: Block = None, checkpoint_store: CheckpointStore = None):
+    """Builds the Q&A generation chain for one file. save_block replaces SaveQABlock (benchmarks run without postgres)"""
+    chunk_scoring = ChunkScoringBlock(logging=False)
+    question_gen = QuestionGenerationBlock(repo_id, logging=False)
+    question_scoring = QuestionScoringBlock(logging=False)
+    question_evolution = QuestionEvolutionBlock(logging=False)
+    answer_gen = AnswerGenerationBlock(logging=False)
+    save_qa = save_block or SaveQABlock(batch_id, file_id)
+    
+    # Connect blocks
+    chunk_scoring >> question_gen
+    question_gen >> question_scoring
+    question_scoring >> question_evolution
+    question_evolution >> answer_gen
+    answer_gen >> save_qa
+    
+    return Chain(
+        name="QAGenerationFlow",
+        starting_block=chunk_scoring,
+        checkpoint_store=checkpoint_store,
+        checkpoint_key=f"qa-{batch_id}-{file_id}"
+    )
+
+def qa_flow_context(chunks: list[dict]):
+    return {
+        "chunks": chunks,
+        "score_threshold": 0.3,  # Lowered from 0.5 to be more inclusive
+        "question_threshold": 0.3,  # Lowered from 0.5 to be more inclusive
+        # logs are copied into gold_qa.flow_logs of every pair, keep only block summaries and failures
+        "log_level": os.getenv("QA_LOG_LEVEL", "summary")
+    }
+
 def work_on_qa_generation(batch_id: uuid.UUID, file_id: uuid.UUID):
     """Main function to generate Q&A pairs for a file"""
     
     # Get file chunks from Qdrant
-    qdrant = QdrantClient(host=os.getenv("QDRANT_HOST"), port=int(os.getenv("QDRANT_PORT")))
-    
     # Get repo_id from file
     with Session(engine) as session:
         from database import file_table
@@ -503,7 +600,7 @@ def work_on_qa_generation(batch_id: uuid.UUID, file_id: uuid.UUID):
         repo_id = session.execute(stmt).scalar_one()
     
     # Search for chunks belonging to this file
-    results = qdrant.scroll(
+    results = qdrant_client.scroll(
         collection_name="chunks",
         scroll_filter=Filter(
             must=[
@@ -526,28 +623,10 @@ def work_on_qa_generation(batch_id: uuid.UUID, file_id: uuid.UUID):
     if not chunks:
         return {"status": "no_chunks", "message": "No chunks found for file"}
     
-    # Create the chain
-    chunk_scoring = ChunkScoringBlock(logging=False)
-    question_gen = QuestionGenerationBlock(repo_id, logging=False)
-    question_scoring = QuestionScoringBlock(logging=False)
-    question_evolution = QuestionEvolutionBlock(logging=False)
-    answer_gen = AnswerGenerationBlock(logging=False)
-    save_qa = SaveQABlock(batch_id, file_id)
-    
-    # Connect blocks
-    chunk_scoring >> question_gen
-    question_gen >> question_scoring
-    question_scoring >> question_evolution
-    question_evolution >> answer_gen
-    answer_gen >> save_qa
-    
-    # Create and run the chain
-    flow = Chain(name="QAGenerationFlow", starting_block=chunk_scoring)
-    context = {
-        "chunks": chunks,
-        "score_threshold": 0.3,  # Lowered from 0.5 to be more inclusive
-        "question_threshold": 0.3  # Lowered from 0.5 to be more inclusive
-    }
+    # checkpointed after every block, so if the job dies (say after AnswerGenerationBlock) the retry resumes at
+    # the next block instead of paying for all the LLM calls again
+    flow = build_qa_flow(repo_id, batch_id, file_id, checkpoint_store=RedisCheckpointStore())
+    context = qa_flow_context(chunks)
     
     flow.run(context)
     
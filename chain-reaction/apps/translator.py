@@ -3,6 +3,7 @@ import os
 
 from utils.llm import Mistral
 from utils.llm import Gemini
+from utils.llm import Router
 from main import Block
 
 
@@ -17,6 +18,10 @@ class Translator(Block):
         self.mistral_llm = Mistral(api_key=mistral_api_key)
         self.gemini_api_key = os.environ.get("GEMINI_API_KEY")
         self.gemini_llm = Gemini(api_key=self.gemini_api_key)
+        self.llm = Router([
+            Mistral(api_key=mistral_api_key, model="mistral-large-latest"),
+            Gemini(api_key=self.gemini_api_key, model="gemini-2.0-flash")
+        ])
 
         # Block specific setup
         self.language = language
@@ -37,12 +42,7 @@ class Translator(Block):
         }
     
     def execute(self, context, prepare_response):
-        self.rotate_llm_token = 0
-        self.rotate_llm_token = (self.rotate_llm_token + 1) % 2
-        if self.rotate_llm_token == 0:
-            return self.mistral_llm.generate_text(model="mistral-large-latest", messages=prepare_response["messages"])
-        else:
-            return self.gemini_llm.generate_text(model="gemini-2.0-flash", messages=prepare_response["messages"])
+        return self.llm.generate_text(messages=prepare_response["messages"])
 
     def post_process(self, context, prepare_response, execute_response):
         context["text"] = execute_response
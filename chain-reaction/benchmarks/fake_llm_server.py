@@ -0,0 +1,246 @@
+# Fake LLM HTTP server for benchmarks and local runs
+# Speaks just enough of the Gemini (generateContent / streamGenerateContent / embedContent / batchEmbedContents) and
+# Mistral (chat/completions, streamed or not / embeddings) APIs for utils/llm.py. Point the clients at it with
+# LLM_BASE_URL (or GEMINI_BASE_URL / MISTRAL_BASE_URL for one provider).
+# - latency: every request sleeps latency_ms +- latency_jitter_ms before answering
+# - streamed answers (server sent events) send the first piece after the latency, then stream_words words every
+#   stream_interval_ms. non streamed answers take just as long in total, so time to first token and total generation
+#   time behave like a real model's
+# - errors: error_rate of the requests get a 429 (with Retry-After) or a 503, to exercise retries
+# - text answers are deterministic (same request, same answer) unless --random, and shaped by the prompt, so the
+#   flows' JSON parsing works: chunk / question scores, eval metrics, questions, evolved questions and plain answers
+# - embeddings are deterministic pseudo random unit vectors seeded by the text, so the same text always lands on the
+#   same point and vector search returns stable results. outputDimensionality (gemini) / output_dimension (mistral)
+#   in the request override the configured dimensions
+# Also runs as the stand-in for the whole stack: docker compose --profile standin up, with LLM_BASE_URL pointing at it
+# (see README_DOCKER.md).
+# Usage:
+#   python -m benchmarks.fake_llm_server --port 8089 --latency-ms 300 --error-rate 0.02
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+EMBEDDING_DIMENSIONS = 3072
+
+
+def fake_embedding(text: str, dimensions: int = EMBEDDING_DIMENSIONS):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def fake_completion(prompt: str, rng: random.Random, answer_words: int = 120):
+    if "g_eval_correctness" in prompt:
+        metrics = {}
+        for metric in ["g_eval_correctness", "g_eval_coherence", "g_eval_tonality", "g_eval_safety", "dag_score",
+                       "contextual_relevancy", "contextual_precision", "contextual_recall", "answer_relevancy",
+                       "answer_faithfulness"]:
+            score = round(rng.uniform(3, 9), 1) if metric == "dag_score" else round(rng.uniform(0.4, 1.0), 2)
+            metrics[metric] = {"score": score, "reason": "Synthetic evaluation from the fake LLM server.", "passed": score >= 0.5}
+        return json.dumps(metrics)
+    if '"self_containment"' in prompt:
+        clarity, containment = round(rng.uniform(0.4, 1.0), 2), round(rng.uniform(0.4, 1.0), 2)
+        return json.dumps({"self_containment": containment, "clarity": clarity, "overall": round((clarity + containment) / 2, 2)})
+    if '"clarity"' in prompt and '"depth"' in prompt:
+        scores = {key: round(rng.uniform(0.3, 1.0), 2) for key in ("clarity", "depth", "structure", "relevance")}
+        scores["overall"] = round(sum(scores.values()) / 4, 2)
+        return "```json\n" + json.dumps(scores) + "\n```"
+    if "Generate a high-quality question" in prompt:
+        return f"How does the code in this chunk handle case {rng.randint(1, 1000)} and why is it structured that way?"
+    if "Rewrite this question" in prompt:
+        return f"What happens in this code path when input {rng.randint(1, 1000)} is invalid, and how would you debug it?"
+    words = ["the", "function", "returns", "a", "value", "from", "the", "chunk", "and", "handles", "errors", "by",
+             "retrying", "the", "request", "with", "backoff", "before", "falling", "back"]
+    return " ".join(rng.choice(words) for _ in range(answer_words)) + "."
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    # keep alive, like the real apis
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, events):
+        # server sent events over chunked transfer encoding, so the connection stays alive afterwards
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for index, event in enumerate(events):
+            if index and self.server.config.stream_interval_ms:
+                time.sleep(self.server.config.stream_interval_ms / 1000)
+            data = f"data: {event if isinstance(event, str) else json.dumps(event)}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _pieces(self, text: str):
+        words = text.split(" ")
+        size = max(1, self.server.config.stream_words)
+        return [" ".join(words[i:i + size]) + (" " if i + size < len(words) else "") for i in range(0, len(words), size)]
+
+    def _sleep_pieces(self, text: str):
+        # a non streamed answer takes as long as the streamed one would
+        if self.server.config.stream_interval_ms:
+            time.sleep(len(self._pieces(text)) * self.server.config.stream_interval_ms / 1000)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self._send(200, {"status": "ok"})
+        elif path == "/v1/models":
+            self._send(200, {"object": "list", "data": [{"id": model, "object": "model", "owned_by": "fake"} for model in ("mistral-large-latest", "mistral-medium-latest", "mistral-embed", "codestral-embed")]})
+        elif path == "/v1beta/models":
+            self._send(200, {"models": [{"name": f"models/{model}"} for model in ("gemini-2.0-flash", "gemini-embedding-001")]})
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        config = self.server.config
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length) or b"{}"
+        request = json.loads(raw)
+        path = urlparse(self.path).path
+        rng = random.Random()
+        # text is seeded by the request, so the same prompt always gets the same answer
+        text_rng = rng if config.random_answers else random.Random(hashlib.sha256(path.encode("utf-8") + raw).digest())
+
+        latency = max(0.0, rng.gauss(config.latency_ms, config.latency_jitter_ms)) / 1000
+        time.sleep(latency)
+
+        if rng.random() < config.error_rate:
+            if rng.random() < 0.5:
+                self._send(429, {"error": {"message": "Resource exhausted (fake)"}}, {"Retry-After": str(config.retry_after)})
+            else:
+                self._send(503, {"error": {"message": "Service unavailable (fake)"}})
+            return
+
+        with self.server.lock:
+            self.server.requests += 1
+
+        if path.endswith(":streamGenerateContent"):
+            prompt = "\n".join(part.get("text", "") for content in request.get("contents", []) for part in content.get("parts", []))
+            text = fake_completion(prompt, text_rng, config.answer_words)
+            events = [{"candidates": [{"content": {"role": "model", "parts": [{"text": piece}]}}]} for piece in self._pieces(text)]
+            events.append({
+                "candidates": [{"content": {"role": "model", "parts": []}, "finishReason": "STOP"}],
+                "usageMetadata": {"promptTokenCount": len(prompt) // 4, "candidatesTokenCount": len(text) // 4, "totalTokenCount": (len(prompt) + len(text)) // 4}
+            })
+            self._send_stream(events)
+        elif path.endswith(":generateContent"):
+            prompt = "\n".join(part.get("text", "") for content in request.get("contents", []) for part in content.get("parts", []))
+            text = fake_completion(prompt, text_rng, config.answer_words)
+            self._sleep_pieces(text)
+            self._send(200, {
+                "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+                "usageMetadata": {"promptTokenCount": len(prompt) // 4, "candidatesTokenCount": len(text) // 4, "totalTokenCount": (len(prompt) + len(text)) // 4}
+            })
+        elif path.endswith(":batchEmbedContents"):
+            self._send(200, {"embeddings": [
+                {"values": fake_embedding("".join(part.get("text", "") for part in item.get("content", {}).get("parts", [])), item.get("outputDimensionality") or config.dimensions)}
+                for item in request.get("requests", [])
+            ]})
+        elif path.endswith(":embedContent"):
+            text = "".join(part.get("text", "") for part in request.get("content", {}).get("parts", []))
+            self._send(200, {"embedding": {"values": fake_embedding(text, request.get("outputDimensionality") or config.dimensions)}})
+        elif path.endswith("/chat/completions"):
+            prompt = "\n".join(
+                part.get("text", "") if isinstance(part, dict) else str(part)
+                for message in request.get("messages", [])
+                for part in (message["content"] if isinstance(message["content"], list) else [{"text": message["content"]}])
+            )
+            text = fake_completion(prompt, text_rng, config.answer_words)
+            usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4, "total_tokens": (len(prompt) + len(text)) // 4}
+            if request.get("stream"):
+                events = [
+                    {"id": "fake", "object": "chat.completion.chunk", "model": request.get("model"), "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                    for piece in self._pieces(text)
+                ]
+                events.append({"id": "fake", "object": "chat.completion.chunk", "model": request.get("model"), "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage})
+                events.append("[DONE]")
+                self._send_stream(events)
+                return
+            self._sleep_pieces(text)
+            self._send(200, {
+                "id": "fake",
+                "object": "chat.completion",
+                "model": request.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+        elif path.endswith("/embeddings"):
+            inputs = request.get("input")
+            inputs = inputs if isinstance(inputs, list) else [inputs]
+            self._send(200, {
+                "object": "list",
+                "data": [{"object": "embedding", "index": index, "embedding": fake_embedding(text, request.get("output_dimension") or config.dimensions)} for index, text in enumerate(inputs)]
+            })
+        else:
+            self._send(404, {"error": {"message": f"Unknown path {path}"}})
+
+
+def make_server(host: str = "127.0.0.1", port: int = 8089, latency_ms: float = 200, latency_jitter_ms: float = 50, error_rate: float = 0.0, retry_after: float = 0, dimensions: int = EMBEDDING_DIMENSIONS, answer_words: int = 120, stream_words: int = 3, stream_interval_ms: float = 20, random_answers: bool = False):
+    server = ThreadingHTTPServer((host, port), FakeLLMHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    server.config = argparse.Namespace(
+        latency_ms=latency_ms,
+        latency_jitter_ms=latency_jitter_ms,
+        error_rate=error_rate,
+        retry_after=retry_after,
+        dimensions=dimensions,
+        answer_words=answer_words,
+        stream_words=stream_words,
+        stream_interval_ms=stream_interval_ms,
+        random_answers=random_answers
+    )
+    server.lock = threading.Lock()
+    server.requests = 0
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Gemini / Mistral server for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--latency-jitter-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0)
+    parser.add_argument("--dimensions", type=int, default=EMBEDDING_DIMENSIONS)
+    parser.add_argument("--answer-words", type=int, default=120)
+    parser.add_argument("--stream-words", type=int, default=3)
+    parser.add_argument("--stream-interval-ms", type=float, default=20)
+    parser.add_argument("--random", action="store_true", help="random answers instead of the same answer for the same request")
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency_ms, args.latency_jitter_ms, args.error_rate, args.retry_after, args.dimensions, args.answer_words, args.stream_words, args.stream_interval_ms, args.random)
+    print(f"Fake LLM server listening on http://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+# Offline benchmark for the chain-reaction flows
+# Runs RAGFlow, QAGenerationFlow and the eval pipeline against local stand-ins instead of the real services:
+# - LLMs: benchmarks/fake_llm_server.py (started here unless --llm-url is given), via GEMINI_BASE_URL / MISTRAL_BASE_URL
+# - Qdrant: embedded in memory (QDRANT_LOCATION=":memory:"), seeded with a synthetic repo
+# - Redis: fakeredis when it's installed, otherwise whatever REDIS_URL points at
+# - Postgres: only the QA flow writes to it (SaveQABlock). With --database-url it runs against that (local) database,
+#   otherwise the rows are built but not inserted. The tables use postgres only types, so sqlite is not an option
+# Every flow runs in its own subprocess so peak RSS is per flow. Reported per flow: runs/sec, p50/p95/p99 latency,
+# error count and peak RSS. --output saves the results as JSON and --compare prints the change against an older file.
+# Usage (from the chain-reaction directory):
+#   python -m benchmarks.run --flows rag,qa,eval --iterations 50 --concurrency 8 --output bench.json
+#   python -m benchmarks.run --compare bench.json --output bench-new.json
+
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+FLOWS = ("rag", "qa", "eval")
+
+BENCH_REPO_ID = "00000000-0000-4000-8000-000000000001"
+SEED_FILES = 20
+SEED_CHUNKS_PER_FILE = 10
+
+
+def synthetic_chunk(file_index: int, chunk_index: int):
+    lines = [f"# module_{file_index}.py, part {chunk_index}"]
+    for function_index in range(6):
+        name = f"handler_{file_index}_{chunk_index}_{function_index}"
+        lines += [
+            f"def {name}(request, retries=3):",
+            f"    \"\"\"Handles request type {function_index} for module {file_index}.\"\"\"",
+            "    for attempt in range(retries):",
+            "        response = send(request, timeout=30)",
+            "        if response.ok:",
+            f"            return parse_{function_index}(response.json())",
+            "    raise RuntimeError('gave up')",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return round(peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024, 1)
+
+
+def percentile(values: list[float], q: int):
+    if not values:
+        return None
+    if len(values) == 1:
+        return round(values[0], 2)
+    return round(statistics.quantiles(values, n=100, method="inclusive")[q - 1], 2)
+
+
+def wait_for_port(host: str, port: int, timeout: float = 10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise Exception(f"Fake LLM server did not come up on {host}:{port}")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# ---- worker side: runs inside the per flow subprocess ----
+
+def configure_stand_ins(args):
+    # has to happen before database.py / utils/llm.py are imported, they read these at import time
+    os.environ["GEMINI_BASE_URL"] = args.llm_url
+    os.environ["MISTRAL_BASE_URL"] = args.llm_url
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    os.environ.setdefault("MISTRAL_API_KEY", "bench")
+    os.environ["QDRANT_LOCATION"] = ":memory:"
+    # measure the flows, not the response cache or the provider quotas (set them in the env to include them)
+    os.environ.setdefault("LLM_CACHE", "0")
+    os.environ.setdefault("RATE_LIMIT", "0")
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    if args.redis_url:
+        os.environ["REDIS_URL"] = args.redis_url
+    else:
+        try:
+            import fakeredis  # noqa: F401
+            os.environ["REDIS_URL"] = "fakeredis://"
+        except ImportError:
+            print("fakeredis is not installed, using REDIS_URL", file=sys.stderr)
+
+
+def seed_qdrant():
+    from database import create_qdrant_chunks_collection, insert_chunks
+    from benchmarks.fake_llm_server import fake_embedding
+
+    create_qdrant_chunks_collection()
+    files = []
+    for file_index in range(SEED_FILES):
+        file_id = str(uuid.UUID(int=file_index + 1))
+        path = f"src/module_{file_index}.py"
+        chunks = [synthetic_chunk(file_index, chunk_index) for chunk_index in range(SEED_CHUNKS_PER_FILE)]
+        insert_chunks(BENCH_REPO_ID, file_id, path, [(chunk, fake_embedding(chunk)) for chunk in chunks])
+        files.append((file_id, path, chunks))
+    return files
+
+
+def make_rag_run(args, files):
+    from apps.github_rag import work_on_rag_request
+
+    def run(index):
+        # a new question every run, otherwise the embedding cache answers everything after the first round
+        question = f"How does handler_{index % SEED_FILES}_{index % SEED_CHUNKS_PER_FILE}_{index % 6} retry failed requests? ({index})"
+        context = work_on_rag_request([{"role": "user", "content": question, "type": "text"}], BENCH_REPO_ID)
+        return context.get("status") == "success"
+    return run
+
+
+def make_eval_run(args, files):
+    from apps.eval_metrics import evaluate_answer
+
+    def run(index):
+        question = f"What does handler_{index % SEED_FILES}_0_{index % 6} return when the response is ok? ({index})"
+        result = evaluate_answer(question, "It returns the parsed JSON of the response.", BENCH_REPO_ID)
+        return bool(result["actual_answer"])
+    return run
+
+
+def make_qa_run(args, files):
+    from apps.qa_generation import SaveQABlock, build_qa_flow, qa_flow_context
+    from utils.checkpoint import RedisCheckpointStore
+
+    batch_id, file_rows = None, {}
+    if args.database_url:
+        batch_id, file_rows = seed_postgres(files)
+
+    class MemorySaveQABlock(SaveQABlock):
+        """SaveQABlock without postgres: the rows are still built (logs serialized, flow_logs JSON encoded), just not inserted"""
+
+        def execute(self, context, prepare_response):
+            from utils.events import serialize_logs
+            logs = serialize_logs(context.get("logs"))
+            for qa in prepare_response:
+                json.dumps({
+                    "question": qa["evolved_question"],
+                    "answer": qa["answer"],
+                    "flow_logs": {"timing": context.get("timing", {}), "chain_timing": context.get("chain_timing", {}), "logs": logs}
+                })
+            return ["success", len(prepare_response)]
+
+    def run(index):
+        file_id, path, chunks = files[index % len(files)]
+        chunk_items = [
+            {"id": str(uuid.uuid4()), "text": text, "file_path": path}
+            for text in chunks[:args.qa_chunks]
+        ]
+        run_batch = batch_id or str(uuid.uuid4())
+        save_block = SaveQABlock(run_batch, file_rows[file_id]) if args.database_url else MemorySaveQABlock(run_batch, file_id)
+        flow = build_qa_flow(BENCH_REPO_ID, f"{run_batch}-{index}", file_id, save_block=save_block, checkpoint_store=RedisCheckpointStore())
+        context = qa_flow_context(chunk_items)
+        flow.run(context)
+        return context.get("saved_count", 0) > 0
+    return run
+
+
+def seed_postgres(files):
+    # repo / file / batch rows the QA flow's inserts point at
+    from sqlalchemy import insert
+    from sqlalchemy.orm import Session
+    from database import create_tables, engine, repo_table, file_table, gold_qa_batch_table
+
+    create_tables()
+    with Session(engine) as session:
+        repo_id = session.execute(insert(repo_table).values(owner="bench", name=f"bench-{uuid.uuid4()}", branch="main").returning(repo_table.c.id)).scalar_one()
+        file_rows = {}
+        for file_id, path, chunks in files:
+            file_rows[file_id] = session.execute(
+                insert(file_table).values(repo_id=repo_id, path=path, raw_content="\n".join(chunks)).returning(file_table.c.id)
+            ).scalar_one()
+        batch_id = session.execute(
+            insert(gold_qa_batch_table).values(repo_id=repo_id, status="running", total_files=len(files)).returning(gold_qa_batch_table.c.id)
+        ).scalar_one()
+        session.commit()
+    return batch_id, file_rows
+
+
+FLOW_RUNNERS = {
+    "rag": make_rag_run,
+    "qa": make_qa_run,
+    "eval": make_eval_run,
+}
+
+
+def run_worker(args):
+    configure_stand_ins(args)
+    files = seed_qdrant()
+    run = FLOW_RUNNERS[args.worker](args, files)
+
+    for index in range(args.warmup):
+        run(-index - 1)
+
+    latencies, errors = [], 0
+
+    def timed(index):
+        start = time.perf_counter()
+        try:
+            ok = run(index)
+        except Exception as e:
+            print(f"Run {index} failed: {str(e)}", file=sys.stderr)
+            ok = False
+        return (time.perf_counter() - start) * 1000, ok
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for latency_ms, ok in executor.map(timed, range(args.iterations)):
+            latencies.append(latency_ms)
+            errors += 0 if ok else 1
+    wall = time.perf_counter() - wall_start
+
+    return {
+        "flow": args.worker,
+        "runs": args.iterations,
+        "errors": errors,
+        "concurrency": args.concurrency,
+        "wall_s": round(wall, 3),
+        "runs_per_s": round(args.iterations / wall, 3) if wall > 0 else None,
+        "mean_ms": round(statistics.fmean(latencies), 2) if latencies else None,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+# ---- driver side ----
+
+def start_fake_server(args):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_llm_server", "--port", str(port),
+         "--latency-ms", str(args.latency_ms), "--latency-jitter-ms", str(args.latency_jitter_ms),
+         "--error-rate", str(args.error_rate)],
+        stdout=subprocess.DEVNULL
+    )
+    wait_for_port("127.0.0.1", port)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def run_flow(flow: str, args, llm_url: str):
+    command = [
+        sys.executable, "-m", "benchmarks.run", "--worker", flow, "--llm-url", llm_url,
+        "--iterations", str(args.iterations), "--concurrency", str(args.concurrency),
+        "--warmup", str(args.warmup), "--qa-chunks", str(args.qa_chunks),
+    ]
+    if args.database_url:
+        command += ["--database-url", args.database_url]
+    if args.redis_url:
+        command += ["--redis-url", args.redis_url]
+    # the flows print a lot, only the last line (the result) is ours
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        print(completed.stderr[-2000:], file=sys.stderr)
+        raise Exception(f"Benchmark for {flow} failed with exit code {completed.returncode}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def print_results(results: list[dict], previous: dict = None):
+    columns = ["flow", "runs", "errors", "runs_per_s", "p50_ms", "p95_ms", "p99_ms", "peak_rss_mb"]
+    print(" | ".join(f"{column:>11}" for column in columns))
+    for result in results:
+        print(" | ".join(f"{str(result[column]):>11}" for column in columns))
+        old = (previous or {}).get(result["flow"])
+        if old:
+            changes = []
+            for column in columns[3:]:
+                if old.get(column) and result.get(column) is not None:
+                    changes.append(f"{(result[column] - old[column]) / old[column] * 100:+.1f}%")
+                else:
+                    changes.append("-")
+            print(" | ".join(f"{value:>11}" for value in ["  vs prev", "", "", *changes]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the chain-reaction flows")
+    parser.add_argument("--flows", default=",".join(FLOWS))
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--qa-chunks", type=int, default=4, help="chunks per file in the QA flow")
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--latency-jitter-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-url", help="use an already running fake (or real) LLM server")
+    parser.add_argument("--database-url", help="local postgres for the QA flow's inserts")
+    parser.add_argument("--redis-url", help="real redis instead of fakeredis")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier run to compare against")
+    parser.add_argument("--worker", choices=FLOWS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args)), flush=True)
+        return
+
+    server = None
+    llm_url = args.llm_url
+    if llm_url is None:
+        server, llm_url = start_fake_server(args)
+
+    try:
+        results = []
+        for flow in [flow.strip() for flow in args.flows.split(",") if flow.strip()]:
+            print(f"Benchmarking {flow}...", flush=True)
+            results.append(run_flow(flow, args, llm_url))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {result["flow"]: result for result in json.load(f)["results"]}
+    print_results(results, previous)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "created_at": datetime.utcnow().isoformat(),
+                "config": {key: value for key, value in vars(args).items() if key not in ("worker", "output", "compare")},
+                "results": results
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,12 @@
 import os
-from uuid import uuid4
+from uuid import uuid4, uuid5, NAMESPACE_URL
 from datetime import datetime
 from sqlalchemy import create_engine, Table, Column, String, DateTime, ForeignKey, text, Integer, Float, Boolean
 from sqlalchemy.dialects.postgresql import UUID, JSONB
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams
+from qdrant_client.http.models import Distance, VectorParams, PayloadSchemaType
 import redis
 from rq import Queue
 
@@ -20,11 +20,22 @@ metadata = Base.metadata
 # Qdrant configuration
 QDRANT_HOST = os.getenv("QDRANT_HOST", "localhost")
 QDRANT_PORT = int(os.getenv("QDRANT_PORT", "6333"))
-qdrant_client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
+# QDRANT_LOCATION=":memory:" (or a directory) runs qdrant embedded in the process instead of talking to the server.
+# used by the benchmarks. an embedded qdrant is per client, so everything has to share this one
+QDRANT_LOCATION = os.getenv("QDRANT_LOCATION")
+if QDRANT_LOCATION:
+    qdrant_client = QdrantClient(location=QDRANT_LOCATION) if QDRANT_LOCATION == ":memory:" else QdrantClient(path=QDRANT_LOCATION)
+else:
+    qdrant_client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
 
 # Redis configuration
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-redis_conn = redis.from_url(REDIS_URL)
+if REDIS_URL.startswith("fakeredis://"):
+    # in process stand-in for benchmarks and scripts, needs the fakeredis package
+    import fakeredis
+    redis_conn = fakeredis.FakeRedis()
+else:
+    redis_conn = redis.from_url(REDIS_URL)
 task_queue = Queue(connection=redis_conn)
 github_queue = Queue('github', connection=redis_conn)
 rag_queue = Queue('rag', connection=redis_conn)
@@ -43,7 +54,7 @@ eval_queue = Queue('eval', connection=redis_conn)
     - id (auto gen uuid)
     - repo_id (foreign key to Repo.id)
     - path
-    - raw_content
+    - raw_content (null for files over 1MB, those are kept in minio as repo-files/<file id>)
     - summary
     - summary_status (processing, processed, failed)
     - chunks_status (processing, processed, failed)
@@ -88,6 +99,10 @@ eval_queue = Queue('eval', connection=redis_conn)
     - relevant_chunks (jsonb)
     - metrics (jsonb) - stores all metric scores and reasons
     - created_at
+- ChainCheckpoint
+    - key (str - checkpoint key of a chain run, e.g. qa-{batch_id}-{file_id})
+    - state (jsonb) - next block + serializable context (see utils/checkpoint.py)
+    - updated_at
 """
 repo_table = Table("repos", metadata,
     Column("id", UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()")),
@@ -154,6 +169,12 @@ eval_metrics_table = Table("eval_metrics", metadata,
     Column("created_at", DateTime, nullable=False, default=datetime.utcnow),
 )
 
+chain_checkpoints_table = Table("chain_checkpoints", metadata,
+    Column("key", String, primary_key=True),
+    Column("state", JSONB, nullable=False),
+    Column("updated_at", DateTime, nullable=False, default=datetime.utcnow),
+)
+
 def create_tables():
     """Create the tables if they don't exist"""
     # First ensure UUID extension is available in PostgreSQL
@@ -180,6 +201,8 @@ def create_qdrant_chunks_collection():
         print("Qdrant chunks collection created successfully")
     else:
         print("Qdrant chunks collection already exists")
+    # re-chunking a file looks up its points by file_id
+    qdrant_client.create_payload_index(collection_name="chunks", field_name="file_id", field_schema=PayloadSchemaType.KEYWORD)
     return
 
 """
@@ -189,25 +212,37 @@ def create_qdrant_chunks_collection():
     - file_id
     - file_path
     - raw_chunk_text
+    - chunk_hash (sha256 of the chunk without the file summary, see utils/chunking.py chunk_hash)
     - vector_embeddings
     - added_at
 """
-def insert_chunks(repo_id: str, file_id: str, file_path: str, chunks: list[(str, list[float])]):
+# chunk point ids are uuid5s in this namespace
+CHUNK_NAMESPACE = uuid5(NAMESPACE_URL, "chain-reaction/chunks")
+
+def chunk_point_id(file_id: str, chunk_hash: str, occurrence: int = 0):
+    # the same chunk of the same file always gets the same point id, so re-chunking a changed file can tell the chunks
+    # it already has (and gold QA pairs keep pointing at unchanged chunks). occurrence counts repeats within the file
+    return str(uuid5(CHUNK_NAMESPACE, f"{file_id}:{chunk_hash}:{occurrence}"))
+
+def insert_chunks(repo_id: str, file_id: str, file_path: str, chunks: list[(str, list[float])], point_ids: list[str] = None, chunk_hashes: list[str] = None):
     # upsert chunk into qdrant
     from qdrant_client.models import PointStruct
     
     points = []
-    for chunk_text, chunk_embedding in chunks:
+    for i, (chunk_text, chunk_embedding) in enumerate(chunks):
+        payload = {  # All other data goes in payload
+            "repo_id": str(repo_id),
+            "file_id": str(file_id),
+            "file_path": file_path,
+            "raw_chunk_text": chunk_text,
+            "added_at": datetime.utcnow().isoformat()
+        }
+        if chunk_hashes is not None:
+            payload["chunk_hash"] = chunk_hashes[i]
         point = PointStruct(
-            id=str(uuid4()),  # Qdrant expects string ID
+            id=point_ids[i] if point_ids is not None else str(uuid4()),  # Qdrant expects string ID
             vector=chunk_embedding,  # The embedding vector
-            payload={  # All other data goes in payload
-                "repo_id": str(repo_id),
-                "file_id": str(file_id),
-                "file_path": file_path,
-                "raw_chunk_text": chunk_text,
-                "added_at": datetime.utcnow().isoformat()
-            }
+            payload=payload
         )
         points.append(point)
     
@@ -218,6 +253,31 @@ def insert_chunks(repo_id: str, file_id: str, file_path: str, chunks: list[(str,
             points=points
         )
 
+def get_chunk_point_ids(file_id: str):
+    # ids of all points of a file, without payloads or vectors
+    from qdrant_client.models import Filter, FieldCondition, MatchValue
+
+    point_ids = []
+    offset = None
+    while True:
+        points, offset = qdrant_client.scroll(
+            collection_name="chunks",
+            scroll_filter=Filter(must=[FieldCondition(key="file_id", match=MatchValue(value=str(file_id)))]),
+            limit=1000,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False
+        )
+        point_ids.extend(str(point.id) for point in points)
+        if offset is None:
+            return point_ids
+
+def delete_chunk_points(point_ids: list[str]):
+    from qdrant_client.models import PointIdsList
+
+    if point_ids:
+        qdrant_client.delete(collection_name="chunks", points_selector=PointIdsList(points=list(point_ids)))
+
 # Dependency for FastAPI
 def get_db():
     db = SessionLocal()
@@ -5,18 +5,88 @@
 # - execute: core compute. takes the output from prepare as context. doesn't read/write to storage directly. ex: llm calls. This emits execute_response. This is where retries are handled and any exceptions (if any) are raised.
 # - post_process: takes the output from execute and does some post processing. ex: formatting the output. This takes in response from prepare and execute's and makes any updates as required to the shared context. And decides on next steps.
 # - execute_fallback: if execute fails even after retries, then this is called to see if there is a fallback plan. if not, the error is percolated up.
+#
+# AsyncBlock / AsyncChain are the asyncio flavour of the above. prepare/execute/post_process are coroutines and retries
+# sleep without blocking the event loop, so one worker process can keep many chains in flight at the same time.
+# Sync blocks can still be linked into an AsyncChain. They are run in a worker thread so they don't stall the loop.
+#
+# Parallel / AsyncParallel give a chain DAG shape. A Parallel block fans out to several branches (a branch is any
+# block, including a whole Chain), runs them concurrently and fans back in: each branch works on its own copy of the
+# context and whatever it wrote is merged back, so the next block (the join) sees all the outputs.
+#   search = Parallel(name="Search", branches=[ddg_search, brave_search])
+#   plan >> search
+#   search >> draft
+#
+# MapBlock runs one item block over every element of a list in the context, a few at a time. The item block sees
+# {'item': ..., 'index': ..., 'parent': context} as its context and puts its answer in context['result']. Retries and
+# fallback are the item block's own, so one bad item doesn't restart the whole list. Results keep the input order.
+#
+# Any block can opt into a result cache: Block(..., cache=RedisCache(), cache_ttl=3600). The key is a hash of the block
+# name + prepare_response (override cache_key for anything else), only successful execute results are stored and
+# context['timing'][block]['cache_hits' / 'cache_misses'] count how often execute was skipped.
+#
+# Retries follow the block's retry_policy (utils/retry.py): exponential backoff with jitter, Retry-After support and no
+# retries for errors that can't succeed (4xx). Blocks without one keep the plain retries/retry_delay behaviour.
+#
+# Block(timeout=...) bounds every execute attempt, Chain(deadline=...) bounds the whole run (utils/deadline.py). The
+# deadline is kept in context['deadline'] and in a contextvar that the LLM clients use for their socket timeouts.
+# Once it has passed, blocks stop retrying and fall back (or fail) instead of starting new attempts.
+#
+# Hooks (utils/hooks.py) are called around every phase of a run: Block(hooks=[...]), Chain(hooks=[...]) for everything
+# in the chain, or register_hook() for the whole process. Built in ones cover profiling, tracemalloc and span export.
+#
+# LLM calls made while a block runs are counted into context['timing'][block]: llm_calls, prompt_tokens,
+# completion_tokens, llm_ms and cost_usd (utils/metrics.py). A chain's entry includes the calls of its blocks.
+#
+# context['logs'] is an EventLog (utils/events.py). Events are recorded compactly and only turned into dicts when the
+# log is serialized (serialize_logs / EventLog.to_list). context['log_level'] = "off" | "summary" | "full" sets verbosity.
 
+import asyncio
+import contextvars
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
+from utils.cache import Cache, stable_hash
+from utils.checkpoint import CheckpointStore, serializable_context
+from utils.events import EventLog
+from utils.retry import RetryPolicy
+from utils.hooks import Hook, active_hooks, emit, hook_scope
+from utils.deadline import BlockTimeout, check_deadline, deadline_scope, remaining, resolve_deadline
+from utils.metrics import current_usage, usage_scope
+
+def run_async_block(block, context):
+    """
+    Runs an AsyncBlock from sync code on an event loop of its own. The http clients opened on that loop
+    (utils/http.py keeps them per loop) are closed before it ends, a closed loop can't reuse them and they would leak.
+    """
+    async def run():
+        try:
+            return await block.run(context)
+        finally:
+            # only if something imported it, no clients otherwise
+            http = sys.modules.get("utils.http")
+            if http is not None:
+                await http.close_async_clients()
+    return asyncio.run(run())
 
 class Block:
-    def __init__(self, name: str = None, description: str = None, retries: int = 1, retry_delay: int = 0, logging: bool = False):
+    def __init__(self, name: str = None, description: str = None, retries: int = 1, retry_delay: int = 0, logging: bool = False, cache: Cache = None, cache_ttl: float = None, retry_policy: RetryPolicy = None, timeout: float = None, hooks: list[Hook] = None):
         self.name = name
         self.description = description
-        self.retries = retries
+        self.retries = retry_policy.max_attempts if retry_policy is not None else retries
         self.retry_delay = retry_delay
+        # backoff/jitter/error classification (see utils/retry.py). without one, retries + retry_delay are used as is
+        self.retry_policy = retry_policy
+        # seconds a single execute attempt may take. the time left before the chain deadline is used when it's shorter
+        self.timeout = timeout
+        # instrumentation for this block only (utils/hooks.py). a Chain's hooks also cover every block it runs
+        self.hooks = list(hooks or [])
         self.logging = logging
         self.next_blocks = {}
+        # opt-in result cache (see utils/cache.py). execute is skipped when the same input was seen before
+        self.cache = cache
+        self.cache_ttl = cache_ttl
 
     def prepare(self, context):
         pass
@@ -26,139 +96,224 @@ class Block:
     
     def post_process(self, context, prepare_response, execute_response):
         pass
-    
-    def run(self, context):
-        # Initialize timing context if not exists
+
+    def cache_key(self, context, prepare_response):
+        # content address of an execute call. override this if execute depends on more than prepare_response
+        try:
+            return stable_hash(self.name or self.__class__.__name__, prepare_response)
+        except TypeError:
+            # not JSON serializable, don't cache
+            return None
+
+    def _cache_get(self, key):
+        try:
+            return self.cache.get(key)
+        except Exception as e:
+            # a broken cache should never fail the block. treat it as a miss
+            print(f"Cache get failed for block {self.name}: {str(e)}")
+            return False, None
+
+    def _cache_set(self, key, value):
+        try:
+            self.cache.set(key, value, self.cache_ttl)
+        except Exception as e:
+            print(f"Cache set failed for block {self.name}: {str(e)}")
+
+    def _cache_timing(self, context, cache_key, cache_hit):
+        # hit/miss counters accumulate over every run of this block in the context
+        if cache_key is None:
+            return {}
+        previous = context['timing'].get(self.name, {})
+        return {
+            'cache_hits': previous.get('cache_hits', 0) + (1 if cache_hit else 0),
+            'cache_misses': previous.get('cache_misses', 0) + (0 if cache_hit else 1)
+        }
+
+    def execute_timeout(self):
+        if self.timeout is None:
+            return None
+        left = remaining()
+        return self.timeout if left is None else max(0, min(self.timeout, left))
+
+    def _execute_with_timeout(self, context, prepare_response):
+        timeout = self.execute_timeout()
+        if timeout is None:
+            return self.execute(context, prepare_response)
+        # execute runs in its own thread so we can stop waiting for it. python can't kill the thread, a hung call keeps
+        # running in the background until its own socket timeout (request_timeout in utils/deadline.py) gives up
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(contextvars.copy_context().run, self.execute, context, prepare_response)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise BlockTimeout(f"Block {self.name} execute timed out after {timeout:.2f}s")
+        finally:
+            executor.shutdown(wait=False)
+
+    def get_retry_policy(self):
+        return self.retry_policy or RetryPolicy.fixed(self.retries, self.retry_delay)
+
+    def _run_logs(self, context):
+        # Initialize timing/logs context if not exists. logs is an EventLog (utils/events.py), a plain list left
+        # over from an older context (or a restored checkpoint) is wrapped into one
         if 'timing' not in context:
             context['timing'] = {}
-        if 'logs' not in context:
-            context['logs'] = []
+        logs = context.get('logs')
+        if not isinstance(logs, EventLog):
+            logs = EventLog(level=context.get('log_level'), records=logs)
+            context['logs'] = logs
+        return logs
+
+    def _record_timing(self, context, block_ns, prepare_ns, execute_ns, post_process_ns, cache_key, cache_hit):
+        context['timing'][self.name] = {
+            'total_ms': round(block_ns / 1e6, 2),
+            'prepare_ms': round(prepare_ns / 1e6, 2),
+            'execute_ms': round(execute_ns / 1e6, 2),
+            'post_process_ms': round(post_process_ns / 1e6, 2),
+            **self._cache_timing(context, cache_key, cache_hit),
+            **self._usage_timing()
+        }
+
+    def _usage_timing(self):
+        usage = current_usage()
+        return usage.as_timing() if usage is not None else {}
+    
+    def run(self, context):
+        hooks = active_hooks(self.hooks)
+        if not hooks:
+            return self._run(context, hooks)
+
+        block_start = time.perf_counter_ns()
+        emit(hooks, 'before_block', self, context)
+        try:
+            response = self._run(context, hooks)
+        except Exception as e:
+            emit(hooks, 'after_block', self, context, time.perf_counter_ns() - block_start, e)
+            raise
+        emit(hooks, 'after_block', self, context, time.perf_counter_ns() - block_start)
+        return response
+
+    def _run(self, context, hooks):
+        # llm calls made during the run are added up here (utils/metrics.py) and land in context['timing']
+        with usage_scope():
+            return self._run_block(context, hooks)
+
+    def _run_block(self, context, hooks):
+        logs = self._run_logs(context)
             
-        block_start_time = time.time()
+        block_start = time.perf_counter_ns()
         
         if self.logging:
             print(f"Running block {self.name}")
             
-        # Add log entry for block start
-        context['logs'].append({
-            'timestamp': datetime.utcnow().isoformat(),
-            'block': self.name,
-            'event': 'block_started',
-            'message': f'Started executing block: {self.name}'
-        })
+        logs.record(self.name, 'block_started')
         
         # Time prepare phase
-        prepare_start = time.time()
+        if hooks:
+            emit(hooks, 'before_prepare', self, context)
+        prepare_start = time.perf_counter_ns()
         prepare_response = self.prepare(context)
-        prepare_duration = time.time() - prepare_start
+        prepare_duration = time.perf_counter_ns() - prepare_start
         
         # if self.logging:
         #     print(f"Prepare response: {prepare_response}")
             
-        context['logs'].append({
-            'timestamp': datetime.utcnow().isoformat(),
-            'block': self.name,
-            'event': 'prepare_completed',
-            'duration_ms': round(prepare_duration * 1000, 2),
-            'message': f'Prepare phase completed in {round(prepare_duration * 1000, 2)}ms'
-        })
+        logs.record(self.name, 'prepare_completed', prepare_duration)
+        if hooks:
+            emit(hooks, 'after_prepare', self, context, prepare_duration)
 
 
-        self.current_attempt = 0
+        # attempt counter is kept local (not on self) so the same block instance can run in several chains at once
+        current_attempt = 0
         execute_response = None
         execute_error = None
-        execute_start = time.time()
+        execute_start = time.perf_counter_ns()
 
         # define a lambda that will retry the execute call
-        retry_execute = lambda: self.execute(context, prepare_response)
+        retry_execute = lambda: self._execute_with_timeout(context, prepare_response)
 
-        while self.current_attempt < self.retries:
+        cache_key = self.cache_key(context, prepare_response) if self.cache is not None else None
+        cache_hit = False
+        if cache_key is not None:
+            cache_hit, cached_response = self._cache_get(cache_key)
+            if cache_hit:
+                execute_response = cached_response
+                logs.record(self.name, 'execute_cache_hit')
+
+        retry_policy = self.get_retry_policy()
+
+        while not cache_hit and current_attempt < retry_policy.max_attempts:
             try:
-                attempt_start = time.time()
+                attempt_start = time.perf_counter_ns()
+                if hooks:
+                    emit(hooks, 'before_execute_attempt', self, context, current_attempt + 1)
+                check_deadline(self.name)
                 execute_response = retry_execute()
-                attempt_duration = time.time() - attempt_start
+                attempt_duration = time.perf_counter_ns() - attempt_start
                 
                 if self.logging:
-                    print(f"Execute response attempt {self.current_attempt}: {execute_response}")
+                    print(f"Execute response attempt {current_attempt}: {execute_response}")
                     
-                context['logs'].append({
-                    'timestamp': datetime.utcnow().isoformat(),
-                    'block': self.name,
-                    'event': 'execute_attempt_success',
-                    'attempt': self.current_attempt + 1,
-                    'duration_ms': round(attempt_duration * 1000, 2),
-                    'message': f'Execute attempt {self.current_attempt + 1} succeeded in {round(attempt_duration * 1000, 2)}ms'
-                })
+                logs.record(self.name, 'execute_attempt_success', attempt_duration, attempt=current_attempt + 1)
+                if hooks:
+                    emit(hooks, 'after_execute_attempt', self, context, current_attempt + 1, attempt_duration, None)
                 
                 execute_error = None
                 break
             except Exception as e:
                 execute_error = e
-                self.current_attempt += 1
+                current_attempt += 1
                 
-                context['logs'].append({
-                    'timestamp': datetime.utcnow().isoformat(),
-                    'block': self.name,
-                    'event': 'execute_attempt_failed',
-                    'attempt': self.current_attempt,
-                    'error': str(e),
-                    'message': f'Execute attempt {self.current_attempt} failed: {str(e)}'
-                })
+                logs.record(self.name, 'execute_attempt_failed', attempt=current_attempt, error=str(e))
+                if hooks:
+                    emit(hooks, 'after_execute_attempt', self, context, current_attempt, time.perf_counter_ns() - attempt_start, e)
                 
-                time.sleep(self.retry_delay)
+                # None = not worth retrying (non retryable error, out of attempts or out of time)
+                delay = retry_policy.next_delay(current_attempt, e, (time.perf_counter_ns() - execute_start) / 1e9)
+                if delay is None:
+                    break
+                time.sleep(delay)
+
+        if cache_key is not None and not cache_hit and not execute_error:
+            self._cache_set(cache_key, execute_response)
 
         if execute_error:
-            fallback_start = time.time()
+            if hooks:
+                emit(hooks, 'before_fallback', self, context, execute_error)
+            fallback_start = time.perf_counter_ns()
             execute_response = self.execute_fallback(context, prepare_response, execute_error)
-            fallback_duration = time.time() - fallback_start
+            fallback_duration = time.perf_counter_ns() - fallback_start
             
             if self.logging:
                 print(f"Execute fallback response: {execute_response}")
                 
-            context['logs'].append({
-                'timestamp': datetime.utcnow().isoformat(),
-                'block': self.name,
-                'event': 'execute_fallback',
-                'duration_ms': round(fallback_duration * 1000, 2),
-                'message': f'Execute fallback completed in {round(fallback_duration * 1000, 2)}ms'
-            })
+            logs.record(self.name, 'execute_fallback', fallback_duration)
+            if hooks:
+                emit(hooks, 'after_fallback', self, context, fallback_duration)
 
-        execute_duration = time.time() - execute_start
+        execute_duration = time.perf_counter_ns() - execute_start
         
         # Time post-process phase
-        post_process_start = time.time()
+        if hooks:
+            emit(hooks, 'before_post_process', self, context)
+        post_process_start = time.perf_counter_ns()
         post_process_response = self.post_process(context, prepare_response, execute_response)
-        post_process_duration = time.time() - post_process_start
+        post_process_duration = time.perf_counter_ns() - post_process_start
         
         if self.logging:
             print(f"Post process response: {post_process_response}")
             
-        context['logs'].append({
-            'timestamp': datetime.utcnow().isoformat(),
-            'block': self.name,
-            'event': 'post_process_completed',
-            'duration_ms': round(post_process_duration * 1000, 2),
-            'message': f'Post-process phase completed in {round(post_process_duration * 1000, 2)}ms'
-        })
+        logs.record(self.name, 'post_process_completed', post_process_duration)
+        if hooks:
+            emit(hooks, 'after_post_process', self, context, post_process_duration)
 
         # Calculate total block duration
-        block_duration = time.time() - block_start_time
+        block_duration = time.perf_counter_ns() - block_start
         
         # Store timing info in context
-        context['timing'][self.name] = {
-            'total_ms': round(block_duration * 1000, 2),
-            'prepare_ms': round(prepare_duration * 1000, 2),
-            'execute_ms': round(execute_duration * 1000, 2),
-            'post_process_ms': round(post_process_duration * 1000, 2)
-        }
+        self._record_timing(context, block_duration, prepare_duration, execute_duration, post_process_duration, cache_key, cache_hit)
         
-        context['logs'].append({
-            'timestamp': datetime.utcnow().isoformat(),
-            'block': self.name,
-            'event': 'block_completed',
-            'duration_ms': round(block_duration * 1000, 2),
-            'message': f'Block {self.name} completed in {round(block_duration * 1000, 2)}ms'
-        })
+        logs.record(self.name, 'block_completed', block_duration)
 
         return post_process_response
 
@@ -189,17 +344,102 @@ class HelperDefinition:
         return self.src
 
 
+def _chain_blocks(starting_block: Block):
+    # every block reachable from the starting block, by name. names have to be unique to resume from a checkpoint
+    blocks = {}
+    pending = [starting_block]
+    seen = set()
+    while pending:
+        block = pending.pop()
+        if id(block) in seen:
+            continue
+        seen.add(id(block))
+        if block.name in blocks:
+            raise ValueError(f"Block name {block.name} is used more than once. Checkpointed chains need unique block names")
+        blocks[block.name] = block
+        pending.extend(block.next_blocks.values())
+    return blocks
+
+def _checkpoint_key(chain, context):
+    if chain.checkpoint_store is None:
+        return None
+    return chain.checkpoint_key or context.get('checkpoint_key')
+
+def _resume_from_checkpoint(chain, context):
+    """
+    Returns (block to start at, block_count). Restores the saved context when there is a checkpoint for this run.
+    """
+    key = _checkpoint_key(chain, context)
+    if key is None:
+        return chain.starting_block, 0
+    try:
+        state = chain.checkpoint_store.load(key)
+    except Exception as e:
+        print(f"Failed to load checkpoint {key}, starting from the first block: {str(e)}")
+        return chain.starting_block, 0
+    if not state:
+        return chain.starting_block, 0
+
+    next_block = _chain_blocks(chain.starting_block).get(state['next_block'])
+    if next_block is None:
+        print(f"Checkpoint {key} points at unknown block {state['next_block']}, starting from the first block")
+        return chain.starting_block, 0
+
+    context.update(state['context'])
+    if not isinstance(context.get('logs'), EventLog):
+        context['logs'] = EventLog(level=context.get('log_level'), records=context.get('logs'))
+    context['logs'].record(chain.name, 'chain_resumed', next_block=next_block.name)
+    return next_block, state['block_count']
+
+def _save_checkpoint(chain, context, next_block, block_count):
+    key = _checkpoint_key(chain, context)
+    if key is None:
+        return
+    try:
+        if next_block is None:
+            # chain is done, nothing to resume
+            chain.checkpoint_store.delete(key)
+        else:
+            chain.checkpoint_store.save(key, {
+                'next_block': next_block.name,
+                'block_count': block_count,
+                'context': serializable_context(context)
+            })
+    except Exception as e:
+        # losing a checkpoint only costs a rerun, it should never fail the chain
+        print(f"Failed to save checkpoint {key}: {str(e)}")
+
+
+def _set_deadline(context, deadline):
+    if deadline is None:
+        context.pop('deadline', None)
+    else:
+        context['deadline'] = deadline
+
+
 class Chain(Block):
-    def __init__(self, name: str = None, description: str = None, starting_block: Block = None):
-        super().__init__(name=name, description=description, retries=1, retry_delay=0)
+    """
+    Runs blocks one after the other, following the action each block returns.
+    With a checkpoint_store (utils/checkpoint.py) the serializable part of the context is saved after every block
+    under checkpoint_key (or context['checkpoint_key']) and a rerun with the same key resumes at the next block.
+    With a deadline (seconds, or an absolute context['deadline'] from the caller) every block and LLM call in the run
+    is bounded by the time left.
+    """
+
+    def __init__(self, name: str = None, description: str = None, starting_block: Block = None, checkpoint_store: CheckpointStore = None, checkpoint_key: str = None, deadline: float = None, hooks: list[Hook] = None):
+        super().__init__(name=name, description=description, retries=1, retry_delay=0, hooks=hooks)
         self.starting_block = starting_block
+        self.checkpoint_store = checkpoint_store
+        self.checkpoint_key = checkpoint_key
+        # seconds the whole run may take. stored as an absolute time in context['deadline']
+        self.deadline = deadline
 
     def start(self, start: Block):
         self.starting_block = start
         return start
     
     def execute(self, context, prepare_response):
-        chain_start_time = time.time()
+        chain_start_time = time.perf_counter_ns()
         
         # Initialize chain-level timing
         if 'chain_timing' not in context:
@@ -208,40 +448,430 @@ class Chain(Block):
                 'blocks_executed': []
             }
         
-        current_block = self.starting_block
+        deadline = resolve_deadline(context, self.deadline)
+        current_block, block_count = _resume_from_checkpoint(self, context)
+        # a restored checkpoint carries the deadline of the run that died, this run gets its own
+        _set_deadline(context, deadline)
         action = None
-        block_count = 0
         
-        while True:
-            block_name = current_block.name or f"Block_{block_count}"
-            context['chain_timing']['blocks_executed'].append(block_name)
-            
-            action = current_block.run(context)
-            if action is None:
-                action = "default"
-            # Ask current_block if there's a next block
-            next_block = current_block.get_next_block(action)
-            if next_block is None:
-                # complete the chain
-                break
-            current_block = next_block
-            block_count += 1
+        with deadline_scope(deadline), hook_scope(self.hooks):
+            while True:
+                block_name = current_block.name or f"Block_{block_count}"
+                context['chain_timing']['blocks_executed'].append(block_name)
+                
+                if isinstance(current_block, AsyncBlock):
+                    # an async block inside a sync chain gets its own event loop
+                    action = run_async_block(current_block, context)
+                else:
+                    action = current_block.run(context)
+                if action is None:
+                    action = "default"
+                # Ask current_block if there's a next block
+                next_block = current_block.get_next_block(action)
+                _save_checkpoint(self, context, next_block, block_count + 1)
+                if next_block is None:
+                    # complete the chain
+                    break
+                current_block = next_block
+                block_count += 1
             
         # Calculate total chain duration
-        chain_duration = time.time() - chain_start_time
-        context['chain_timing']['total_duration_ms'] = round(chain_duration * 1000, 2)
+        chain_duration = time.perf_counter_ns() - chain_start_time
+        context['chain_timing']['total_duration_ms'] = round(chain_duration / 1e6, 2)
         context['chain_timing']['end_time'] = datetime.utcnow().isoformat()
         
         # Add final log entry
-        context['logs'].append({
-            'timestamp': datetime.utcnow().isoformat(),
-            'block': 'Chain',
-            'event': 'chain_completed',
-            'duration_ms': round(chain_duration * 1000, 2),
-            'blocks_executed': block_count + 1,
-            'message': f'Chain completed: executed {block_count + 1} blocks in {round(chain_duration * 1000, 2)}ms'
-        })
+        context['logs'].record('Chain', 'chain_completed', chain_duration, blocks_executed=block_count + 1)
         
         return action
 
 
+
+
+class AsyncBlock(Block):
+    """
+    Same lifecycle as Block, but prepare/execute/post_process/execute_fallback are coroutines.
+    Use this for blocks that spend their time waiting on the network (LLM calls, vector search etc).
+    """
+
+    async def prepare(self, context):
+        pass
+
+    async def execute(self, context, prepare_response):
+        pass
+
+    async def post_process(self, context, prepare_response, execute_response):
+        pass
+
+    async def execute_fallback(self, context, prepare_response, error):
+        #  by default just raise the error
+        raise error
+
+    async def _execute_with_timeout(self, context, prepare_response):
+        timeout = self.execute_timeout()
+        if timeout is None:
+            return await self.execute(context, prepare_response)
+        try:
+            return await asyncio.wait_for(self.execute(context, prepare_response), timeout)
+        except asyncio.TimeoutError:
+            raise BlockTimeout(f"Block {self.name} execute timed out after {timeout:.2f}s")
+
+    async def run(self, context):
+        hooks = active_hooks(self.hooks)
+        if not hooks:
+            return await self._run(context, hooks)
+
+        block_start = time.perf_counter_ns()
+        emit(hooks, 'before_block', self, context)
+        try:
+            response = await self._run(context, hooks)
+        except Exception as e:
+            emit(hooks, 'after_block', self, context, time.perf_counter_ns() - block_start, e)
+            raise
+        emit(hooks, 'after_block', self, context, time.perf_counter_ns() - block_start)
+        return response
+
+    async def _run(self, context, hooks):
+        with usage_scope():
+            return await self._run_block(context, hooks)
+
+    async def _run_block(self, context, hooks):
+        logs = self._run_logs(context)
+
+        block_start = time.perf_counter_ns()
+
+        if self.logging:
+            print(f"Running block {self.name}")
+
+        logs.record(self.name, 'block_started')
+
+        if hooks:
+            emit(hooks, 'before_prepare', self, context)
+        prepare_start = time.perf_counter_ns()
+        prepare_response = await self.prepare(context)
+        prepare_duration = time.perf_counter_ns() - prepare_start
+
+        logs.record(self.name, 'prepare_completed', prepare_duration)
+        if hooks:
+            emit(hooks, 'after_prepare', self, context, prepare_duration)
+
+        current_attempt = 0
+        execute_response = None
+        execute_error = None
+        execute_start = time.perf_counter_ns()
+
+        cache_key = self.cache_key(context, prepare_response) if self.cache is not None else None
+        cache_hit = False
+        if cache_key is not None:
+            cache_hit, cached_response = self._cache_get(cache_key)
+            if cache_hit:
+                execute_response = cached_response
+                logs.record(self.name, 'execute_cache_hit')
+
+        retry_policy = self.get_retry_policy()
+
+        while not cache_hit and current_attempt < retry_policy.max_attempts:
+            try:
+                attempt_start = time.perf_counter_ns()
+                if hooks:
+                    emit(hooks, 'before_execute_attempt', self, context, current_attempt + 1)
+                check_deadline(self.name)
+                execute_response = await self._execute_with_timeout(context, prepare_response)
+                attempt_duration = time.perf_counter_ns() - attempt_start
+
+                if self.logging:
+                    print(f"Execute response attempt {current_attempt}: {execute_response}")
+
+                logs.record(self.name, 'execute_attempt_success', attempt_duration, attempt=current_attempt + 1)
+                if hooks:
+                    emit(hooks, 'after_execute_attempt', self, context, current_attempt + 1, attempt_duration, None)
+
+                execute_error = None
+                break
+            except Exception as e:
+                execute_error = e
+                current_attempt += 1
+
+                logs.record(self.name, 'execute_attempt_failed', attempt=current_attempt, error=str(e))
+                if hooks:
+                    emit(hooks, 'after_execute_attempt', self, context, current_attempt, time.perf_counter_ns() - attempt_start, e)
+
+                delay = retry_policy.next_delay(current_attempt, e, (time.perf_counter_ns() - execute_start) / 1e9)
+                if delay is None:
+                    break
+                # non blocking sleep. other chains keep running while we wait
+                await asyncio.sleep(delay)
+
+        if cache_key is not None and not cache_hit and not execute_error:
+            self._cache_set(cache_key, execute_response)
+
+        if execute_error:
+            if hooks:
+                emit(hooks, 'before_fallback', self, context, execute_error)
+            fallback_start = time.perf_counter_ns()
+            execute_response = await self.execute_fallback(context, prepare_response, execute_error)
+            fallback_duration = time.perf_counter_ns() - fallback_start
+
+            if self.logging:
+                print(f"Execute fallback response: {execute_response}")
+
+            logs.record(self.name, 'execute_fallback', fallback_duration)
+            if hooks:
+                emit(hooks, 'after_fallback', self, context, fallback_duration)
+
+        execute_duration = time.perf_counter_ns() - execute_start
+
+        if hooks:
+            emit(hooks, 'before_post_process', self, context)
+        post_process_start = time.perf_counter_ns()
+        post_process_response = await self.post_process(context, prepare_response, execute_response)
+        post_process_duration = time.perf_counter_ns() - post_process_start
+
+        if self.logging:
+            print(f"Post process response: {post_process_response}")
+
+        logs.record(self.name, 'post_process_completed', post_process_duration)
+        if hooks:
+            emit(hooks, 'after_post_process', self, context, post_process_duration)
+
+        block_duration = time.perf_counter_ns() - block_start
+
+        self._record_timing(context, block_duration, prepare_duration, execute_duration, post_process_duration, cache_key, cache_hit)
+
+        logs.record(self.name, 'block_completed', block_duration)
+
+        return post_process_response
+
+
+class AsyncChain(AsyncBlock):
+    """
+    Async version of Chain. Async blocks are awaited directly, plain (sync) blocks are pushed to a worker thread.
+    Blocks are shared between runs, so keep per-run state in the context and not on the block.
+    Checkpointing and deadlines work the same way as for Chain.
+    """
+
+    def __init__(self, name: str = None, description: str = None, starting_block: Block = None, checkpoint_store: CheckpointStore = None, checkpoint_key: str = None, deadline: float = None, hooks: list[Hook] = None):
+        super().__init__(name=name, description=description, retries=1, retry_delay=0, hooks=hooks)
+        self.starting_block = starting_block
+        self.checkpoint_store = checkpoint_store
+        self.checkpoint_key = checkpoint_key
+        # seconds the whole run may take. stored as an absolute time in context['deadline']
+        self.deadline = deadline
+
+    def start(self, start: Block):
+        self.starting_block = start
+        return start
+
+    async def execute(self, context, prepare_response):
+        chain_start_time = time.perf_counter_ns()
+
+        if 'chain_timing' not in context:
+            context['chain_timing'] = {
+                'start_time': datetime.utcnow().isoformat(),
+                'blocks_executed': []
+            }
+
+        deadline = resolve_deadline(context, self.deadline)
+        current_block, block_count = _resume_from_checkpoint(self, context)
+        _set_deadline(context, deadline)
+        action = None
+
+        with deadline_scope(deadline), hook_scope(self.hooks):
+            while True:
+                block_name = current_block.name or f"Block_{block_count}"
+                context['chain_timing']['blocks_executed'].append(block_name)
+
+                if isinstance(current_block, AsyncBlock):
+                    action = await current_block.run(context)
+                else:
+                    # to_thread copies the contextvars, so the deadline follows the block into the thread
+                    action = await asyncio.to_thread(current_block.run, context)
+                if action is None:
+                    action = "default"
+                next_block = current_block.get_next_block(action)
+                _save_checkpoint(self, context, next_block, block_count + 1)
+                if next_block is None:
+                    break
+                current_block = next_block
+                block_count += 1
+
+        chain_duration = time.perf_counter_ns() - chain_start_time
+        context['chain_timing']['total_duration_ms'] = round(chain_duration / 1e6, 2)
+        context['chain_timing']['end_time'] = datetime.utcnow().isoformat()
+
+        context['logs'].record('Chain', 'chain_completed', chain_duration, blocks_executed=block_count + 1)
+
+        return action
+
+
+async def run_chains(chain: AsyncBlock, contexts: list[dict], max_concurrency: int = 100):
+    """
+    Drive many runs of the same chain concurrently on one event loop.
+    max_concurrency bounds how many runs are in flight at once. Returns the contexts in the same order.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_one(context):
+        async with semaphore:
+            await chain.run(context)
+            return context
+
+    return await asyncio.gather(*(run_one(context) for context in contexts))
+
+
+# context keys that are owned by the framework and merged separately when branches fan back in
+FRAMEWORK_CONTEXT_KEYS = ('logs', 'timing', 'chain_timing', 'branch_outputs')
+
+def _branch_context(context):
+    # shallow copy so branches don't step on each other's keys. logs/timing are collected per branch and merged after
+    branch_context = {key: value for key, value in context.items() if key not in FRAMEWORK_CONTEXT_KEYS}
+    branch_context['logs'] = EventLog(level=context.get('log_level'))
+    branch_context['timing'] = {}
+    return branch_context
+
+def _merge_branches(context, branch_names, branch_results):
+    """
+    Fan-in. Every key a branch added or replaced is copied back into the context (later branches win on conflicts)
+    and the per branch outputs are kept under context['branch_outputs'][branch_name] for the join block.
+    """
+    if 'timing' not in context:
+        context['timing'] = {}
+    if not isinstance(context.get('logs'), EventLog):
+        context['logs'] = EventLog(level=context.get('log_level'), records=context.get('logs'))
+    context['branch_outputs'] = {}
+
+    for branch_name, (action, branch_context) in zip(branch_names, branch_results):
+        outputs = {
+            key: value for key, value in branch_context.items()
+            if key not in FRAMEWORK_CONTEXT_KEYS and (key not in context or context[key] is not value)
+        }
+        context['branch_outputs'][branch_name] = {
+            'action': action,
+            'outputs': outputs
+        }
+        context['logs'].extend(branch_context['logs'])
+        context['timing'].update(branch_context['timing'])
+
+    for branch_name in branch_names:
+        context.update(context['branch_outputs'][branch_name]['outputs'])
+
+
+class Parallel(Block):
+    """
+    Fan-out / fan-in block. Runs all branches concurrently in a thread pool and merges their outputs back into the
+    context. Latency is that of the slowest branch instead of the sum of all of them.
+    """
+
+    def __init__(self, name: str = None, description: str = None, branches: list[Block] = None, max_workers: int = None, retries: int = 1, retry_delay: int = 0, logging: bool = False):
+        super().__init__(name=name, description=description, retries=retries, retry_delay=retry_delay, logging=logging)
+        self.branches = branches or []
+        self.max_workers = max_workers
+
+    def branch_names(self):
+        return [branch.name or f"branch_{index}" for index, branch in enumerate(self.branches)]
+
+    def _run_branch(self, branch, branch_context):
+        if isinstance(branch, AsyncBlock):
+            action = run_async_block(branch, branch_context)
+        else:
+            action = branch.run(branch_context)
+        return action, branch_context
+
+    def execute(self, context, prepare_response):
+        if not self.branches:
+            return []
+
+        with ThreadPoolExecutor(max_workers=self.max_workers or len(self.branches)) as executor:
+            # copy_context so anything kept in contextvars (deadlines, tracing etc) follows the branch into its thread
+            futures = [
+                executor.submit(contextvars.copy_context().run, self._run_branch, branch, _branch_context(context))
+                for branch in self.branches
+            ]
+            # results are collected in branch order, not completion order
+            return [future.result() for future in futures]
+
+    def post_process(self, context, prepare_response, execute_response):
+        _merge_branches(context, self.branch_names(), execute_response)
+        if 'chain_timing' in context:
+            context['chain_timing']['blocks_executed'].extend(self.branch_names())
+        return "default"
+
+
+class AsyncParallel(AsyncBlock):
+    """
+    Async version of Parallel. Async branches share the event loop, sync branches are run in worker threads.
+    """
+
+    def __init__(self, name: str = None, description: str = None, branches: list[Block] = None, retries: int = 1, retry_delay: int = 0, logging: bool = False):
+        super().__init__(name=name, description=description, retries=retries, retry_delay=retry_delay, logging=logging)
+        self.branches = branches or []
+
+    def branch_names(self):
+        return [branch.name or f"branch_{index}" for index, branch in enumerate(self.branches)]
+
+    async def _run_branch(self, branch, branch_context):
+        if isinstance(branch, AsyncBlock):
+            action = await branch.run(branch_context)
+        else:
+            action = await asyncio.to_thread(branch.run, branch_context)
+        return action, branch_context
+
+    async def execute(self, context, prepare_response):
+        return await asyncio.gather(*(self._run_branch(branch, _branch_context(context)) for branch in self.branches))
+
+    async def post_process(self, context, prepare_response, execute_response):
+        _merge_branches(context, self.branch_names(), execute_response)
+        if 'chain_timing' in context:
+            context['chain_timing']['blocks_executed'].extend(self.branch_names())
+        return "default"
+
+
+# only the interesting item events are copied into the parent logs, otherwise a 50 item map adds 250 log entries
+MAP_ITEM_LOG_EVENTS = ('execute_attempt_failed', 'execute_fallback')
+
+class MapBlock(Block):
+    """
+    Runs item_block for every element of context[items_key] with at most max_concurrency items in flight.
+    execute returns the item results in input order. Unless post_process is overridden they are stored in
+    context[output_key].
+    """
+
+    def __init__(self, name: str = None, description: str = None, item_block: Block = None, items_key: str = None, output_key: str = None, max_concurrency: int = 4, retries: int = 1, retry_delay: int = 0, logging: bool = False):
+        super().__init__(name=name, description=description, retries=retries, retry_delay=retry_delay, logging=logging)
+        self.item_block = item_block
+        self.items_key = items_key
+        self.output_key = output_key
+        self.max_concurrency = max_concurrency
+
+    def prepare(self, context):
+        return list(context.get(self.items_key) or [])
+
+    def _run_item(self, context, index, item):
+        item_context = {'item': item, 'index': index, 'parent': context, 'logs': EventLog(level=context.get('log_level')), 'timing': {}}
+        if isinstance(self.item_block, AsyncBlock):
+            run_async_block(self.item_block, item_context)
+        else:
+            self.item_block.run(item_context)
+        return item_context
+
+    def execute(self, context, prepare_response):
+        items = prepare_response
+        if not items:
+            return []
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_concurrency, len(items)))) as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, self._run_item, context, index, item)
+                for index, item in enumerate(items)
+            ]
+            item_contexts = [future.result() for future in futures]
+
+        for item_context in item_contexts:
+            context['logs'].extend(item_context['logs'], events=MAP_ITEM_LOG_EVENTS)
+
+        return [item_context.get('result') for item_context in item_contexts]
+
+    def post_process(self, context, prepare_response, execute_response):
+        if self.output_key:
+            context[self.output_key] = execute_response
+        return "default"
@@ -64,6 +64,60 @@ def download_file(file_name: str, bucket_name: str = DEFAULT_BUCKET):
         print(f"Error downloading file: {e}")
         raise
 
+class _IterReader:
+    # file like view of an iterator of bytes blocks, what put_object reads from
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.pending = bytearray()
+
+    def read(self, size: int = -1):
+        while size < 0 or len(self.pending) < size:
+            block = next(self.blocks, None)
+            if block is None:
+                break
+            self.pending += block
+        if size < 0:
+            size = len(self.pending)
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+def upload_stream(blocks, file_name: str, bucket_name: str = DEFAULT_BUCKET, content_type: str = "application/octet-stream", part_size: int = 10 * 1024 * 1024):
+    """Upload an iterator of bytes blocks of unknown total size to MinIO, one part at a time"""
+    ensure_bucket_exists(bucket_name)
+
+    try:
+        result = minio_client.put_object(
+            bucket_name,
+            file_name,
+            _IterReader(blocks),
+            length=-1,
+            part_size=part_size,
+            content_type=content_type
+        )
+        return {
+            "bucket": bucket_name,
+            "object_name": file_name,
+            "etag": result.etag,
+            "version_id": result.version_id
+        }
+    except S3Error as e:
+        print(f"Error uploading file: {e}")
+        raise
+
+def stream_file(file_name: str, bucket_name: str = DEFAULT_BUCKET, chunk_size: int = 64 * 1024):
+    """Yield the bytes of a file in MinIO as they download"""
+    try:
+        response = minio_client.get_object(bucket_name, file_name)
+    except S3Error as e:
+        print(f"Error downloading file: {e}")
+        raise
+    try:
+        yield from response.stream(chunk_size)
+    finally:
+        response.close()
+        response.release_conn()
+
 def delete_file(file_name: str, bucket_name: str = DEFAULT_BUCKET):
     """Delete a file from MinIO"""
     try:
@@ -8,7 +8,7 @@ from apps.grounded_gpt import Search, Draft, Main
 from main import Chain
 from pydantic import BaseModel
 from database import get_db, qdrant_client, task_queue, create_tables, create_qdrant_chunks_collection, github_queue, rag_queue, eval_queue
-from tasks import long_running_task, process_translation_batch, process_vector_embedding, generate_file_jobs_for_repo, generate_rag_response
+from tasks import long_running_task, process_translation_batch, process_vector_embedding, generate_file_jobs_for_repo, resync_repo, generate_rag_response
 from s3_utils import upload_file, download_file, delete_file, list_files, get_file_info
 from fastapi import UploadFile, File, HTTPException
 from fastapi.responses import StreamingResponse
@@ -16,6 +16,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from io import BytesIO
 from apps.github_rag import ingest_repo, get_repo_files, get_file_details, create_rag_request, get_rag_request_status, create_qa_batch, get_qa_batches, get_qa_pairs
 from apps.eval_api import create_eval_job, get_eval_jobs, get_eval_metrics, get_eval_overall_metrics
+from utils.metrics import registry as llm_metrics_registry
 
 # This is a qucik api server to test the chain reaction apps
 app = FastAPI()
@@ -46,6 +47,13 @@ async def startup_event():
 def read_root():
     return {"message": "Hello, World!", "status": "ok"}
 
+@app.get("/metrics/llm")
+def llm_metrics():
+    # token usage, latency and estimated cost per provider / model (utils/metrics.py). summed over all workers when
+    # they run with METRICS_REDIS=1, otherwise only the calls made by this process
+    source = "redis" if llm_metrics_registry.use_redis else "local"
+    return {"metrics": llm_metrics_registry.snapshot(source=source), "source": source, "success": "ok"}
+
 @app.get("/health")
 def health_check(db: Session = Depends(get_db)):
     health_status = {
@@ -207,7 +215,9 @@ class GithubRAGRequest(BaseModel):
 def run_github_rag(request: GithubRAGRequest):
     repo_id, job_creation_info = ingest_repo(request.repo_url)
     if job_creation_info:
-        github_queue.enqueue(generate_file_jobs_for_repo, repo_id, job_id=job_creation_info["job_id"])
+        # a repo seen before is re-synced instead of ingested from scratch
+        job = resync_repo if job_creation_info.get("resync") else generate_file_jobs_for_repo
+        github_queue.enqueue(job, repo_id, job_id=job_creation_info["job_id"])
     return {"message": "Repo ingested successfully", "repo_id": repo_id, "job_creation_info": job_creation_info, "success": "ok"}
 
 class GithubRAGFilesRequest(BaseModel):
@@ -1,17 +1,26 @@
 import time
 from database import task_queue, github_queue, rag_queue, qa_queue, eval_queue, gold_qa_batch_table, gold_qa_table, eval_job_table, eval_metrics_table
 from rq.decorators import job
-from utils.github import get_repo_files, get_repo_file_raw
-from database import repo_table, file_table, engine, insert_chunks, rag_requests_table
+from utils.github import get_repo_files, get_repo_file_raw, stream_repo_file_raw, git_blob_sha, FileTooLarge
+from database import repo_table, file_table, engine, insert_chunks, rag_requests_table, chunk_point_id, get_chunk_point_ids, delete_chunk_points
 from sqlalchemy.orm import Session
 from sqlalchemy import select, func, insert, update
-from utils.llm import Mistral, Gemini
-from utils.chunking import contextual_chunking
+from utils.llm import Mistral, Gemini, CachedLLM
+from utils.chunking import contextual_chunking, chunk_many, stream_chunking, chunk_hash
+from s3_utils import upload_stream, stream_file, get_file_info
+from utils.events import serialize_logs
 from apps.github_rag import work_on_rag_request
 import os
+import itertools
 
 mistral = Mistral(api_key=os.getenv("MISTRAL_API_KEY"))
-gemini = Gemini(api_key=os.getenv("GEMINI_API_KEY"))
+# cached, so re-ingesting a repo only embeds the chunks that changed
+gemini = CachedLLM(Gemini(api_key=os.getenv("GEMINI_API_KEY")))
+
+# seconds between partial answer writes while a RAG answer streams
+STREAM_WRITE_INTERVAL = float(os.getenv("RAG_STREAM_WRITE_INTERVAL", "0.5"))
+# chunks of a streamed (large) file embedded and stored at a time
+STREAM_CHUNK_BATCH = 100
 
 @job('default', connection=task_queue.connection, timeout='10m')
 def long_running_task(task_name: str, duration: int = 5):
@@ -98,7 +107,7 @@ def generate_file_summary_and_chunks(file_id: str):
             raise ValueError(f"Repo with id {file.repo_id} not found")
 
         # get the raw content of the file using github utils if it doesn't exist
-        if not file.raw_content:
+        if not file.raw_content and not large_file_stored(file_id):
             try:
                 raw_content = get_repo_file_raw(repo.name, repo.owner, file.path, repo.branch)
                 # Update the file with raw content
@@ -106,27 +115,28 @@ def generate_file_summary_and_chunks(file_id: str):
                 session.execute(stmt)
                 session.commit()
             except ValueError as e:
-                # Skip directories or files without content
-                print(f"Skipping file {file.path}: {str(e)}")
-                # Mark as processed but with no content
-                stmt = file_table.update().where(file_table.c.id == file_id).values(
-                    summary_status="skipped",
-                    chunks_status="skipped"
-                )
-                session.execute(stmt)
-                session.commit()
-                return
+                # files over 1MB are kept out of postgres: streamed into minio and chunked from there
+                if isinstance(e, FileTooLarge) and store_large_file(repo, file.path, file_id):
+                    print(f"Stored large file {file.path} in object storage")
+                else:
+                    # Skip directories or files without content
+                    print(f"Skipping file {file.path}: {str(e)}")
+                    # Mark as processed but with no content
+                    stmt = file_table.update().where(file_table.c.id == file_id).values(
+                        summary_status="skipped",
+                        chunks_status="skipped"
+                    )
+                    session.execute(stmt)
+                    session.commit()
+                    return
         
         # check if summary exists for the file. If it does, schedule a new job to generate the chunks
         # if it doesn't generate the summary and schedule a new job to generate the chunks
-        chunk_job_id = f"file-chunks-{file_id}"
-        chunk_job_exists = github_queue.fetch_job(chunk_job_id)
         if file.summary_status == "processed":
             if file.chunks_status == "processed":
                 return
             else:
-                if not chunk_job_exists:
-                    github_queue.enqueue(generate_file_chunks, file_id=file_id, job_id=chunk_job_id)
+                enqueue_chunks(file.repo_id, file_id)
         else:
             print(f"Generating summary for file {file.path}")
             # COMMENTING OUT MISTRAL BECAUSE OF RATE LIMITS
@@ -146,11 +156,184 @@ def generate_file_summary_and_chunks(file_id: str):
             if file.chunks_status == "processed":
                 return
             else:
-                if not chunk_job_exists:
-                    print(f"Enqueuing chunks job for file {file.path}")
-                    github_queue.enqueue(generate_file_chunks, file_id=file_id, job_id=chunk_job_id)
+                enqueue_chunks(file.repo_id, file_id)
+
+
+def enqueue_chunks(repo_id: str, file_id: str):
+    # files are chunked in bulk, one job per repo (generate_repo_chunks) takes every summarised file at once and spreads
+    # them over all cores. A file whose summary finishes while that job is already running gets a job of its own
+    repo_job_id = f"repo-chunks-{repo_id}"
+    repo_job = github_queue.fetch_job(repo_job_id)
+    status = repo_job.get_status() if repo_job else None
+    if status in ("queued", "deferred", "scheduled"):
+        return
+    if status == "started":
+        chunk_job_id = f"file-chunks-{file_id}"
+        if not github_queue.fetch_job(chunk_job_id):
+            print(f"Enqueuing chunks job for file {file_id}")
+            github_queue.enqueue(generate_file_chunks, file_id=file_id, job_id=chunk_job_id)
+        return
+    print(f"Enqueuing chunks job for repo {repo_id}")
+    github_queue.enqueue(generate_repo_chunks, repo_id=str(repo_id), job_id=repo_job_id)
+
+
+def claim_files_for_chunking(session, *conditions):
+    # pending -> processing, so a file is chunked (and its points inserted) by one job only. returns the claimed files
+    stmt = (
+        update(file_table)
+        .where(file_table.c.chunks_status.in_(["pending", "failed"]), file_table.c.summary_status == "processed", *conditions)
+        .values(chunks_status="processing")
+        .returning(file_table.c.id, file_table.c.path)
+    )
+    files = session.execute(stmt).fetchall()
+    session.commit()
+    return files
+
+
+class FileChunks:
+    """
+    Writes a file's chunks to qdrant next to the ones it already has. A chunk's point id comes from the file and the
+    chunk's content hash, so chunks that already have a point are not embedded again, and points of chunks the file no
+    longer has are deleted by finish(). Re-chunking a changed file only pays embeddings for the chunks that changed
+    """
+    def __init__(self, repo_id: str, file_id: str, file_path: str, summary: str = None):
+        self.repo_id = repo_id
+        self.file_id = file_id
+        self.file_path = file_path
+        self.summary = summary
+        self.existing = set(get_chunk_point_ids(file_id))
+        self.kept = set()
+        # content hash -> times seen, identical chunks within a file get a point each
+        self.occurrences = {}
+        self.embedded = 0
+
+    def add(self, chunk_texts: list[str]):
+        new_texts, point_ids, hashes = [], [], []
+        for chunk_text in chunk_texts:
+            content_hash = chunk_hash(chunk_text, self.summary)
+            occurrence = self.occurrences.get(content_hash, 0)
+            self.occurrences[content_hash] = occurrence + 1
+            point_id = chunk_point_id(self.file_id, content_hash, occurrence)
+            self.kept.add(point_id)
+            if point_id not in self.existing:
+                new_texts.append(chunk_text)
+                point_ids.append(point_id)
+                hashes.append(content_hash)
+
+        if new_texts:
+            # chunk_embeddings = mistral.generate_embeddings_batch(new_texts, "codestral-embed")
+            # one request per batch of chunks (up to 100) instead of one per chunk
+            chunk_embeddings = gemini.generate_embeddings_batch(new_texts, "gemini-embedding-001")
+
+            # insert chunks into the db
+            insert_chunks(self.repo_id, self.file_id, self.file_path, list(zip(new_texts, chunk_embeddings)), point_ids=point_ids, chunk_hashes=hashes)
+            self.embedded += len(new_texts)
+
+    def finish(self):
+        stale = self.existing - self.kept
+        delete_chunk_points(stale)
+        print(f"Chunks of {self.file_path}: {self.embedded} embedded, {len(self.kept) - self.embedded} unchanged, {len(stale)} deleted")
+
+
+def mark_chunked(session, file_id: str):
+    # Update the file chunks status
+    stmt = file_table.update().where(file_table.c.id == file_id).values(chunks_status="processed")
+    session.execute(stmt)
+    session.commit()
+
+
+def store_file_chunks(session, repo_id: str, file_id: str, file_path: str, chunk_texts: list[str], summary: str = None):
+    chunks = FileChunks(repo_id, file_id, file_path, summary)
+    chunks.add(chunk_texts)
+    chunks.finish()
+    mark_chunked(session, file_id)
+
+
+def raw_object_name(file_id: str):
+    # where a file too large for files.raw_content is kept in minio
+    return f"repo-files/{file_id}"
+
+
+def large_file_stored(file_id: str):
+    # raw_content stays null for files kept in minio, the object is what says the content is already there
+    try:
+        get_file_info(raw_object_name(file_id))
+        return True
+    except Exception:
+        return False
+
+
+def store_large_file(repo, file_path: str, file_id: str):
+    """
+    Streams a file too large for files.raw_content from github into minio. False for binary files
+    """
+    blocks = stream_repo_file_raw(repo.name, repo.owner, file_path, repo.branch)
+    first = next(blocks, b"")
+    # like git: a NUL byte near the start means binary, nothing to chunk
+    if b"\0" in first[:8000]:
+        blocks.close()
+        return False
+    upload_stream(itertools.chain([first], blocks), raw_object_name(file_id), content_type="text/plain")
+    return True
+
+
+def store_streamed_file_chunks(session, repo_id: str, file_id: str, file_path: str, summary: str):
+    # chunked as it downloads from minio, embedded and stored a batch at a time: memory stays flat for any file size
+    chunks = FileChunks(repo_id, file_id, file_path, summary)
+    batch = []
+    for chunk_text in stream_chunking(stream_file(raw_object_name(file_id)), 1000, "o200k_base", strategy="auto", path=file_path, summary=summary):
+        batch.append(chunk_text)
+        if len(batch) == STREAM_CHUNK_BATCH:
+            chunks.add(batch)
+            batch = []
+    chunks.add(batch)
+    chunks.finish()
+    mark_chunked(session, file_id)
+
+
+@job("github", connection=github_queue.connection, timeout="2h")
+def generate_repo_chunks(repo_id: str):
+    # chunk every summarised file of the repo that isn't chunked yet, on all cores (chunk_many), then embed and store
+    # them file by file as their chunks come back
+    with Session(engine) as session:
+        files = claim_files_for_chunking(session, file_table.c.repo_id == repo_id)
+        paths = {file.id: file.path for file in files}
+        summaries = {}
+        # files kept in minio (no raw_content), chunked one by one as they stream in after the rest
+        large_files = []
+        print(f"Chunking {len(files)} files for repo {repo_id}")
+
+        def documents():
+            # contents are read in pages while the pool works, not all at once
+            file_ids = list(paths)
+            for i in range(0, len(file_ids), 100):
+                stmt = select(file_table.c.id, file_table.c.path, file_table.c.raw_content, file_table.c.summary).where(file_table.c.id.in_(file_ids[i:i + 100]))
+                for file in session.execute(stmt).fetchall():
+                    summaries[file.id] = file.summary
+                    if file.raw_content is None:
+                        large_files.append((file.id, file.summary))
+                        continue
+                    yield {"id": file.id, "text": file.raw_content, "path": file.path, "summary": file.summary}
+
+        done = set()
+        try:
+            for file_id, chunk_texts in chunk_many(documents(), strategy="auto", max_chunk_size=1000, model="o200k_base"):
+                if chunk_texts is None:
+                    session.execute(file_table.update().where(file_table.c.id == file_id).values(chunks_status="failed"))
+                    session.commit()
                 else:
-                    print(f"Chunks job already exists for file {file.path}")
+                    store_file_chunks(session, repo_id, file_id, paths[file_id], chunk_texts, summaries[file_id])
+                done.add(file_id)
+            for file_id, summary in large_files:
+                store_streamed_file_chunks(session, repo_id, file_id, paths[file_id], summary)
+                done.add(file_id)
+        finally:
+            # files not reached (errors, job killed by its timeout) go back to pending for the next job
+            left = [file_id for file_id in paths if file_id not in done]
+            if left:
+                session.rollback()
+                session.execute(file_table.update().where(file_table.c.id.in_(left), file_table.c.chunks_status == "processing").values(chunks_status="pending"))
+                session.commit()
 
 @job("github", connection=github_queue.connection)
 def generate_file_chunks(file_id: str):
@@ -160,23 +343,123 @@ def generate_file_chunks(file_id: str):
         file = session.execute(stmt).fetchone()
         if not file:
             raise ValueError(f"File with id {file_id} not found")
-        
+
+        if not claim_files_for_chunking(session, file_table.c.id == file_id):
+            print(f"File {file.path} is already chunked or being chunked")
+            return
+
         raw_content = file.raw_content
         summary = file.summary
 
-        # generate chunks
-        chunk_texts = contextual_chunking(raw_content, 1000, "o200k_base", summary)
-        # chunk_embeddings = [mistral.generate_embeddings(text, "codestral-embed") for text in chunk_texts]
-        chunk_embeddings = [gemini.generate_embeddings(text, "gemini-embedding-001") for text in chunk_texts]
+        try:
+            if raw_content is None:
+                store_streamed_file_chunks(session, file.repo_id, file_id, file.path, summary)
+                return
+            # generate chunks
+            # source files are cut between definitions, docs and everything else between paragraphs
+            chunk_texts = contextual_chunking(raw_content, 1000, "o200k_base", summary, strategy="auto", path=file.path)
+            store_file_chunks(session, file.repo_id, file_id, file.path, chunk_texts, summary)
+        except Exception:
+            session.rollback()
+            session.execute(file_table.update().where(file_table.c.id == file_id).values(chunks_status="pending"))
+            session.commit()
+            raise
 
-        # insert chunks into the db
-        insert_chunks(file.repo_id, file_id, file.path, list(zip(chunk_texts, chunk_embeddings)))
-        # Update the file chunks status
-        stmt = file_table.update().where(file_table.c.id == file_id).values(chunks_status="processed")
-        session.execute(stmt)
+
+def stored_blob_sha(file):
+    # git blob sha of the content we have for a file, None if there is none
+    if file.raw_content is not None:
+        data = file.raw_content.encode("utf-8")
+        return git_blob_sha([data], len(data))
+    try:
+        size = get_file_info(raw_object_name(file.id))["size"]
+    except Exception:
+        return None
+    return git_blob_sha(stream_file(raw_object_name(file.id)), size)
+
+
+def resync_file(session, repo, file_id: str, file_path: str, summary: str):
+    # download a changed file again and bring its chunks up to date. the summary is kept, it is written from the path
+    claimed = session.execute(
+        update(file_table)
+        .where(file_table.c.id == file_id, file_table.c.chunks_status.in_(["processed", "removed"]))
+        .values(chunks_status="processing")
+        .returning(file_table.c.id)
+    ).fetchall()
+    session.commit()
+    if not claimed:
+        return
+
+    try:
+        try:
+            raw_content = get_repo_file_raw(repo.name, repo.owner, file_path, repo.branch)
+        except ValueError as e:
+            if not (isinstance(e, FileTooLarge) and store_large_file(repo, file_path, file_id)):
+                # binary now, or not a file any more: nothing to search in
+                print(f"Skipping file {file_path}: {str(e)}")
+                delete_chunk_points(get_chunk_point_ids(file_id))
+                session.execute(file_table.update().where(file_table.c.id == file_id).values(raw_content=None, chunks_status="skipped"))
+                session.commit()
+                return
+            raw_content = None
+
+        session.execute(file_table.update().where(file_table.c.id == file_id).values(raw_content=raw_content))
+        session.commit()
+        if raw_content is None:
+            store_streamed_file_chunks(session, repo.id, file_id, file_path, summary)
+        else:
+            chunk_texts = contextual_chunking(raw_content, 1000, "o200k_base", summary, strategy="auto", path=file_path)
+            store_file_chunks(session, repo.id, file_id, file_path, chunk_texts, summary)
+    except Exception as e:
+        print(f"Resync failed for file {file_path}: {e}")
+        session.rollback()
+        session.execute(file_table.update().where(file_table.c.id == file_id).values(chunks_status="failed"))
         session.commit()
 
 
+@job("github", connection=github_queue.connection, timeout="2h")
+def resync_repo(repo_id: str):
+    # bring an ingested repo up to date with its branch. The stored files are compared with the tree's blob shas:
+    # changed files are downloaded again and re-chunked (only chunks with new content get embedded, see FileChunks),
+    # removed files lose their points, and new files go through the usual summary / chunk jobs
+    with Session(engine) as session:
+        stmt = select(repo_table).where(repo_table.c.id == repo_id)
+        repo = session.execute(stmt).fetchone()
+        if not repo:
+            raise ValueError(f"Repo with id {repo_id} not found")
+
+        remote = {item["path"]: item["sha"] for item in get_repo_files(repo.name, repo.owner, repo.branch) if item.get("type") == "blob"}
+        files = session.execute(
+            select(file_table.c.id, file_table.c.path, file_table.c.chunks_status).where(file_table.c.repo_id == repo_id)
+        ).fetchall()
+
+        removed = [file for file in files if file.path not in remote and file.chunks_status != "removed"]
+        for file in removed:
+            delete_chunk_points(get_chunk_point_ids(file.id))
+            # the row stays, gold QA pairs may point at it
+            session.execute(file_table.update().where(file_table.c.id == file.id).values(chunks_status="removed"))
+            session.commit()
+
+        # files still being ingested (pending / processing) are left to their jobs
+        candidates = [file.id for file in files if file.path in remote and file.chunks_status in ("processed", "removed")]
+        changed = []
+        for i in range(0, len(candidates), 100):
+            stmt = select(file_table.c.id, file_table.c.path, file_table.c.raw_content, file_table.c.summary, file_table.c.chunks_status).where(file_table.c.id.in_(candidates[i:i + 100]))
+            for file in session.execute(stmt).fetchall():
+                # a removed file that came back has no points, whatever its content
+                if file.chunks_status == "removed" or stored_blob_sha(file) != remote[file.path]:
+                    changed.append((file.id, file.path, file.summary))
+
+        known_paths = {file.path for file in files}
+        new_paths = [path for path in remote if path not in known_paths]
+        print(f"Resync of repo {repo_id}: {len(changed)} changed, {len(removed)} removed, {len(new_paths)} new")
+        for file_id, file_path, summary in changed:
+            resync_file(session, repo, file_id, file_path, summary)
+
+    if new_paths:
+        github_queue.enqueue(generate_file_jobs_for_repo, repo_id)
+
+
 @job("rag", connection=rag_queue.connection)
 def generate_rag_response(request_id: str):
     # get the request from the db
@@ -193,17 +476,34 @@ def generate_rag_response(request_id: str):
 
         repo_id = request_details["repo_id"]
 
-        # for now, just write a response to the request as "Hello, world! This is a test response."
-        context = work_on_rag_request(messages, repo_id)
+        # write the answer as it streams in (status "streaming") so the UI shows it before it is done.
+        # at most one write every STREAM_WRITE_INTERVAL seconds, the final write below always has the whole answer
+        last_write = [0.0]
+
+        def on_token(partial_response: str):
+            now = time.time()
+            if now - last_write[0] < STREAM_WRITE_INTERVAL:
+                return
+            last_write[0] = now
+            with engine.begin() as connection:
+                connection.execute(
+                    rag_requests_table.update()
+                    .where(rag_requests_table.c.id == request_id)
+                    .values(response_details={"response": partial_response, "status": "streaming"})
+                )
+
+        context = work_on_rag_request(messages, repo_id, on_token=on_token)
         
         # Extract only JSON-serializable data from the response
         response_details = {
             "response": context.get("response", ""),
             "status": context.get("status", "completed"),
             "query": context.get("text", ""),
+            "first_token_ms": context.get("first_token_ms"),
             "timing": context.get("timing", {}),
             "chain_timing": context.get("chain_timing", {}),
-            "logs": context.get("logs", [])
+            # nothing reads the rendered messages of rag logs, they would only grow the row
+            "logs": serialize_logs(context.get("logs"), messages=False)
         }
 
         # update the request with the response details
@@ -0,0 +1,5 @@
+# the modules live at the top of chain-reaction and import each other as top level modules (main, utils.*)
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
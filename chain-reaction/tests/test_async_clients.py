@@ -0,0 +1,62 @@
+# Async blocks run from sync code get an event loop per run, the http clients opened on it must not outlive it
+import pytest
+
+pytest.importorskip("httpx")
+
+from main import AsyncBlock, Chain, MapBlock, Parallel
+from utils import http
+
+URL = "http://example.com/"
+
+
+class OpenClientBlock(AsyncBlock):
+    def __init__(self, opened: list, **kwargs):
+        super().__init__(**kwargs)
+        self.opened = opened
+
+    async def execute(self, context, prepare_response):
+        self.opened.append(http.get_async_client(URL))
+        return None
+
+
+def assert_closed(opened: list):
+    assert opened
+    assert all(client.is_closed for client in opened)
+    assert len(http._async_clients) == 0
+
+
+def test_chain_closes_async_clients():
+    opened = []
+    chain = Chain(name="chain", starting_block=OpenClientBlock(opened, name="open"))
+    chain.run({})
+    assert_closed(opened)
+
+
+def test_parallel_closes_async_clients():
+    opened = []
+    parallel = Parallel(name="parallel", branches=[OpenClientBlock(opened, name="a"), OpenClientBlock(opened, name="b")])
+    parallel.run({})
+    assert len(opened) == 2
+    assert_closed(opened)
+
+
+def test_map_block_closes_async_clients():
+    opened = []
+    map_block = MapBlock(name="map", item_block=OpenClientBlock(opened, name="item"), items_key="items", output_key="out")
+    map_block.run({"items": [1, 2, 3]})
+    assert len(opened) == 3
+    assert_closed(opened)
+
+
+def test_clients_closed_when_block_fails():
+    opened = []
+
+    class FailingBlock(OpenClientBlock):
+        async def execute(self, context, prepare_response):
+            await super().execute(context, prepare_response)
+            raise ValueError("boom")
+
+    chain = Chain(name="chain", starting_block=FailingBlock(opened, name="fail"))
+    with pytest.raises(Exception):
+        chain.run({})
+    assert_closed(opened)
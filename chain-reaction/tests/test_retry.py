@@ -0,0 +1,29 @@
+# RetryPolicy.fixed keeps the behaviour Blocks had before policies: every error is retried with a constant delay
+from utils.deadline import DeadlineExceeded
+from utils.retry import RetryPolicy
+
+
+class StatusError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+def test_fixed_retries_every_status_code():
+    policy = RetryPolicy.fixed(3, 0.5)
+    for status_code in (400, 401, 404, 429, 500):
+        assert policy.is_retryable(StatusError(status_code))
+        assert policy.next_delay(1, StatusError(status_code)) == 0.5
+    assert policy.next_delay(3, StatusError(500)) is None
+
+
+def test_fixed_never_retries_deadline():
+    assert not RetryPolicy.fixed(3).is_retryable(DeadlineExceeded("late"))
+
+
+def test_default_policy_classifies_status_codes():
+    policy = RetryPolicy()
+    assert not policy.is_retryable(StatusError(400))
+    assert not policy.is_retryable(StatusError(404))
+    assert policy.is_retryable(StatusError(429))
+    assert policy.is_retryable(StatusError(503))
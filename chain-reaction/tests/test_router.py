@@ -0,0 +1,52 @@
+# Router stats are kept per model a call used, a client serving several models doesn't mix their latencies
+import time
+
+import pytest
+
+pytest.importorskip("httpx")
+
+from utils.llm import LLM, Router
+
+
+class FakeLLM(LLM):
+    def __init__(self, provider: str, latencies: dict, model: str):
+        super().__init__(api_key="key")
+        self.provider = provider
+        self.models = {name: {} for name in latencies}
+        self.model = model
+        self.latencies = latencies
+
+    def generate_text(self, messages: list[dict], model: str = None, max_tokens: int = 1000):
+        time.sleep(self.latencies[self.model_for(model)])
+        return self.model_for(model)
+
+
+def test_stats_are_kept_per_model():
+    # "mixed" is fast on flash and slow on pro, "steady" is in between for both
+    mixed = FakeLLM("test-mixed", {"flash": 0.01, "pro": 0.2}, model="flash")
+    steady = FakeLLM("test-steady", {"flash": 0.05, "pro": 0.05}, model="flash")
+    router = Router([mixed, steady])
+
+    for model in ("flash", "pro"):
+        for llm in (mixed, steady):
+            router._timed(llm, "text", lambda llm: llm.generate_text([], model), model)
+
+    assert router.stats(mixed, "text", "flash").latency < router.stats(mixed, "text", "pro").latency
+    assert router.ranked("text", "flash")[0] is mixed
+    assert router.ranked("text", "pro")[0] is steady
+    assert router.generate_text([], model="pro") == "pro"
+    assert router.stats(steady, "text", "pro").calls == 2
+    assert router.stats(mixed, "text", "pro").calls == 1
+
+
+def test_rate_limit_cools_down_only_that_model():
+    class RateLimited(Exception):
+        status_code = 429
+        retry_after = 60
+
+    llm = FakeLLM("test-cooldown", {"flash": 0.0, "pro": 0.0}, model="flash")
+    router = Router([llm])
+    router.record(llm, "text", "pro", error=RateLimited())
+
+    assert router.stats(llm, "text", "pro").cooldown_until > time.time()
+    assert router.stats(llm, "text", "flash").cooldown_until == 0.0
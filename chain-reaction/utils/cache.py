@@ -0,0 +1,220 @@
+# Small key/value caches used to skip repeated work (block results, llm responses etc)
+# All backends share the same interface:
+#   get(key) -> (hit, value)
+#   get_with_ttl(key) -> (hit, value, seconds until it expires or None)
+#   set(key, value, ttl=None)
+# Values have to be JSON serializable. They are stored serialized, so whatever comes out of the cache is a fresh
+# copy and callers can mutate it freely.
+# Backends:
+# - MemoryCache - in process LRU with TTL. Fastest, but per process
+# - RedisCache - shared by all workers. Uses the redis connection from database.py unless one is passed in
+# - SQLiteCache - on disk. Survives restarts without needing any service
+# - TieredCache - several of the above, fastest first. Hits in a slower tier are copied into the faster ones, with the
+#   time the entry has left there, so a copy never outlives the original
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def stable_hash(*parts):
+    """
+    sha256 over the JSON form of parts (dict keys sorted), so equal inputs always give the same key.
+    Raises TypeError if parts are not JSON serializable.
+    """
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Cache:
+    def __init__(self, ttl: float = None):
+        # default ttl in seconds. None = never expires
+        self.ttl = ttl
+
+    def get(self, key: str):
+        return False, None
+
+    def get_with_ttl(self, key: str):
+        # backends that can't tell how long an entry has left report the default ttl
+        hit, value = self.get(key)
+        return hit, value, self.ttl
+
+    def set(self, key: str, value, ttl: float = None):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+    def _expires_at(self, ttl: float = None):
+        ttl = ttl if ttl is not None else self.ttl
+        return time.time() + ttl if ttl is not None else None
+
+
+def _ttl_left(expires_at: float = None):
+    return expires_at - time.time() if expires_at is not None else None
+
+
+class MemoryCache(Cache):
+    def __init__(self, max_entries: int = 1024, ttl: float = None):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        hit, value, _ = self.get_with_ttl(key)
+        return hit, value
+
+    def get_with_ttl(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None, None
+            expires_at, payload = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._entries[key]
+                return False, None, None
+            self._entries.move_to_end(key)
+        return True, json.loads(payload), _ttl_left(expires_at)
+
+    def set(self, key: str, value, ttl: float = None):
+        payload = json.dumps(value)
+        with self._lock:
+            self._entries[key] = (self._expires_at(ttl), payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisCache(Cache):
+    def __init__(self, connection=None, prefix: str = "cache:", ttl: float = None):
+        super().__init__(ttl)
+        self._connection = connection
+        self.prefix = prefix
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            # imported lazily, database.py sets up postgres/qdrant/redis clients on import
+            from database import redis_conn
+            self._connection = redis_conn
+        return self._connection
+
+    def get(self, key: str):
+        payload = self.connection.get(self.prefix + key)
+        if payload is None:
+            return False, None
+        return True, json.loads(payload)
+
+    def get_with_ttl(self, key: str):
+        pipeline = self.connection.pipeline(transaction=False)
+        pipeline.get(self.prefix + key)
+        pipeline.pttl(self.prefix + key)
+        payload, ttl_ms = pipeline.execute()
+        if payload is None:
+            return False, None, None
+        # -1: no expiry
+        return True, json.loads(payload), ttl_ms / 1000 if ttl_ms >= 0 else None
+
+    def set(self, key: str, value, ttl: float = None):
+        ttl = ttl if ttl is not None else self.ttl
+        # milliseconds, ex=int(ttl) would be 0 for ttls under a second, which redis rejects
+        self.connection.set(self.prefix + key, json.dumps(value), px=max(1, int(ttl * 1000)) if ttl is not None else None)
+
+    def delete(self, key: str):
+        self.connection.delete(self.prefix + key)
+
+
+class SQLiteCache(Cache):
+    def __init__(self, path: str = None, max_entries: int = None, ttl: float = None):
+        super().__init__(ttl)
+        self.path = path or os.getenv("CACHE_SQLITE_PATH", os.path.join(".cache", "cache.sqlite3"))
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # one connection shared by all threads, access is serialized with the lock
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self._db.commit()
+
+    def get(self, key: str):
+        hit, value, _ = self.get_with_ttl(key)
+        return hit, value
+
+    def get_with_ttl(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return False, None, None
+            payload, expires_at = row
+            if expires_at is not None and expires_at < now:
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._db.commit()
+                return False, None, None
+            self._db.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        return True, json.loads(payload), _ttl_left(expires_at)
+
+    def set(self, key: str, value, ttl: float = None):
+        payload = json.dumps(value)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, payload, self._expires_at(ttl), time.time())
+            )
+            if self.max_entries is not None:
+                # evict least recently used entries above the limit
+                self._db.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            self._db.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._db.commit()
+
+
+class TieredCache(Cache):
+    def __init__(self, caches: list[Cache], ttl: float = None):
+        super().__init__(ttl)
+        self.caches = list(caches)
+
+    def get(self, key: str):
+        hit, value, _ = self.get_with_ttl(key)
+        return hit, value
+
+    def get_with_ttl(self, key: str):
+        for index, cache in enumerate(self.caches):
+            hit, value, ttl_left = cache.get_with_ttl(key)
+            if hit:
+                # copies expire with the entry they were made from
+                for faster in self.caches[:index]:
+                    faster.set(key, value, ttl_left)
+                return True, value, ttl_left
+        return False, None, None
+
+    def set(self, key: str, value, ttl: float = None):
+        ttl = ttl if ttl is not None else self.ttl
+        for cache in self.caches:
+            cache.set(key, value, ttl)
+
+    def delete(self, key: str):
+        for cache in self.caches:
+            cache.delete(key)
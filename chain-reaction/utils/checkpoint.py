@@ -0,0 +1,135 @@
+# Checkpoint stores for Chain (see Chain(checkpoint_store=..., checkpoint_key=...) in main.py)
+# After every block the chain saves {"next_block", "block_count", "context"} under the checkpoint key. If the job dies
+# and is retried with the same key, the chain restores the context and continues at next_block instead of starting over.
+# The checkpoint is deleted once the chain completes.
+# Stores:
+# - RedisCheckpointStore - default choice for RQ jobs. uses the redis connection from database.py
+# - PostgresCheckpointStore - chain_checkpoints table in database.py. survives a redis flush
+# - FileCheckpointStore - one json file per key in a local directory. handy for scripts and tests
+
+import json
+import os
+import re
+from datetime import datetime
+
+
+def serializable_context(context: dict):
+    """
+    The part of the context that can be stored as JSON. Values that can't be serialized (clients, callbacks etc) are
+    skipped and have to be rebuilt by whoever creates the context.
+    """
+    from utils.events import serialize_logs
+
+    state = {}
+    for key, value in context.items():
+        if key == 'logs':
+            state[key] = serialize_logs(value)
+            continue
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        state[key] = value
+    return state
+
+
+class CheckpointStore:
+    def load(self, key: str):
+        return None
+
+    def save(self, key: str, state: dict):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+
+class RedisCheckpointStore(CheckpointStore):
+    def __init__(self, connection=None, prefix: str = "checkpoint:", ttl: int = 24 * 3600):
+        self._connection = connection
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            from database import redis_conn
+            self._connection = redis_conn
+        return self._connection
+
+    def load(self, key: str):
+        payload = self.connection.get(self.prefix + key)
+        return json.loads(payload) if payload is not None else None
+
+    def save(self, key: str, state: dict):
+        self.connection.set(self.prefix + key, json.dumps(state), ex=self.ttl)
+
+    def delete(self, key: str):
+        self.connection.delete(self.prefix + key)
+
+
+class PostgresCheckpointStore(CheckpointStore):
+    def __init__(self, engine=None):
+        self._engine = engine
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            from database import engine
+            self._engine = engine
+        return self._engine
+
+    def load(self, key: str):
+        from sqlalchemy import select
+        from database import chain_checkpoints_table
+
+        with self.engine.connect() as conn:
+            stmt = select(chain_checkpoints_table.c.state).where(chain_checkpoints_table.c.key == key)
+            return conn.execute(stmt).scalar_one_or_none()
+
+    def save(self, key: str, state: dict):
+        from sqlalchemy.dialects.postgresql import insert
+        from database import chain_checkpoints_table
+
+        stmt = insert(chain_checkpoints_table).values(key=key, state=state, updated_at=datetime.utcnow())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[chain_checkpoints_table.c.key],
+            set_={"state": stmt.excluded.state, "updated_at": stmt.excluded.updated_at}
+        )
+        with self.engine.begin() as conn:
+            conn.execute(stmt)
+
+    def delete(self, key: str):
+        from database import chain_checkpoints_table
+
+        with self.engine.begin() as conn:
+            conn.execute(chain_checkpoints_table.delete().where(chain_checkpoints_table.c.key == key))
+
+
+class FileCheckpointStore(CheckpointStore):
+    def __init__(self, directory: str = None):
+        self.directory = directory or os.getenv("CHECKPOINT_DIR", os.path.join(".cache", "checkpoints"))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key: str):
+        return os.path.join(self.directory, re.sub(r"[^A-Za-z0-9_.-]", "_", key) + ".json")
+
+    def load(self, key: str):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, key: str, state: dict):
+        # write + rename so a crash mid write never leaves a half written checkpoint behind
+        path = self._path(key)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
@@ -1,116 +1,534 @@
-
 # Given a piece of text, max chunk size, chunk it into smaller pieces and return the chunks
 # Implement different chunking strategies
 # naive chunking - chunk based on max chunk token size
 # sentence chunking - chunk based on sentence boundaries (with fall back to naive chunking for larger sentences)
 # paragraph chunking - chunk based on paragraph boundaries (with fall back to sentence boundaries for larger paragraphs)
-# contextual chunking - if a summary is provided, then prepend this to every chunk (with paragraph chunking as the base)
+# code chunking - chunk source code at definition boundaries (python ast, indentation for other languages), packing small
+#   definitions together, with fall back to lines and tokens for larger ones
+# contextual chunking - if a summary is provided, then prepend this to every chunk (with paragraph or code chunking as the base)
+# chunk_many - any of the above for many documents at once, on a process pool
+# stream chunking - any of the above for text that arrives as a stream (large files), with bounded memory
 # LATER - if we can use LLMs, then we can ask them to give a better split of the text into contextually relevant chunks
 # LATER - skipping overlap between chunks
 
+import ast
+import codecs
+import hashlib
+import os
+import warnings
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from functools import lru_cache
+from itertools import accumulate
+
 import tiktoken
 import nltk
 nltk.download('punkt_tab')
 
+ENCODINGS = ["o200k_base", "cl100k_base", "p50k_base", "r50k_base"]
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model_or_encoding: str):
+    """
+    tiktoken encoding for an encoding name (like o200k_base, cl100k_base) or a model name. Loaded once per process
+    """
+    if model_or_encoding in ENCODINGS:
+        return tiktoken.get_encoding(model_or_encoding)
+    return tiktoken.encoding_for_model(model_or_encoding)
+
+
+@lru_cache(maxsize=None)
+def _get_sentence_tokenizer(language: str = "english"):
+    # the punkt model sent_tokenize uses, loaded once. span_tokenize gives offsets instead of copies
+    return nltk.tokenize.punkt.PunktTokenizer(language)
+
+
 def _convert_to_tokens(text: str, model_or_encoding: str):
     """
     Convert the text to tokens using the tiktoken library
     """
-    # Check if it's an encoding name (like o200k_base, cl100k_base) or a model name
-    if model_or_encoding in ["o200k_base", "cl100k_base", "p50k_base", "r50k_base"]:
-        encoding = tiktoken.get_encoding(model_or_encoding)
-    else:
-        encoding = tiktoken.encoding_for_model(model_or_encoding)
-    return encoding.encode(text)
+    return _get_encoding(model_or_encoding).encode(text, disallowed_special=())
 
 def _convert_to_text(tokens: list[int], model_or_encoding: str):
     """
     Convert the tokens to text using the tiktoken library
     """
-    # Check if it's an encoding name (like o200k_base, cl100k_base) or a model name
-    if model_or_encoding in ["o200k_base", "cl100k_base", "p50k_base", "r50k_base"]:
-        encoding = tiktoken.get_encoding(model_or_encoding)
-    else:
-        encoding = tiktoken.encoding_for_model(model_or_encoding)
-    return encoding.decode(tokens)
+    return _get_encoding(model_or_encoding).decode(tokens)
+
+
+@lru_cache(maxsize=None)
+def _token_byte_lengths(model_or_encoding: str):
+    # length in bytes of every token id, 0 for ids that are not tokens
+    encoding = _get_encoding(model_or_encoding)
+    lengths = []
+    for token in range(encoding.n_vocab):
+        try:
+            lengths.append(len(encoding.decode_single_token_bytes(token)))
+        except KeyError:
+            lengths.append(0)
+    return lengths
+
+
+# 1 for the bytes that continue a utf-8 character, 0 for the ones that start one
+_CONTINUATION_BYTES = bytes(1 if 0x80 <= byte < 0xC0 else 0 for byte in range(256))
+
+
+# The chunkers below encode the document once and keep where every token starts in the text. Token counts of any
+# slice are then two binary searches, and chunks are slices of the original string cut at paragraph, sentence or token
+# boundaries, nothing is encoded or decoded again. Counts are those of the tokens as they fall in the whole document,
+# encoding a chunk on its own can differ by a token at its edges.
+
+class TokenOffsets:
+    def __init__(self, text: str, model: str):
+        tokens = _get_encoding(model).encode(text, disallowed_special=())
+        # same offsets as encoding.decode_with_offsets, without its python loop over every token's bytes
+        self.starts = list(accumulate(map(_token_byte_lengths(model).__getitem__, tokens), initial=0))[:-1]
+        if not text.isascii():
+            # byte offsets to character offsets: minus the continuation bytes up to there
+            continuations = list(accumulate(text.encode("utf-8").translate(_CONTINUATION_BYTES)))
+            self.starts = [start - continuations[start] for start in self.starts]
+        self.text = text
+        self._line_starts = None
+
+    @property
+    def line_starts(self):
+        # offset where each line starts, line n (1-based, like ast) starts at line_starts[n - 1]
+        if self._line_starts is None:
+            self._line_starts = [0] + [i + 1 for i, char in enumerate(self.text) if char == "\n"]
+        return self._line_starts
+
+    def line_end(self, line: int):
+        # offset right after line (1-based), including its newline
+        return self.line_starts[line] if line < len(self.line_starts) else len(self.text)
+
+    def line_spans(self, start: int, end: int):
+        first = bisect_left(self.line_starts, start + 1) - 1
+        cuts = [start] + [position for position in self.line_starts[first + 1:] if position < end] + [end]
+        return [(a, b) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+    def count(self, start: int, end: int):
+        """
+        Number of tokens starting in text[start:end]
+        """
+        return bisect_left(self.starts, end) - bisect_left(self.starts, start)
+
+    def token_spans(self, start: int, end: int, max_tokens: int):
+        """
+        text[start:end] cut into pieces of max_tokens tokens
+        """
+        first, last = bisect_left(self.starts, start), bisect_left(self.starts, end)
+        cuts = [start] + [self.starts[i] for i in range(first + max_tokens, last, max(1, max_tokens))] + [end]
+        return [(a, b) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+
+def _paragraph_spans(text: str, start: int, end: int):
+    # paragraphs are separated by two newlines
+    spans = []
+    position = start
+    while position < end:
+        boundary = text.find("\n\n", position, end)
+        if boundary == -1:
+            boundary = end
+        if boundary > position:
+            spans.append((position, boundary))
+        position = boundary + 2
+    return spans
+
+
+def _sentence_spans(text: str, start: int, end: int):
+    spans = [(start + a, start + b) for a, b in _get_sentence_tokenizer().span_tokenize(text[start:end])]
+    return spans or [(start, end)]
+
+
+def _pack(offsets: TokenOffsets, spans: list, max_tokens: int, split):
+    """
+    Joins consecutive spans (with whatever separates them in the text) while they fit into max_tokens. Spans that are
+    too large on their own are cut by split(start, end), its first and last piece can still be joined with the spans
+    around it (the closing lines of a long function with the next one etc)
+    """
+    chunks = []
+    current = None
+    for start, end in spans:
+        if offsets.count(start, end) > max_tokens:
+            pieces = split(start, end)
+            if not pieces:
+                continue
+            if current is not None:
+                if offsets.count(current[0], pieces[0][1]) <= max_tokens:
+                    pieces[0] = (current[0], pieces[0][1])
+                else:
+                    chunks.append(current)
+            chunks.extend(pieces[:-1])
+            current = pieces[-1]
+            continue
+        if current is not None and offsets.count(current[0], end) > max_tokens:
+            chunks.append(current)
+            current = None
+        current = (current[0] if current is not None else start, end)
+    if current is not None:
+        chunks.append(current)
+    return chunks
+
+
+def _split_tokens(offsets: TokenOffsets, start: int, end: int, max_tokens: int):
+    return offsets.token_spans(start, end, max_tokens)
+
+
+def _split_sentences(offsets: TokenOffsets, start: int, end: int, max_tokens: int):
+    return _pack(offsets, _sentence_spans(offsets.text, start, end), max_tokens,
+                 lambda a, b: _split_tokens(offsets, a, b, max_tokens))
+
+
+def _split_paragraphs(offsets: TokenOffsets, start: int, end: int, max_tokens: int):
+    return _pack(offsets, _paragraph_spans(offsets.text, start, end), max_tokens,
+                 lambda a, b: _split_sentences(offsets, a, b, max_tokens))
+
+
+def _split_lines(offsets: TokenOffsets, start: int, end: int, max_tokens: int):
+    return _pack(offsets, offsets.line_spans(start, end), max_tokens,
+                 lambda a, b: _split_tokens(offsets, a, b, max_tokens))
+
+
+# Code is cut between definitions / statements. Every piece runs from the end of the previous one to the end of its
+# own, so comments and decorators above a definition stay with it and the chunks cover the whole file.
+
+CODE_EXTENSIONS = {
+    ".py": "python", ".pyi": "python",
+    ".js": "javascript", ".jsx": "javascript", ".mjs": "javascript", ".cjs": "javascript",
+    ".ts": "typescript", ".tsx": "typescript",
+    ".java": "java", ".kt": "kotlin", ".scala": "scala", ".go": "go", ".rs": "rust", ".swift": "swift",
+    ".c": "c", ".h": "c", ".cc": "cpp", ".cpp": "cpp", ".hpp": "cpp", ".cs": "csharp",
+    ".rb": "ruby", ".php": "php", ".lua": "lua", ".sh": "shell", ".bash": "shell",
+}
+
+# lines that continue the construct above them instead of starting a new one
+_CONTINUATION_PREFIXES = ("}", ")", "]", "else", "elif", "except", "catch", "finally", "end", "case", "default", ".", "&&", "||", "+", "?", ":")
+# lines that belong to the construct below them
+_LEADING_PREFIXES = ("#", "//", "/*", "*", "--", "@")
+
+
+def code_language(path: str = None):
+    """
+    Language of a source file by its extension, None for everything that isn't code (docs, configs, ...)
+    """
+    if not path:
+        return None
+    return CODE_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
+
+def _python_segments(offsets: TokenOffsets, start: int, end: int, nodes: list):
+    # ((start, end), node) for each statement, the last one runs to end
+    segments = []
+    position = start
+    for node in nodes:
+        node_end = min(max(offsets.line_end(node.end_lineno), position), end)
+        # blank lines after a statement stay with it, comments go with the next one
+        while node_end < end and not offsets.text[node_end:offsets.line_end(bisect_left(offsets.line_starts, node_end + 1))].strip():
+            node_end = offsets.line_end(bisect_left(offsets.line_starts, node_end + 1))
+        if node is nodes[-1]:
+            node_end = end
+        if node_end > position:
+            segments.append(((position, node_end), node))
+            position = node_end
+    if position < end:
+        segments.append(((position, end), None))
+    return segments
+
+
+def _split_python(offsets: TokenOffsets, start: int, end: int, max_tokens: int, nodes: list):
+    segments = _python_segments(offsets, start, end, nodes)
+    nodes_by_span = dict(segments)
+
+    def split(a: int, b: int):
+        body = getattr(nodes_by_span[(a, b)], "body", None)
+        # a definition / block too large for one chunk: split between its statements, its header goes with the first
+        if isinstance(body, list) and body:
+            return _split_python(offsets, a, b, max_tokens, body)
+        return _split_lines(offsets, a, b, max_tokens)
+
+    return _pack(offsets, [span for span, _ in segments], max_tokens, split)
+
+
+def _indentation(line: str):
+    return len(line) - len(line.lstrip())
+
+
+def _indented_spans(offsets: TokenOffsets, start: int, end: int):
+    """
+    Cuts text[start:end] before every line that starts a new construct at the block's outermost indentation (below its
+    first line), keeping comments / annotations with the line after them
+    """
+    lines = [(a, b, offsets.text[a:b].rstrip("\r\n")) for a, b in offsets.line_spans(start, end)]
+    inner = [line for _, _, line in lines[1:] if line.strip() and not line.strip().startswith(_CONTINUATION_PREFIXES)]
+    if not inner:
+        return [(start, end)]
+    level = min(_indentation(line) for line in inner)
+    # at the top of a file the first line is a construct like any other
+    level = min(level, _indentation(lines[0][2])) if start == 0 else level
+
+    cuts = [start]
+    previous = lines[0][2]
+    for a, _, line in lines[1:]:
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if _indentation(line) == level and not stripped.startswith(_CONTINUATION_PREFIXES) and not previous.strip().startswith(_LEADING_PREFIXES):
+            cuts.append(a)
+        previous = line
+    cuts.append(end)
+    return [(a, b) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+
+def _split_indented(offsets: TokenOffsets, start: int, end: int, max_tokens: int):
+    spans = _indented_spans(offsets, start, end)
+    if spans == [(start, end)]:
+        return _split_lines(offsets, start, end, max_tokens)
+    return _pack(offsets, spans, max_tokens, lambda a, b: _split_indented(offsets, a, b, max_tokens))
+
+
+def _split_code(offsets: TokenOffsets, start: int, end: int, max_tokens: int, path: str = None):
+    if code_language(path) == "python" and start == 0:
+        try:
+            with warnings.catch_warnings():
+                # invalid escape sequences etc in the parsed file, not ours to report
+                warnings.simplefilter("ignore")
+                nodes = ast.parse(offsets.text[:end]).body
+        except (SyntaxError, ValueError):
+            # python 2, templates, half written files
+            nodes = None
+        if nodes is not None:
+            return _split_python(offsets, start, end, max_tokens, nodes)
+    return _split_indented(offsets, start, end, max_tokens)
+
+
+STRATEGIES = {
+    "naive": _split_tokens,
+    "sentence": _split_sentences,
+    "paragraph": _split_paragraphs,
+    "code": _split_code,
+}
+
+
+def chunking_strategy(path: str = None):
+    """
+    "code" for source files, "paragraph" for everything else
+    """
+    return "code" if code_language(path) else "paragraph"
+
+
+def chunk_offsets(text: str, max_chunk_size: int, model: str, strategy: str = "paragraph", path: str = None):
+    """
+    (start, end) character offsets of the chunks of text, chunk i is text[start:end]. strategy="auto" picks one by
+    the file's path
+    """
+    if strategy == "auto":
+        strategy = chunking_strategy(path)
+    if strategy not in STRATEGIES:
+        raise Exception(f"Unknown chunking strategy: {strategy}")
+    if not text:
+        return []
+    offsets = TokenOffsets(text, model)
+    if strategy == "code":
+        return _split_code(offsets, 0, len(text), max_chunk_size, path=path)
+    return STRATEGIES[strategy](offsets, 0, len(text), max_chunk_size)
+
 
 def naive_chunking(text: str, max_chunk_size: int, model: str):
     """
     Chunk the text into smaller pieces based on the max chunk size
     """
-    tokens = _convert_to_tokens(text, model)
-
-    return [_convert_to_text(tokens[i:i+max_chunk_size], model) for i in range(0, len(tokens), max_chunk_size)]
+    return [text[start:end] for start, end in chunk_offsets(text, max_chunk_size, model, "naive")]
 
 def sentence_chunking(text: str, max_chunk_size: int, model: str):
     """
     We go through the input text sentence by sentence
     If the sentence is larger than the max chunk size, we split it into smaller chunks using naive chunking
     """
-    sentences = nltk.sent_tokenize(text)
-    chunks = []
-    current_chunk = ""
-    current_chunk_tokens = 0
-    for sentence in sentences:
-        tokens = _convert_to_tokens(sentence, model)
-        if current_chunk_tokens + len(tokens) > max_chunk_size:
-            if current_chunk_tokens > max_chunk_size:
-                chunks.extend(naive_chunking(current_chunk, max_chunk_size, model))
-            else:
-                chunks.append(current_chunk)
-            current_chunk = ""
-            current_chunk_tokens = 0
-        current_chunk += (" " if current_chunk else "") + sentence
-        current_chunk_tokens += len(tokens)
-    if current_chunk:
-        if current_chunk_tokens > max_chunk_size:
-            chunks.extend(naive_chunking(current_chunk, max_chunk_size, model))
-        else:
-            chunks.append(current_chunk)
-    return chunks
+    return [text[start:end] for start, end in chunk_offsets(text, max_chunk_size, model, "sentence")]
 
 def paragraph_chunking(text: str, max_chunk_size: int, model: str):
     """
     Define paragraph as a sequence of sentences separated by two newlines
     If the paragraph is larger than the max chunk size, we split it into smaller chunks using sentence chunking
     """
-    paragraphs = text.split('\n\n')
+    return [text[start:end] for start, end in chunk_offsets(text, max_chunk_size, model, "paragraph")]
 
-    chunks = []
-    current_chunk = ""
-    current_chunk_tokens = 0
-    for paragraph in paragraphs:
-        tokens = _convert_to_tokens(paragraph, model)
-        if current_chunk_tokens + len(tokens) > max_chunk_size:
-            if current_chunk_tokens > max_chunk_size:
-                chunks.extend(sentence_chunking(current_chunk, max_chunk_size, model))
-            else:
-                chunks.append(current_chunk)
-            current_chunk = ""
-            current_chunk_tokens = 0
-        current_chunk += ("\n\n" if current_chunk else "") + paragraph
-        current_chunk_tokens += len(tokens)
-    if current_chunk:
-        if current_chunk_tokens > max_chunk_size:
-            chunks.extend(sentence_chunking(current_chunk, max_chunk_size, model))
-        else:
-            chunks.append(current_chunk)
-    return chunks
+def code_chunking(text: str, max_chunk_size: int, model: str, path: str = None):
+    """
+    Split source code between top level definitions and pack small ones together up to the max chunk size
+    Definitions larger than that are split between their statements, then lines. Python files are parsed with ast,
+    other languages (or python that doesn't parse) are split by indentation
+    """
+    return [text[start:end] for start, end in chunk_offsets(text, max_chunk_size, model, "code", path=path)]
 
 
-def contextual_chunking(text: str, max_chunk_size: int, model: str, summary: str):
+def contextual_chunking(text: str, max_chunk_size: int, model: str, summary: str, strategy: str = "paragraph", path: str = None):
     """
-    Chunk the text into smaller pieces based on paragraph boundaries
+    Chunk the text into smaller pieces based on paragraph boundaries (or the given strategy, "auto" picks code
+    chunking for source files by their path)
     For every chunk, prepend the summary to the chunk
     """
-    summary_tokens = _convert_to_tokens(summary, model)
-    summary_tokens_length = len(summary_tokens)
+    summary_tokens_length = len(_convert_to_tokens(summary, model))
 
     if summary_tokens_length > max_chunk_size:
         # ignore the summary or raise an error. ignore for now
         summary = ""
         summary_tokens_length = 0
 
-    chunks = paragraph_chunking(text, max_chunk_size - summary_tokens_length, model)
+    chunks = [text[start:end] for start, end in chunk_offsets(text, max_chunk_size - summary_tokens_length, model, strategy, path=path)]
 
     return [summary + "\n\n" + chunk for chunk in chunks]
+
+
+def chunk_hash(chunk: str, summary: str = None):
+    """
+    sha256 of a chunk's content. The summary contextual chunking put in front of it is left out, so a new summary for
+    the file doesn't make every chunk of it new
+    """
+    if summary is not None:
+        for prefix in (summary + "\n\n", "\n\n"):
+            # "\n\n" alone when the summary was too long to prepend
+            if chunk.startswith(prefix):
+                chunk = chunk[len(prefix):]
+                break
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+
+# Streaming: stream_chunking chunks text that is never in memory as a whole (large files, logs, dumps). The stream is
+# read into a window of window_chars characters which is chunked like a document, every chunk but the last is yielded and
+# the last one is carried over to the next window, it may continue past the window's end. Memory stays at about one
+# window. Code is split by indentation here, a window of a python file usually doesn't parse on its own.
+
+def _iter_text(stream, block_size: int = 64 * 1024):
+    """
+    str blocks from a text or binary file object or an iterator of str / bytes blocks (http responses, minio objects).
+    Bytes are decoded as utf-8, strictly: binary content raises UnicodeDecodeError
+    """
+    if hasattr(stream, "read"):
+        reader = stream
+        stream = iter(lambda: reader.read(block_size), reader.read(0))
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for block in stream:
+        text = decoder.decode(block) if isinstance(block, (bytes, bytearray)) else block
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def _window_spans(offsets: TokenOffsets, max_tokens: int, strategy: str):
+    if strategy == "code":
+        return _split_indented(offsets, 0, len(offsets.text), max_tokens)
+    return STRATEGIES[strategy](offsets, 0, len(offsets.text), max_tokens)
+
+
+def stream_chunking(stream, max_chunk_size: int, model: str, strategy: str = "paragraph", path: str = None, summary: str = None, window_chars: int = 256 * 1024):
+    """
+    Chunk a text stream (file object, iterator of str / bytes blocks) and yield the chunks as they are found
+    If a summary is given, prepend it to every chunk like contextual chunking
+    """
+    if strategy == "auto":
+        strategy = chunking_strategy(path)
+    if strategy not in STRATEGIES:
+        raise Exception(f"Unknown chunking strategy: {strategy}")
+
+    prefix = ""
+    if summary is not None:
+        summary_tokens_length = len(_convert_to_tokens(summary, model))
+        if summary_tokens_length > max_chunk_size:
+            # ignore the summary, same as contextual_chunking
+            summary, summary_tokens_length = "", 0
+        prefix = summary + "\n\n"
+        max_chunk_size -= summary_tokens_length
+    # a window has to hold a good number of chunks, or the carried over chunk is most of it
+    window_chars = max(window_chars, max_chunk_size * 32)
+
+    buffer = ""
+    for text in _iter_text(stream):
+        buffer += text
+        if len(buffer) < window_chars:
+            continue
+        spans = _window_spans(TokenOffsets(buffer, model), max_chunk_size, strategy)
+        for start, end in spans[:-1]:
+            yield prefix + buffer[start:end]
+        buffer = buffer[spans[-1][0]:] if spans else ""
+
+    if buffer:
+        for start, end in _window_spans(TokenOffsets(buffer, model), max_chunk_size, strategy):
+            yield prefix + buffer[start:end]
+
+
+# Bulk chunking: chunking is pure python / tiktoken work that holds the GIL, so chunk_many spreads documents over a
+# process pool. Every pool process loads the encoding (and its token length table) and punkt once, when it starts.
+# CHUNK_WORKERS sets the pool size (default: all cores), 1 chunks in the calling process.
+
+CHUNK_WORKERS = int(os.getenv("CHUNK_WORKERS", "0")) or os.cpu_count() or 1
+
+
+def _warm_worker(model: str):
+    _get_encoding(model)
+    _token_byte_lengths(model)
+    _get_sentence_tokenizer()
+
+
+def _chunk_document(document: dict, strategy: str, max_chunk_size: int, model: str):
+    text, path = document["text"], document.get("path")
+    if document.get("summary") is not None:
+        return contextual_chunking(text, max_chunk_size, model, document["summary"], strategy=strategy, path=path)
+    return [text[start:end] for start, end in chunk_offsets(text, max_chunk_size, model, strategy, path=path)]
+
+
+def _chunk_batch(documents: list[dict], strategy: str, max_chunk_size: int, model: str):
+    results = []
+    for document in documents:
+        try:
+            results.append((document.get("id"), _chunk_document(document, strategy, max_chunk_size, model)))
+        except Exception as e:
+            print(f"Chunking failed for {document.get('path') or document.get('id')}: {e}")
+            results.append((document.get("id"), None))
+    return results
+
+
+def _batches(documents, max_documents: int = 32, max_chars: int = 1_000_000):
+    # small files travel to the pool together, a pickle round trip per file costs more than chunking it
+    batch, chars = [], 0
+    for document in documents:
+        batch.append(document)
+        chars += len(document.get("text") or "")
+        if len(batch) >= max_documents or chars >= max_chars:
+            yield batch
+            batch, chars = [], 0
+    if batch:
+        yield batch
+
+
+def chunk_many(documents, strategy: str = "auto", max_chunk_size: int = 1000, model: str = "o200k_base", workers: int = None):
+    """
+    Chunk many documents on all cores
+    documents is an iterable (read lazily) of {"id": ..., "text": ..., "path": optional, used by strategy="auto",
+    "summary": optional, contextual chunking when given}
+    Yields (id, chunks) as documents finish, not in input order. chunks is None for documents that failed
+    """
+    workers = workers or CHUNK_WORKERS
+    if workers <= 1:
+        for batch in _batches(documents):
+            yield from _chunk_batch(batch, strategy, max_chunk_size, model)
+        return
+
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_warm_worker, initargs=(model,))
+    try:
+        pending = set()
+        for batch in _batches(documents):
+            pending.add(pool.submit(_chunk_batch, batch, strategy, max_chunk_size, model))
+            # a couple of batches per process in flight, the rest of the documents stay unread
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in as_completed(pending):
+            yield from future.result()
+    finally:
+        # also when the caller stops early: batches not started yet are dropped
+        pool.shutdown(wait=True, cancel_futures=True)
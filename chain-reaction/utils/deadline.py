@@ -0,0 +1,82 @@
+# Deadlines for chain runs
+# A chain with a deadline (Chain(..., deadline=30) or context['deadline'] set by the caller) stores the absolute time
+# (epoch seconds) it has to finish by in context['deadline'] and in a contextvar for the duration of the run.
+# Code that doesn't get the context (LLM clients, http helpers) reads the contextvar:
+#   requests.post(url, timeout=request_timeout(60))
+# request_timeout returns the smaller of its default and the time left, so a slow provider can never hold a worker past
+# the deadline. Blocks check the deadline before every execute attempt and Block(timeout=...) bounds a single execute.
+# Contextvars follow Parallel / MapBlock into their worker threads and asyncio tasks, so branches see the same deadline.
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+_deadline = contextvars.ContextVar("chain_deadline", default=None)
+
+# never hand out a socket timeout below this. a request with 5ms left would just fail with a confusing error
+MIN_REQUEST_TIMEOUT = 0.1
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class BlockTimeout(TimeoutError):
+    """
+    Raised when a single execute call of a block takes longer than its timeout.
+    """
+    pass
+
+
+def get_deadline():
+    return _deadline.get()
+
+
+def remaining():
+    """
+    Seconds left before the current deadline. None when there is no deadline.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def check_deadline(name: str = None):
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded{' before ' + name if name else ''} ({-left:.2f}s over)")
+
+
+def request_timeout(default: float = None):
+    """
+    Timeout to pass to a network call: the default, shortened to the time left before the deadline.
+    Raises DeadlineExceeded when there is no time left at all.
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded ({-left:.2f}s over)")
+    left = max(left, MIN_REQUEST_TIMEOUT)
+    return left if default is None else min(default, left)
+
+
+def resolve_deadline(context: dict, timeout: float = None):
+    """
+    Absolute deadline for a run: the earlier of context['deadline'], the surrounding deadline and now + timeout.
+    """
+    candidates = [context.get('deadline'), _deadline.get()]
+    if timeout is not None:
+        candidates.append(time.time() + timeout)
+    candidates = [candidate for candidate in candidates if candidate is not None]
+    return min(candidates) if candidates else None
+
+
+@contextmanager
+def deadline_scope(deadline: float = None):
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
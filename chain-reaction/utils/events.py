@@ -0,0 +1,145 @@
+# Compact event log for block/chain runs (context['logs'])
+# Block.run records a handful of events per block. Building a dict with an isoformat timestamp and a formatted message
+# for each of them is a lot of allocation for hot chains, so instead we keep:
+# - monotonic ns timestamps and durations in typed arrays
+# - one small tuple per event (block, event, attempt, error, extra fields)
+# and only build the familiar dicts ({'timestamp', 'block', 'event', ..., 'message'}) when the log is serialized.
+#
+# Verbosity (context['log_level'] or CHAIN_LOG_LEVEL env, default "full"):
+# - off: nothing is recorded
+# - summary: block_completed, chain_completed/resumed, failed attempts, fallbacks and cache hits
+# - full: every phase of every block (the old behaviour)
+
+import os
+import time
+from array import array
+from datetime import datetime, timezone
+
+LOG_LEVELS = {
+    "off": 0,
+    "summary": 1,
+    "full": 2,
+}
+
+# minimum level at which an event is recorded. anything not listed is treated as "summary"
+EVENT_LEVELS = {
+    "block_started": 2,
+    "prepare_completed": 2,
+    "execute_attempt_success": 2,
+    "post_process_completed": 2,
+}
+
+EVENT_MESSAGES = {
+    "block_started": "Started executing block: {block}",
+    "prepare_completed": "Prepare phase completed in {duration_ms}ms",
+    "execute_attempt_success": "Execute attempt {attempt} succeeded in {duration_ms}ms",
+    "execute_attempt_failed": "Execute attempt {attempt} failed: {error}",
+    "execute_cache_hit": "Execute skipped, result served from cache",
+    "execute_fallback": "Execute fallback completed in {duration_ms}ms",
+    "post_process_completed": "Post-process phase completed in {duration_ms}ms",
+    "block_completed": "Block {block} completed in {duration_ms}ms",
+    "chain_completed": "Chain completed: executed {blocks_executed} blocks in {duration_ms}ms",
+    "chain_resumed": "Chain resumed from checkpoint at block {next_block}",
+}
+
+DEFAULT_LOG_LEVEL = os.getenv("CHAIN_LOG_LEVEL", "full")
+
+
+class EventLog:
+    __slots__ = ("level", "_wall_anchor_ns", "_mono_anchor_ns", "_timestamps", "_durations", "_records", "_raw")
+
+    def __init__(self, level: str = None, records: list[dict] = None):
+        self.level = LOG_LEVELS[level or DEFAULT_LOG_LEVEL]
+        # monotonic clock for ordering/durations, anchored once to wall clock for the serialized timestamps
+        self._wall_anchor_ns = time.time_ns()
+        self._mono_anchor_ns = time.monotonic_ns()
+        self._timestamps = array("q")
+        self._durations = array("q")
+        self._records = []
+        # entries that were appended as ready made dicts (older code paths, restored checkpoints). index -> dict
+        self._raw = {}
+        if records:
+            self.extend(records)
+
+    def enabled(self, event: str):
+        return self.level >= EVENT_LEVELS.get(event, 1)
+
+    def record(self, block: str, event: str, duration_ns: int = -1, attempt: int = None, error: str = None, **fields):
+        if self.level < EVENT_LEVELS.get(event, 1):
+            return
+        self._timestamps.append(time.monotonic_ns())
+        self._durations.append(duration_ns)
+        self._records.append((block, event, attempt, error, fields or None))
+
+    def append(self, entry: dict):
+        if self.level < EVENT_LEVELS.get(entry.get("event"), 1):
+            return
+        self._raw[len(self._records)] = entry
+        self._timestamps.append(time.monotonic_ns())
+        self._durations.append(-1)
+        self._records.append(None)
+
+    def extend(self, entries, events: tuple = None):
+        """
+        Add entries from a list of dicts or another EventLog. events optionally restricts which events are copied.
+        """
+        if isinstance(entries, EventLog):
+            # copy records as they are, no formatting. timestamps are re-based onto our anchor
+            offset = (entries._wall_anchor_ns - entries._mono_anchor_ns) - (self._wall_anchor_ns - self._mono_anchor_ns)
+            for index, record in enumerate(entries._records):
+                event = record[1] if record is not None else entries._raw[index].get("event")
+                if (events is not None and event not in events) or self.level < EVENT_LEVELS.get(event, 1):
+                    continue
+                if record is None:
+                    self._raw[len(self._records)] = entries._raw[index]
+                self._timestamps.append(entries._timestamps[index] + offset)
+                self._durations.append(entries._durations[index])
+                self._records.append(record)
+            return
+        for entry in entries:
+            if events is None or entry.get("event") in events:
+                self.append(entry)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        for index in range(len(self._records)):
+            yield self._entry(index, True)
+
+    def _entry(self, index: int, messages: bool):
+        record = self._records[index]
+        if record is None:
+            return self._raw[index]
+
+        block, event, attempt, error, fields = record
+        wall_ns = self._wall_anchor_ns + (self._timestamps[index] - self._mono_anchor_ns)
+        entry = {
+            "timestamp": datetime.fromtimestamp(wall_ns / 1e9, timezone.utc).isoformat(),
+            "block": block,
+            "event": event,
+        }
+        if attempt is not None:
+            entry["attempt"] = attempt
+        if error is not None:
+            entry["error"] = error
+        if self._durations[index] >= 0:
+            entry["duration_ms"] = round(self._durations[index] / 1e6, 2)
+        if fields:
+            entry.update(fields)
+        if messages:
+            entry["message"] = EVENT_MESSAGES.get(event, event).format(**entry)
+        return entry
+
+    def to_list(self, messages: bool = True):
+        """
+        JSON ready list of log dicts. messages=False drops the human readable message to keep stored logs small.
+        """
+        return [self._entry(index, messages) for index in range(len(self._records))]
+
+
+def serialize_logs(logs, messages: bool = True):
+    # context['logs'] can be an EventLog or (older contexts) a plain list of dicts
+    if isinstance(logs, EventLog):
+        return logs.to_list(messages)
+    return list(logs or [])
@@ -1,11 +1,19 @@
 # All the github related utils
 import base64
+import hashlib
 import requests
 import os
+from utils.deadline import request_timeout
 
 # Get the github token from the environment variable
 GITHUB_TOKEN = os.getenv("GITHUB_ACCESS_TOKEN")
 
+
+class FileTooLarge(ValueError):
+    """
+    The contents api only inlines files up to 1MB, larger ones have to be streamed with stream_repo_file_raw
+    """
+
 def get_repo_files(repo_name: str, repo_owner: str, repo_branch: str = "main") -> list[str]:
     """
     Get the files and folders in the repo
@@ -16,7 +24,7 @@ def get_repo_files(repo_name: str, repo_owner: str, repo_branch: str = "main") -
     print(f"GITHUB_TOKEN: {GITHUB_TOKEN}")
 
     url = f"https://api.github.com/repos/{repo_owner}/{repo_name}/git/trees/{repo_branch}?recursive=1"
-    response = requests.get(url, headers={"Authorization": f"token {GITHUB_TOKEN}"})
+    response = requests.get(url, headers={"Authorization": f"token {GITHUB_TOKEN}"}, timeout=request_timeout(30))
     response.raise_for_status()
     return response.json()["tree"]
 
@@ -27,7 +35,7 @@ def get_repo_file_raw(repo_name: str, repo_owner: str, file_path: str, repo_bran
     Do get request to GET https://api.github.com/repos/{owner}/{repo}/contents/{path}
     """
     url = f"https://api.github.com/repos/{repo_owner}/{repo_name}/contents/{file_path}?ref={repo_branch}"
-    response = requests.get(url, headers={"Authorization": f"token {GITHUB_TOKEN}"})
+    response = requests.get(url, headers={"Authorization": f"token {GITHUB_TOKEN}"}, timeout=request_timeout(30))
     response.raise_for_status()
     json_data = response.json()
     
@@ -38,5 +46,31 @@ def get_repo_file_raw(repo_name: str, repo_owner: str, file_path: str, repo_bran
     # If it's a file but doesn't have content (e.g., too large), skip it
     if "content" not in json_data:
         raise ValueError(f"File '{file_path}' content not available (file may be too large)")
+
+    # 1MB - 100MB: the file is there, but its content is left out (encoding "none")
+    if json_data.get("encoding") == "none":
+        raise FileTooLarge(f"File '{file_path}' is too large to inline ({json_data.get('size')} bytes)")
     
     return base64.b64decode(json_data["content"]).decode("utf-8")
+
+def stream_repo_file_raw(repo_name: str, repo_owner: str, file_path: str, repo_branch: str = "main", chunk_size: int = 64 * 1024):
+    """
+    Yield the raw bytes of a file in the repo as they download, for files too large for get_repo_file_raw (up to 100MB)
+
+    Do get request to GET https://api.github.com/repos/{owner}/{repo}/contents/{path} with the raw media type
+    """
+    url = f"https://api.github.com/repos/{repo_owner}/{repo_name}/contents/{file_path}?ref={repo_branch}"
+    headers = {"Authorization": f"token {GITHUB_TOKEN}", "Accept": "application/vnd.github.raw+json"}
+    with requests.get(url, headers=headers, stream=True, timeout=request_timeout(30)) as response:
+        response.raise_for_status()
+        yield from response.iter_content(chunk_size=chunk_size)
+
+def git_blob_sha(blocks, size: int) -> str:
+    """
+    The sha git (and the trees api) gives a file with these bytes, from an iterable of bytes blocks of size bytes in total.
+    Tells whether a stored file changed without downloading it again
+    """
+    sha = hashlib.sha1(f"blob {size}\0".encode())
+    for block in blocks:
+        sha.update(block)
+    return sha.hexdigest()
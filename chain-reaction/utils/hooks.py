@@ -0,0 +1,331 @@
+# Instrumentation hooks for Block / Chain runs
+# A hook gets called around every phase of a block run:
+#   before_block / after_block                      - the whole Block.run (Chain.run too, chains are blocks)
+#   before_prepare / after_prepare
+#   before_execute_attempt / after_execute_attempt  - once per attempt, error is set when the attempt failed
+#   before_fallback / after_fallback
+#   before_post_process / after_post_process
+# Subclass Hook and override what you need. Hooks are picked up from three places:
+# - Block(..., hooks=[...]) - that block only. Chain(..., hooks=[...]) covers the chain and every block it runs
+# - hook_scope([...]) - everything run inside the with block (kept in a contextvar, follows Parallel / MapBlock)
+# - register_hook(hook) - every block in the process. install_hooks_from_env() does this from env vars in the workers
+# Blocks without any hooks skip all of this, so it costs nothing unless it's switched on.
+# A hook that raises is reported and ignored, instrumentation must never fail a chain.
+#
+# Built in hooks:
+# - ProfilerHook - cProfile or pyinstrument profile of chosen blocks, one file per run
+# - TracemallocHook - memory allocated per block, added to context['timing'][block]
+# - SpanExporterHook - OpenTelemetry style spans (trace/span/parent ids, events, status) as JSON lines in a local file
+
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_global_hooks = []
+_scoped_hooks = contextvars.ContextVar("block_hooks", default=())
+
+
+class Hook:
+    def before_block(self, block, context):
+        pass
+
+    def after_block(self, block, context, duration_ns: int, error: Exception = None):
+        pass
+
+    def before_prepare(self, block, context):
+        pass
+
+    def after_prepare(self, block, context, duration_ns: int):
+        pass
+
+    def before_execute_attempt(self, block, context, attempt: int):
+        pass
+
+    def after_execute_attempt(self, block, context, attempt: int, duration_ns: int, error: Exception = None):
+        pass
+
+    def before_fallback(self, block, context, error: Exception):
+        pass
+
+    def after_fallback(self, block, context, duration_ns: int):
+        pass
+
+    def before_post_process(self, block, context):
+        pass
+
+    def after_post_process(self, block, context, duration_ns: int):
+        pass
+
+
+def register_hook(hook: Hook):
+    if hook not in _global_hooks:
+        _global_hooks.append(hook)
+
+
+def unregister_hook(hook: Hook):
+    if hook in _global_hooks:
+        _global_hooks.remove(hook)
+
+
+@contextmanager
+def hook_scope(hooks: list[Hook]):
+    token = _scoped_hooks.set(tuple(dict.fromkeys([*_scoped_hooks.get(), *(hooks or ())])))
+    try:
+        yield
+    finally:
+        _scoped_hooks.reset(token)
+
+
+def active_hooks(block_hooks: list[Hook] = None):
+    """
+    Hooks that apply to a block right now: global + scoped + the block's own, each one once.
+    """
+    if not _global_hooks and not _scoped_hooks.get() and not block_hooks:
+        return ()
+    return tuple(dict.fromkeys([*_global_hooks, *_scoped_hooks.get(), *(block_hooks or ())]))
+
+
+def emit(hooks, method: str, *args):
+    for hook in hooks:
+        try:
+            getattr(hook, method)(*args)
+        except Exception as e:
+            print(f"Hook {type(hook).__name__}.{method} failed: {str(e)}")
+
+
+def _run_key(block, context):
+    # the same block object can run in many contexts at once (MapBlock items, concurrent chains)
+    return (id(block), id(context))
+
+
+def _block_selected(blocks, block):
+    return blocks is None or block.name in blocks or type(block).__name__ in blocks
+
+
+class ProfilerHook(Hook):
+    """
+    Profiles whole runs of the selected blocks (by name or class name, None = all) and writes one file per run
+    into output_dir. engine is "cprofile" (.prof, open with pstats / snakeviz) or "pyinstrument" (.html, needs the
+    pyinstrument package). sample_rate < 1 profiles only that fraction of runs, so it can stay on in production.
+    Profilers only see the thread they started on: work a block hands to other threads (Parallel, MapBlock, a block
+    timeout) shows up as waiting.
+    """
+
+    def __init__(self, blocks: list[str] = None, engine: str = "cprofile", output_dir: str = None, sample_rate: float = 1.0):
+        if engine not in ("cprofile", "pyinstrument"):
+            raise ValueError(f"Unknown profiler engine {engine}")
+        if engine == "pyinstrument":
+            # fail at setup time instead of on the first profiled block
+            import pyinstrument  # noqa: F401
+        self.blocks = set(blocks) if blocks is not None else None
+        self.engine = engine
+        self.output_dir = output_dir or os.getenv("CHAIN_PROFILE_DIR", os.path.join(".cache", "profiles"))
+        self.sample_rate = sample_rate
+        self._profilers = {}
+        self._lock = threading.Lock()
+        # one profiler per thread at a time. a profiled chain doesn't also profile the blocks inside it
+        self._local = threading.local()
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def before_block(self, block, context):
+        if not _block_selected(self.blocks, block) or getattr(self._local, "active", False):
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+
+        if self.engine == "cprofile":
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            from pyinstrument import Profiler
+            profiler = Profiler(async_mode="enabled")
+            profiler.start()
+
+        self._local.active = True
+        with self._lock:
+            self._profilers[_run_key(block, context)] = profiler
+
+    def after_block(self, block, context, duration_ns: int, error: Exception = None):
+        with self._lock:
+            profiler = self._profilers.pop(_run_key(block, context), None)
+        if profiler is None:
+            return
+        self._local.active = False
+
+        name = f"{block.name or type(block).__name__}-{time.time_ns() // 1_000_000}-{os.getpid()}-{threading.get_ident()}"
+        if self.engine == "cprofile":
+            profiler.disable()
+            path = os.path.join(self.output_dir, name + ".prof")
+            profiler.dump_stats(path)
+        else:
+            profiler.stop()
+            path = os.path.join(self.output_dir, name + ".html")
+            with open(path, "w") as f:
+                f.write(profiler.output_html())
+        print(f"Profile of {block.name} ({round(duration_ns / 1e6, 2)}ms) written to {path}")
+
+
+class TracemallocHook(Hook):
+    """
+    Net memory allocated by each selected block run, stored as context['timing'][block]['memory_delta_kb'], and the
+    most it had allocated at any point of the run in 'memory_peak_kb' (above what was allocated when it started).
+    Starts tracemalloc if it isn't running (which slows allocation heavy code down noticeably). The numbers are
+    process wide: blocks running at the same time in other threads count towards each other's delta and peak.
+    top > 0 also prints the top allocation sites of every run.
+    """
+
+    def __init__(self, blocks: list[str] = None, top: int = 0, frames: int = 1):
+        self.blocks = set(blocks) if blocks is not None else None
+        self.top = top
+        self._runs = {}
+        self._lock = threading.Lock()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def before_block(self, block, context):
+        if not _block_selected(self.blocks, block):
+            return
+        snapshot = tracemalloc.take_snapshot() if self.top > 0 else None
+        with self._lock:
+            # the peak is reset for this run, runs already going (the chain around it) keep the peak they reached
+            current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            for run in self._runs.values():
+                run[2] = max(run[2], peak_bytes)
+            tracemalloc.reset_peak()
+            self._runs[_run_key(block, context)] = [current_bytes, snapshot, current_bytes]
+
+    def after_block(self, block, context, duration_ns: int, error: Exception = None):
+        with self._lock:
+            run = self._runs.pop(_run_key(block, context), None)
+            if run is None:
+                return
+            start_bytes, start_snapshot, peak_bytes = run
+            current_bytes, traced_peak_bytes = tracemalloc.get_traced_memory()
+            peak_bytes = max(peak_bytes, traced_peak_bytes)
+
+        timing = context.get('timing', {}).get(block.name)
+        if timing is not None:
+            timing['memory_delta_kb'] = round((current_bytes - start_bytes) / 1024, 2)
+            timing['memory_peak_kb'] = round((peak_bytes - start_bytes) / 1024, 2)
+
+        if start_snapshot is not None:
+            stats = tracemalloc.take_snapshot().compare_to(start_snapshot, "lineno")
+            print(f"Top allocations in {block.name}:")
+            for stat in stats[:self.top]:
+                print(f"  {stat}")
+
+
+class SpanExporterHook(Hook):
+    """
+    Writes one OpenTelemetry style span per block run to path (JSON lines). Blocks run inside a chain (or Parallel /
+    MapBlock) are children of its span, so a file can be loaded into any trace viewer that reads OTLP-like JSON, or
+    just grepped. Execute attempts, fallbacks and phase timings are added as span events.
+    """
+
+    def __init__(self, path: str = None, service_name: str = None):
+        self.path = path or os.getenv("CHAIN_SPAN_FILE", os.path.join(".cache", "spans.jsonl"))
+        self.service_name = service_name or os.getenv("OTEL_SERVICE_NAME", "chain-reaction")
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._current = contextvars.ContextVar("current_span", default=None)
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def _span(self, block, context):
+        with self._lock:
+            return self._spans.get(_run_key(block, context))
+
+    def _event(self, block, context, name: str, **attributes):
+        span = self._span(block, context)
+        if span is not None:
+            span['events'].append({
+                'name': name,
+                'time_unix_nano': time.time_ns(),
+                'attributes': {key: value for key, value in attributes.items() if value is not None}
+            })
+
+    def before_block(self, block, context):
+        parent = self._current.get()
+        span = {
+            'trace_id': parent['trace_id'] if parent else os.urandom(16).hex(),
+            'span_id': os.urandom(8).hex(),
+            'parent_span_id': parent['span_id'] if parent else None,
+            'name': block.name or type(block).__name__,
+            'kind': 'INTERNAL',
+            'start_time_unix_nano': time.time_ns(),
+            'attributes': {
+                'service.name': self.service_name,
+                'block.class': type(block).__name__,
+                'thread.id': threading.get_ident(),
+            },
+            'events': [],
+        }
+        # the token is kept on the span so after_block can restore the parent
+        span['_token'] = self._current.set(span)
+        with self._lock:
+            self._spans[_run_key(block, context)] = span
+
+    def after_prepare(self, block, context, duration_ns: int):
+        self._event(block, context, 'prepare', duration_ms=round(duration_ns / 1e6, 2))
+
+    def after_execute_attempt(self, block, context, attempt: int, duration_ns: int, error: Exception = None):
+        self._event(block, context, 'execute_attempt', attempt=attempt, duration_ms=round(duration_ns / 1e6, 2), error=str(error) if error else None)
+
+    def after_fallback(self, block, context, duration_ns: int):
+        self._event(block, context, 'execute_fallback', duration_ms=round(duration_ns / 1e6, 2))
+
+    def after_post_process(self, block, context, duration_ns: int):
+        self._event(block, context, 'post_process', duration_ms=round(duration_ns / 1e6, 2))
+
+    def after_block(self, block, context, duration_ns: int, error: Exception = None):
+        with self._lock:
+            span = self._spans.pop(_run_key(block, context), None)
+        if span is None:
+            return
+        try:
+            self._current.reset(span.pop('_token'))
+        except ValueError:
+            # reset from a different context (shouldn't happen, blocks run start to end in one context)
+            self._current.set(None)
+
+        span['end_time_unix_nano'] = span['start_time_unix_nano'] + duration_ns
+        span['status'] = {'code': 'ERROR', 'message': str(error)} if error else {'code': 'OK'}
+        line = json.dumps(span, default=str)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+def install_hooks_from_env():
+    """
+    Registers the built in hooks configured through env vars:
+    - CHAIN_SPAN_FILE=path                             -> SpanExporterHook
+    - CHAIN_PROFILE_BLOCKS=LLMBlock,VectorSearchBlock  -> ProfilerHook (all blocks with "*"). CHAIN_PROFILER picks the
+      engine, CHAIN_PROFILE_SAMPLE_RATE the fraction of runs, CHAIN_PROFILE_DIR the output directory
+    - CHAIN_TRACEMALLOC_BLOCKS=...                     -> TracemallocHook, same block syntax
+    """
+    def block_list(value):
+        return None if value.strip() == "*" else [name.strip() for name in value.split(",") if name.strip()]
+
+    installed = []
+    if os.getenv("CHAIN_SPAN_FILE"):
+        installed.append(SpanExporterHook())
+    if os.getenv("CHAIN_PROFILE_BLOCKS"):
+        installed.append(ProfilerHook(
+            blocks=block_list(os.getenv("CHAIN_PROFILE_BLOCKS")),
+            engine=os.getenv("CHAIN_PROFILER", "cprofile"),
+            sample_rate=float(os.getenv("CHAIN_PROFILE_SAMPLE_RATE", "1.0"))
+        ))
+    if os.getenv("CHAIN_TRACEMALLOC_BLOCKS"):
+        installed.append(TracemallocHook(blocks=block_list(os.getenv("CHAIN_TRACEMALLOC_BLOCKS"))))
+
+    for hook in installed:
+        register_hook(hook)
+    return installed
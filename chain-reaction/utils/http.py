@@ -0,0 +1,134 @@
+# Shared HTTP clients for outbound API calls (LLM providers etc)
+# One httpx.Client per origin (scheme + host + port), shared by every thread and every LLM object in the process.
+# Connections are kept alive and reused, so a call pays the TCP + TLS handshake once per pooled connection instead of
+# once per request. HTTP/2 is used when the h2 package is installed and the server offers it (over TLS), which lets
+# many concurrent requests share a single connection.
+# Pool size per origin: HTTP_POOL_SIZE env (default 20), or configure_pool(host, max_connections) for a specific host.
+# Clients are dropped in forked children (RQ forks a work horse per job): sharing a socket across processes corrupts
+# both sides.
+# Async code (AsyncBlock, the async LLM clients) gets an httpx.AsyncClient per origin from get_async_client. Those are
+# kept per event loop: an async client is bound to the loop it first ran on, and asyncio.run starts a new loop per run.
+
+import asyncio
+import os
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+
+DEFAULT_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+# idle connections are closed after this many seconds
+KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = os.getenv("HTTP2", "1") != "0"
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_pool_sizes = {}
+_clients = {}
+# event loop -> {origin: httpx.AsyncClient}. entries go away with their loop
+_async_clients = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _origin(url: str):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def configure_pool(host: str, max_connections: int):
+    """
+    Pool size for one host (e.g. "generativelanguage.googleapis.com"). Has to be called before its first request.
+    """
+    _pool_sizes[host] = max_connections
+
+
+def _client_options(url: str):
+    pool_size = _pool_sizes.get(urlsplit(url).hostname, DEFAULT_POOL_SIZE)
+    return dict(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size, keepalive_expiry=KEEPALIVE_EXPIRY),
+        # every call passes its own timeout (see request_timeout in utils/deadline.py), this is the fallback
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        follow_redirects=True
+    )
+
+
+def get_client(url: str):
+    origin = _origin(url)
+    client = _clients.get(origin)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(origin)
+        if client is None:
+            client = httpx.Client(**_client_options(url))
+            _clients[origin] = client
+    return client
+
+
+def get_async_client(url: str):
+    """
+    Shared httpx.AsyncClient for url's origin on the running event loop. Only call from a coroutine.
+    """
+    loop = asyncio.get_running_loop()
+    origin = _origin(url)
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(origin)
+        if client is None:
+            client = httpx.AsyncClient(**_client_options(url))
+            clients[origin] = client
+    return client
+
+
+def request(method: str, url: str, **kwargs):
+    return get_client(url).request(method, url, **kwargs)
+
+
+def get(url: str, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def stream(method: str, url: str, **kwargs):
+    """
+    Streamed request, the body is read with response.iter_bytes() inside the with block:
+        with http.stream("GET", url) as response: ...
+    """
+    return get_client(url).stream(method, url, **kwargs)
+
+
+def close_clients():
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
+async def close_async_clients():
+    """
+    Closes the async clients of the running event loop. Call before the loop ends to skip unclosed socket warnings.
+    """
+    with _lock:
+        clients = list(_async_clients.pop(asyncio.get_running_loop(), {}).values())
+    for client in clients:
+        await client.aclose()
+
+
+def _forget_clients():
+    # in a forked child: the parent's sockets are not ours to use or close, just start over
+    global _lock
+    _clients.clear()
+    _async_clients.clear()
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_clients)
@@ -0,0 +1,269 @@
+# Image fetching for vision prompts
+# Images are downloaded once into a bounded on-disk cache keyed by URL (IMAGE_CACHE_DIR, default .cache/images, at most
+# IMAGE_CACHE_MAX_MB, least recently used images are removed first):
+# - a cached image younger than IMAGE_CACHE_FRESH seconds (or the response's Cache-Control max-age) is used as is
+# - an older one is revalidated with If-None-Match / If-Modified-Since, a 304 costs a round trip but no body
+# - if the server can't be reached a stale copy is used rather than failing
+# Downloads are streamed to disk, never held in memory as a whole. With Pillow installed, images larger than the
+# provider can use (models' maxImageSide in utils/llm.py) are downscaled once and the smaller copy is cached next to the
+# original. Without Pillow the original is sent.
+#   path, mimetype = image_cache.fetch(url, max_side=1540)
+#   data_url = encode_data_url(path, mimetype)
+
+import binascii
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import threading
+import time
+
+from utils import http
+from utils.deadline import request_timeout, check_deadline
+
+# read / encode in chunks of this many bytes, a multiple of 3 so the base64 of the chunks can be concatenated
+CHUNK_SIZE = 3 * 64 * 1024
+
+# Pillow formats a downscaled image is saved in, anything else becomes PNG
+_SAVE_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+
+def _mimetype(response, url: str):
+    mimetype = response.headers.get("Content-Type", "").split(";")[0].strip()
+    if not mimetype.startswith("image/"):
+        # servers and buckets often say application/octet-stream, the extension knows better
+        mimetype = mimetypes.guess_type(url.split("?")[0])[0] or mimetype or "application/octet-stream"
+    return mimetype
+
+
+def _max_age(response):
+    match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+    return int(match.group(1)) if match else None
+
+
+def encode_data_url(path: str, mimetype: str):
+    """
+    data:<mimetype>;base64,... for the file at path. The file is encoded chunk by chunk straight into one buffer of
+    the final size, so the raw image is never in memory and the base64 only twice for the moment of the decode.
+    """
+    prefix = f"data:{mimetype};base64,".encode("ascii")
+    size = os.path.getsize(path)
+    buffer = bytearray(len(prefix) + 4 * ((size + 2) // 3))
+    buffer[:len(prefix)] = prefix
+    offset = len(prefix)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            encoded = binascii.b2a_base64(chunk, newline=False)
+            buffer[offset:offset + len(encoded)] = encoded
+            offset += len(encoded)
+    return buffer.decode("ascii")
+
+
+class ImageCache:
+    def __init__(self, directory: str = None, max_bytes: int = None, fresh_for: float = None, max_download_bytes: int = None):
+        self.directory = directory or os.getenv("IMAGE_CACHE_DIR", os.path.join(".cache", "images"))
+        self.max_bytes = max_bytes if max_bytes is not None else int(float(os.getenv("IMAGE_CACHE_MAX_MB", "512")) * 1024 * 1024)
+        # seconds a cached image is used without asking the server, unless the response said otherwise
+        self.fresh_for = fresh_for if fresh_for is not None else float(os.getenv("IMAGE_CACHE_FRESH", "3600"))
+        # downloads above this are aborted, nobody should send a 100MB image to an llm
+        self.max_download_bytes = max_download_bytes or int(float(os.getenv("IMAGE_MAX_DOWNLOAD_MB", "50")) * 1024 * 1024)
+        self._evict_lock = threading.Lock()
+
+    def _paths(self, url: str):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.directory, key)
+        return base + ".img", base + ".json"
+
+    def _read_meta(self, meta_path: str):
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta_path: str, meta: dict):
+        tmp = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, meta_path)
+
+    def _touch(self, *paths):
+        # eviction goes by mtime, so a used image counts as recent
+        for path in paths:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+    def fetch(self, url: str, max_side: int = None):
+        """
+        (path, mimetype) of a local copy of the image at url, downscaled to at most max_side pixels on its longer side
+        when max_side is given and Pillow is installed. Raises for HTTP errors unless a stale copy can be used.
+        """
+        image_path, meta_path = self._paths(url)
+        meta = self._read_meta(meta_path) if os.path.exists(image_path) else None
+
+        if meta is None or time.time() - meta["fetched_at"] > meta.get("max_age", self.fresh_for):
+            meta = self._download(url, image_path, meta_path, meta)
+        self._touch(image_path, meta_path)
+
+        if max_side:
+            variant = self._variant(image_path, meta_path, meta, max_side)
+            if variant is not None:
+                return variant
+        return image_path, meta["mimetype"]
+
+    def _download(self, url: str, image_path: str, meta_path: str, meta: dict = None):
+        check_deadline()
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f"{image_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with http.stream("GET", url, headers=headers, timeout=request_timeout(30)) as response:
+                if response.status_code == 304 and meta is not None:
+                    meta = {**meta, "fetched_at": time.time()}
+                    max_age = _max_age(response)
+                    if max_age is not None:
+                        meta["max_age"] = max_age
+                    self._write_meta(meta_path, meta)
+                    return meta
+                response.raise_for_status()
+
+                size = 0
+                with open(tmp, "wb") as f:
+                    for chunk in response.iter_bytes(CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > self.max_download_bytes:
+                            raise Exception(f"Image at {url} is larger than {self.max_download_bytes} bytes")
+                        f.write(chunk)
+
+                new_meta = {
+                    "url": url,
+                    "mimetype": _mimetype(response, url),
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "fetched_at": time.time(),
+                    "size": size,
+                    "variants": {}
+                }
+                max_age = _max_age(response)
+                if max_age is not None:
+                    new_meta["max_age"] = max_age
+        except Exception as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            if meta is None:
+                raise
+            print(f"Image cache: could not revalidate {url} ({e}), using the cached copy")
+            return meta
+
+        # the image changed, its downscaled copies are out of date
+        self._remove_variants(image_path, meta)
+        os.replace(tmp, image_path)
+        self._write_meta(meta_path, new_meta)
+        self._evict(keep=image_path)
+        return new_meta
+
+    def _variant_path(self, image_path: str, max_side: int):
+        return f"{image_path[:-len('.img')]}.{max_side}.img"
+
+    def _remove_variants(self, image_path: str, meta: dict = None):
+        for max_side in (meta or {}).get("variants", {}):
+            try:
+                os.remove(self._variant_path(image_path, max_side))
+            except OSError:
+                pass
+
+    def _variant(self, image_path: str, meta_path: str, meta: dict, max_side: int):
+        """
+        (path, mimetype) of the image downscaled to max_side, None when the original is small enough or Pillow is
+        not installed.
+        """
+        variants = meta.setdefault("variants", {})
+        key = str(max_side)
+        variant_path = self._variant_path(image_path, max_side)
+        if key in variants:
+            # None: the original already fits
+            if variants[key] is None:
+                return None
+            if os.path.exists(variant_path):
+                self._touch(variant_path)
+                return variant_path, variants[key]
+
+        try:
+            from PIL import Image
+        except ImportError:
+            return None
+
+        tmp = f"{variant_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with Image.open(image_path) as image:
+                if max(image.size) <= max_side:
+                    mimetype = None
+                else:
+                    image_format = image.format if image.format in _SAVE_FORMATS else "PNG"
+                    image.thumbnail((max_side, max_side))
+                    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+                        image = image.convert("RGB")
+                    image.save(tmp, format=image_format, **({"quality": 90} if image_format == "JPEG" else {}))
+                    mimetype = _SAVE_FORMATS[image_format]
+        except Exception as e:
+            # not something Pillow can read (svg, ...), the provider gets the original
+            print(f"Image cache: could not downscale {meta.get('url')} ({e})")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None
+
+        if mimetype is not None:
+            os.replace(tmp, variant_path)
+        variants[key] = mimetype
+        self._write_meta(meta_path, meta)
+        if mimetype is None:
+            return None
+        self._evict(keep=image_path)
+        return variant_path, mimetype
+
+    def _evict(self, keep: str = None):
+        """
+        Removes the least recently used images (with their metadata and downscaled copies) until the cache fits into
+        max_bytes. Never the one at keep, which is about to be used.
+        """
+        keep = os.path.basename(keep).split(".")[0] if keep else None
+        with self._evict_lock:
+            entries = {}
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                key = entry.name.split(".")[0]
+                size, used_at, paths = entries.get(key, (0, 0, []))
+                entries[key] = (size + stat.st_size, max(used_at, stat.st_mtime), paths + [entry.path])
+
+            total = sum(size for size, _, _ in entries.values())
+            candidates = [entry for key, entry in entries.items() if key != keep]
+            for size, _, paths in sorted(candidates, key=lambda entry: entry[1]):
+                if total <= self.max_bytes:
+                    break
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+
+
+# shared by everything in the process
+image_cache = ImageCache()
@@ -1,37 +1,204 @@
 # Simple wrappers around llms. 
 # TODO: (SG) Add tensorzero here once we dockerize the whole thing
 
-import requests
+import os
 import json
-import base64
-import mimetypes
+import time
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils.retry import parse_retry_after, get_status_code, get_retry_after
+from utils.deadline import request_timeout, remaining, check_deadline, DeadlineExceeded
+from utils.rate_limit import limiter
+from utils.singleflight import flights
+from utils.cache import Cache, SQLiteCache, RedisCache, TieredCache, stable_hash
+from utils.images import image_cache, encode_data_url
+from utils import http
+from utils import metrics
 
 
-def get_data_url_and_mimetype(image_url):
-    # Fetch the image content
-    response = requests.get(image_url)
-    response.raise_for_status()
+def get_data_url_and_mimetype(image_url, max_side: int = None):
+    """
+    (data url, mimetype) of the image at image_url. Fetched through the on-disk image cache (utils/images.py) and
+    downscaled to max_side pixels when given, e.g. llm.max_image_side().
+    """
+    path, mimetype = image_cache.fetch(image_url, max_side=max_side)
+    return encode_data_url(path, mimetype), mimetype
 
-    # Try to get mimetype from headers
-    mimetype = response.headers.get('Content-Type')
-    if not mimetype:
-        # Fallback: guess based on file extension
-        mimetype, _ = mimetypes.guess_type(image_url)
+def _body_texts(value, key: str = None):
+    # the prompt text of a request body (message contents, embedding inputs), without images or settings
+    if isinstance(value, str):
+        return [value] if key in ("text", "content", "input") else []
+    if isinstance(value, list):
+        return [text for item in value for text in _body_texts(item, key)]
+    if isinstance(value, dict):
+        return [text for child_key, child in value.items() for text in _body_texts(child, child_key)]
+    return []
 
-    # Encode image as base64
-    base64_data = base64.b64encode(response.content).decode('utf-8')
+def _body_images(value):
+    # number of images in a request body: mistral's image_url parts, gemini's inlineData parts
+    if isinstance(value, list):
+        return sum(_body_images(item) for item in value)
+    if isinstance(value, dict):
+        return sum(1 if key in ("image_url", "inlineData") else _body_images(child) for key, child in value.items())
+    return 0
 
-    # Form data URL
-    data_url = f"data:{mimetype};base64,{base64_data}"
+# tokens a request is charged per image by the rate limiter. providers bill an image by its size in tiles, not by the
+# length of its base64, ~1.5K tokens covers a downscaled image
+IMAGE_TOKENS = int(os.getenv("LLM_IMAGE_TOKENS", "1500"))
+
+class LLMError(Exception):
+    """
+    Raised when a provider answers with a non 200 status. status_code and retry_after (seconds, from the Retry-After
+    header) let RetryPolicy (utils/retry.py) decide whether and when to retry.
+    """
+    def __init__(self, message: str, status_code: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, message: str, response):
+        return cls(
+            f"{message}: {response.status_code} {response.text}",
+            status_code=response.status_code,
+            retry_after=parse_retry_after(response.headers.get("Retry-After"))
+        )
+
+# per model {"rpm": ..., "tpm": ...} overrides for the limits in the model tables, e.g.
+# LLM_RATE_LIMITS='{"gemini:gemini-2.0-flash": {"rpm": 15, "tpm": 1000000}}'. a limit of 0 / null is no limit
+RATE_LIMITS = json.loads(os.getenv("LLM_RATE_LIMITS", "{}"))
 
-    return data_url, mimetype
 
 class LLM:
-    def __init__(self, api_key: str):
+    provider = "llm"
+    models = {}
+    model = None
+
+    def __init__(self, api_key: str, timeout: float = 60):
         self.api_key = api_key
+        # socket timeout in seconds for every request. shortened to the time left when running under a chain deadline
+        self.timeout = timeout
+
+    def model_for(self, model: str = None):
+        # per call, the client's default model is left alone so one client can be shared between threads
+        return model if model is not None and model in self.models else self.model
+
+    def max_image_side(self, model: str = None):
+        # longest image side in pixels the model makes use of, larger images only cost upload time and tokens
+        return self.models.get(self.model_for(model), {}).get("maxImageSide")
+
+    def rate_limit(self, model: str, body: dict):
+        """
+        (key, rpm, tpm, tokens) for a request to model. tokens is estimated from the prompt text of the body, the way
+        usage is, plus IMAGE_TOKENS per image. Only the input is counted.
+        """
+        key = f"{self.provider}:{model}"
+        limits = RATE_LIMITS.get(key) or self.models.get(model, {})
+        tokens = metrics.estimate_tokens("\n".join(_body_texts(body))) + IMAGE_TOKENS * _body_images(body)
+        return key, limits.get("rpm"), limits.get("tpm"), tokens
+
+    def acquire_rate_limit(self, model: str, body: dict):
+        # waits for a slot under the provider's quota, shared by all workers (utils/rate_limit.py)
+        limiter.acquire(*self.rate_limit(self.model_for(model), body))
+
+    # request building / response parsing, per provider:
+    #   text_request(messages, model, max_tokens, stream) / embeddings_request(text, model) -> (url, headers, body)
+    #   embeddings_batch_requests(texts, model) -> one (url, headers, body) per batch
+    #   parse_text / parse_text_delta / parse_embeddings / parse_embeddings_batch / parse_usage (response json)
+
+    def flight_key(self, url: str, body: dict):
+        # the query string can carry the api key (gemini), never part of the key
+        return stable_hash(self.provider, url.split("?")[0], body)
+
+    def _post(self, model: str, url: str, headers: dict, body: dict, error: str, operation: str):
+        """
+        Response json of a request, and whether this caller made it: identical requests in flight at the same time
+        share one call (utils/singleflight.py), only the caller that made it records the usage.
+        """
+        return flights.do(self.flight_key(url, body), lambda: self._send(model, url, headers, body, error, operation))
+
+    def _send(self, model: str, url: str, headers: dict, body: dict, error: str, operation: str):
+        self.acquire_rate_limit(model, body)
+        try:
+            response = http.post(url, headers=headers, json=body, timeout=request_timeout(self.timeout))
+        except Exception:
+            metrics.registry.record_error(self.provider, self.model_for(model), operation)
+            raise
+
+        if response.status_code != 200:
+            metrics.registry.record_error(self.provider, self.model_for(model), operation)
+            raise LLMError.from_response(error, response)
+
+        return response.json()
+
+    def generate_text(self, messages: list[dict], model: str = None, max_tokens: int = 1000):
+        url, headers, body = self.text_request(messages, model, max_tokens)
+        start = time.time()
+        data, leader = self._post(model, url, headers, body, "Failed to generate text", "text")
+        text = self.parse_text(data)
+        if leader:
+            self.record_usage("text", model, body, data, start, text)
+        return text
+
+    def generate_embeddings(self, text: str, model: str = None):
+        url, headers, body = self.embeddings_request(text, model)
+        start = time.time()
+        data, leader = self._post(model, url, headers, body, "Failed to generate embeddings", "embeddings")
+        if leader:
+            self.record_usage("embeddings", model, body, data, start)
+        return self.parse_embeddings(data)
 
-    def generate_text(self, messages: list[dict]):
-        pass
+    def generate_embeddings_batch(self, texts: list[str], model: str = None):
+        """
+        Embeddings for many texts with as few requests as possible. Vectors come back in input order.
+        """
+        embeddings = []
+        for url, headers, body in self.embeddings_batch_requests(texts, model):
+            start = time.time()
+            data, leader = self._post(model, url, headers, body, "Failed to generate embeddings", "embeddings")
+            if leader:
+                self.record_usage("embeddings", model, body, data, start)
+            embeddings.extend(self.parse_embeddings_batch(data))
+        return embeddings
+
+    def parse_usage(self, data: dict):
+        # (prompt_tokens, completion_tokens) from a response, None for what the provider doesn't report
+        return None, None
+
+    def record_usage(self, operation: str, model: str, body: dict, data: dict, start: float, output: str = None):
+        """
+        Adds a finished call to the metrics (utils/metrics.py): the block's context['timing'] entry and the registry.
+        Token counts the provider didn't report are estimated from the request / output text.
+        """
+        model = self.model_for(model)
+        prompt_tokens, completion_tokens = self.parse_usage(data) if data else (None, None)
+        estimated = prompt_tokens is None or (output is not None and completion_tokens is None)
+        if prompt_tokens is None:
+            prompt_tokens = metrics.estimate_tokens("\n".join(_body_texts(body)))
+        if completion_tokens is None:
+            completion_tokens = metrics.estimate_tokens(output) if output else 0
+        prices = self.models.get(model, {})
+        cost = (prompt_tokens * prices.get("inputPrice", 0) + completion_tokens * prices.get("outputPrice", 0)) / 1e6
+        metrics.record_llm_call(self.provider, model, operation, prompt_tokens, completion_tokens, (time.time() - start) * 1000, cost, estimated)
+
+    def embedding_batches(self, texts: list[str], max_items: int, max_tokens: int = None):
+        """
+        Splits texts into consecutive batches of at most max_items texts and about max_tokens tokens. Token counts are
+        estimated (~4 characters a token): the providers use their own tokenizers, so this only has to stay under
+        their limits, not be exact.
+        """
+        batch, batch_tokens = [], 0
+        for text in texts:
+            tokens = len(text) // 4 + 1
+            if batch and (len(batch) >= max_items or (max_tokens is not None and batch_tokens + tokens > max_tokens)):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            yield batch
 
     def parse_response(self, response: str):
         # trim the response, then ```json <content> ``` of the form should be parsed and only JSON.parse(content) should be returned
@@ -44,33 +211,68 @@ class LLM:
             raise Exception(f"Error parsing response: {str(e)} \n\n Response: {response}")
 
 class Mistral(LLM):
+    provider = "mistral"
+
+    # rpm / tpm: quotas for utils/rate_limit.py, override with LLM_RATE_LIMITS for other tiers
+    # maxImageSide: longest image side in pixels the model uses, images are downscaled to it before upload
+    # inputPrice / outputPrice: USD per 1M tokens, for the cost estimates in utils/metrics.py
     models = {
         "mistral-large-latest": {
             "supportsImages": False,
+            "rpm": 60,
+            "tpm": 500000,
+            "inputPrice": 2.0,
+            "outputPrice": 6.0,
         },
         "mistral-embed": {
             "supportsEmbeddings": True,
+            "maxBatchItems": 128,
+            "maxBatchTokens": 16000,
+            "rpm": 60,
+            "tpm": 500000,
+            "inputPrice": 0.1,
         },
         "codestral-embed": {
             "supportsEmbeddings": True,
+            "maxBatchItems": 128,
+            "maxBatchTokens": 16000,
+            "rpm": 60,
+            "tpm": 500000,
+            "inputPrice": 0.15,
         },
         "mistral-medium-latest": {
             "supportsImages": True,
+            "maxImageSide": 1540,
+            "rpm": 60,
+            "tpm": 500000,
+            "inputPrice": 0.4,
+            "outputPrice": 2.0,
         }
     }
 
     model = "mistral-large-latest"
 
-    def __init__(self, api_key: str, model: str = None):
-        super().__init__(api_key)
+    # overridable so benchmarks / local runs can point at a stand-in server (benchmarks/fake_llm_server.py).
+    # LLM_BASE_URL moves every provider at once
+    base_url = os.getenv("MISTRAL_BASE_URL") or os.getenv("LLM_BASE_URL") or "https://api.mistral.ai"
+
+    def __init__(self, api_key: str, model: str = None, timeout: float = 60):
+        super().__init__(api_key, timeout)
         if model is not None and model in self.models:
             self.model = model
 
-    def format_messages(self, messages: list[dict]):
+    def headers(self):
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+
+    def format_messages(self, messages: list[dict], model: str = None):
+        model = model or self.model
         # each message is of the form role, content and type. content = {"type": "image_url", "dataUrl": "url"} for images. type = image_url and text other wise
         formatted_messages = []
         for message in messages:
-            if message["type"] == "image_url" and self.models[self.model]["supportsImages"]:
+            if message["type"] == "image_url" and self.models[model]["supportsImages"]:
                 formatted_messages.append({
                     "role": message["role"],
                     "content": [
@@ -93,94 +295,130 @@ class Mistral(LLM):
 
         return formatted_messages
 
-    def generate_text(self, messages: list[dict], model: str = None, max_tokens: int = 1000):
-        if model is not None and model in self.models:
-            self.model = model
+    def text_request(self, messages: list[dict], model: str = None, max_tokens: int = 1000, stream: bool = False):
+        model = self.model_for(model)
 
-        if self.model not in self.models:
-            raise Exception(f"Model {self.model} not supported")
+        if model not in self.models:
+            raise Exception(f"Model {model} not supported")
 
-        formatted_messages = self.format_messages(messages)
+        formatted_messages = self.format_messages(messages, model)
 
         body = {
-            "model": self.model,
+            "model": model,
             "messages": formatted_messages,
-            "stream": False,
+            "stream": stream,
             "max_tokens": max_tokens
         }
 
+        return f"{self.base_url}/v1/chat/completions", self.headers(), body
 
-        response = requests.post(
-            "https://api.mistral.ai/v1/chat/completions",
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.api_key}"
-            },
-            json=body)
-        
-        if response.status_code != 200:
-            raise Exception(f"Failed to generate text: {response.status_code} {response.text}")
-        
-        return response.json()["choices"][0]["message"]["content"]
+    def parse_text(self, data: dict):
+        return data["choices"][0]["message"]["content"]
 
-    def generate_embeddings(self, text: str, model: str = None):
-        if model is not None and model in self.models:
-            self.model = model
+    def parse_text_delta(self, data: dict):
+        # one server sent event of a streamed completion
+        choices = data.get("choices") or []
+        if not choices:
+            return ""
+        return choices[0].get("delta", {}).get("content") or ""
+
+    def embeddings_request(self, text: str, model: str = None):
+        model = self.model_for(model)
 
-        if self.model not in self.models:
-            raise Exception(f"Model {self.model} not supported")
+        if model not in self.models:
+            raise Exception(f"Model {model} not supported")
 
-        if not self.models[self.model]["supportsEmbeddings"]:
-            raise Exception(f"Model {self.model} does not support embeddings")
+        if not self.models[model]["supportsEmbeddings"]:
+            raise Exception(f"Model {model} does not support embeddings")
         
         body = {
-            "model": self.model,
+            "model": model,
             "input": text,
             "output_dtype": "float"
         }
 
-        response = requests.post(
-            "https://api.mistral.ai/v1/embeddings",
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.api_key}"
-            },
-            json=body
-        )
+        return f"{self.base_url}/v1/embeddings", self.headers(), body
 
-        if response.status_code != 200:
-            raise Exception(f"Failed to generate embeddings: {response.status_code} {response.text}")
+    def parse_embeddings(self, data: dict):
+        return data["data"][0]["embedding"]
+
+    def embeddings_batch_requests(self, texts: list[str], model: str = None):
+        """
+        (url, headers, body) for every batch needed to embed texts, in input order.
+        """
+        model = self.model_for(model)
+
+        if not self.models[model].get("supportsEmbeddings"):
+            raise Exception(f"Model {model} does not support embeddings")
+
+        for batch in self.embedding_batches(texts, self.models[model]["maxBatchItems"], self.models[model]["maxBatchTokens"]):
+            yield f"{self.base_url}/v1/embeddings", self.headers(), {
+                "model": model,
+                "input": batch,
+                "output_dtype": "float"
+            }
+
+    def parse_embeddings_batch(self, data: dict):
+        return [item["embedding"] for item in sorted(data["data"], key=lambda item: item["index"])]
+
+    def parse_usage(self, data: dict):
+        usage = data.get("usage") or {}
+        return usage.get("prompt_tokens"), usage.get("completion_tokens")
 
-        return response.json()["data"][0]["embedding"]
         
 
     
 class Gemini(LLM):
+    provider = "gemini"
 
+    # rpm / tpm: tier 1 quotas for utils/rate_limit.py, override with LLM_RATE_LIMITS for other tiers
+    # maxImageSide: longest image side in pixels the model uses, images are downscaled to it before upload
+    # inputPrice / outputPrice: USD per 1M tokens, for the cost estimates in utils/metrics.py
     models = {
         "gemini-2.0-flash": {
             "supportsImages": True,
+            # larger images are scaled down to this by the api anyway
+            "maxImageSide": 3072,
+            "rpm": 2000,
+            "tpm": 4000000,
+            "inputPrice": 0.1,
+            "outputPrice": 0.4,
         },
         "gemini-embedding-001": {
             "supportsEmbeddings": True,
+            # batchEmbedContents takes at most 100 requests
+            "maxBatchItems": 100,
+            "maxBatchTokens": 20000,
+            "rpm": 3000,
+            "tpm": 1000000,
+            "inputPrice": 0.15,
         }
     }
 
     model = "gemini-2.0-flash"
 
-    def __init__(self, api_key: str, model: str = None):
-        super().__init__(api_key)
+    base_url = os.getenv("GEMINI_BASE_URL") or os.getenv("LLM_BASE_URL") or "https://generativelanguage.googleapis.com"
+
+    def __init__(self, api_key: str, model: str = None, timeout: float = 60):
+        super().__init__(api_key, timeout)
         if model is not None and model in self.models:
             self.model = model
 
-    def format_messages(self, messages: list[dict]):
+    def headers(self):
+        return {
+            "Content-Type": "application/json",
+            "x-goog-api-key": self.api_key
+        }
+
+    def format_messages(self, messages: list[dict], model: str = None):
+        model = model or self.model
         # each message is of the form role, content and type. content = {"type": "image_url", "dataUrl": "url", "mime": "image/png"} for images. type = image_url and text other wise
         formatted_messages = []
         for message in messages:
             # strip away system messsages if any
             if message["role"] == "system":
                 continue
-            if message["type"] == "image_url" and self.models[self.model]["supportsImages"]:
+            if message["type"] == "image_url" and self.models[model]["supportsImages"]:
                 formatted_messages.append({
                     "role": "user" if message["role"] == "user" else "model",
                     "parts": [
@@ -204,14 +442,13 @@ class Gemini(LLM):
 
         return formatted_messages
 
-    def generate_text(self, messages: list[dict], model: str = None, max_tokens: int = 1000):
-        if model is not None and model in self.models:
-            self.model = model
+    def text_request(self, messages: list[dict], model: str = None, max_tokens: int = 1000, stream: bool = False):
+        model = self.model_for(model)
 
-        if self.model not in self.models:
-            raise Exception(f"Model {self.model} not supported")
+        if model not in self.models:
+            raise Exception(f"Model {model} not supported")
 
-        formatted_messages = self.format_messages(messages)
+        formatted_messages = self.format_messages(messages, model)
 
         system_messages = [msg for msg in formatted_messages if msg["role"] == "system"]
         system_message = system_messages[0]["content"][0]["text"] if len(system_messages) > 0 and "content" in system_messages[0] and system_messages[0]["type"] == "text" else ""
@@ -233,32 +470,35 @@ class Gemini(LLM):
             }
         }
 
-        response = requests.post(
-            "https://generativelanguage.googleapis.com/v1beta/models/" + self.model + ":generateContent?key=" + self.api_key,
-            json=body,
-            headers={
-                "Content-Type": "application/json",
-                "x-goog-api-key": self.api_key
-            }
-        )
+        if stream:
+            # alt=sse makes streamGenerateContent answer with server sent events instead of one long JSON array
+            url = f"{self.base_url}/v1beta/models/{model}:streamGenerateContent?alt=sse&key={self.api_key}"
+        else:
+            url = f"{self.base_url}/v1beta/models/{model}:generateContent?key={self.api_key}"
 
-        if response.status_code != 200:
-            raise Exception(f"Failed to generate text: {response.status_code} {response.text}")
-        
-        return response.json()["candidates"][0]["content"]["parts"][0]["text"]
-    
-    def generate_embeddings(self, text: str, model: str = None):
-        if model is not None and model in self.models:
-            self.model = model
+        return url, self.headers(), body
+
+    def parse_text(self, data: dict):
+        return data["candidates"][0]["content"]["parts"][0]["text"]
+
+    def parse_text_delta(self, data: dict):
+        # one server sent event of a streamed answer. the last one may only carry finishReason / usageMetadata
+        candidates = data.get("candidates") or []
+        if not candidates:
+            return ""
+        return "".join(part.get("text", "") for part in candidates[0].get("content", {}).get("parts", []))
+
+    def embeddings_request(self, text: str, model: str = None):
+        model = self.model_for(model)
 
-        if self.model not in self.models:
-            raise Exception(f"Model {self.model} not supported")
+        if model not in self.models:
+            raise Exception(f"Model {model} not supported")
         
-        if not self.models[self.model]["supportsEmbeddings"]:
-            raise Exception(f"Model {self.model} does not support embeddings")
+        if not self.models[model]["supportsEmbeddings"]:
+            raise Exception(f"Model {model} does not support embeddings")
 
         body = {
-            "model": f"models/{self.model}",
+            "model": f"models/{model}",
             "content": {
                 "parts": [
                     {
@@ -268,20 +508,542 @@ class Gemini(LLM):
             }
         }
 
-        headers = {
-            "Content-Type": "application/json",
-            "x-goog-api-key": self.api_key
-        }
+        return f"{self.base_url}/v1beta/models/{model}:embedContent", self.headers(), body
+
+    def parse_embeddings(self, data: dict):
+        return data["embedding"]["values"]
+
+    def embeddings_batch_requests(self, texts: list[str], model: str = None):
+        """
+        (url, headers, body) for every batchEmbedContents call needed to embed texts, in input order.
+        """
+        model = self.model_for(model)
+
+        if not self.models[model].get("supportsEmbeddings"):
+            raise Exception(f"Model {model} does not support embeddings")
+
+        for batch in self.embedding_batches(texts, self.models[model]["maxBatchItems"], self.models[model]["maxBatchTokens"]):
+            body = {
+                "requests": [
+                    {
+                        "model": f"models/{model}",
+                        "content": {
+                            "parts": [
+                                {
+                                    "text": text
+                                }
+                            ]
+                        }
+                    }
+                    for text in batch
+                ]
+            }
+            yield f"{self.base_url}/v1beta/models/{model}:batchEmbedContents", self.headers(), body
+
+    def parse_embeddings_batch(self, data: dict):
+        return [embedding["values"] for embedding in data["embeddings"]]
+
+    def parse_usage(self, data: dict):
+        # embedContent / batchEmbedContents don't report usage
+        usage = data.get("usageMetadata") or {}
+        return usage.get("promptTokenCount"), usage.get("candidatesTokenCount")
 
-        response = requests.post(
-            f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:embedContent",
-            json=body,
-            headers=headers
-        )
+
+
+class AsyncLLM:
+    """
+    Async versions of the client calls, for AsyncBlock / AsyncChain. Mixed in front of a provider class so the request
+    building and response parsing stay in one place:
+        gemini = AsyncGemini(api_key)
+        text = await gemini.generate_text(messages)
+        async for delta in gemini.stream_text(messages):
+            ...
+    stream_text yields the answer as it is generated, so callers can show the first words long before the answer is
+    done (time to first token instead of total generation time).
+    """
+
+    async def acquire_rate_limit_async(self, model: str, body: dict):
+        await limiter.acquire_async(*self.rate_limit(self.model_for(model), body))
+
+    async def _post(self, model: str, url: str, headers: dict, body: dict, error: str, operation: str):
+        return await flights.do_async(self.flight_key(url, body), lambda: self._send(model, url, headers, body, error, operation))
+
+    async def _send(self, model: str, url: str, headers: dict, body: dict, error: str, operation: str):
+        await self.acquire_rate_limit_async(model, body)
+        try:
+            response = await http.get_async_client(url).post(url, headers=headers, json=body, timeout=request_timeout(self.timeout))
+        except Exception:
+            metrics.registry.record_error(self.provider, self.model_for(model), operation)
+            raise
 
         if response.status_code != 200:
-            raise Exception(f"Failed to generate embeddings: {response.status_code} {response.text}")
+            metrics.registry.record_error(self.provider, self.model_for(model), operation)
+            raise LLMError.from_response(error, response)
+
+        return response.json()
+
+    async def generate_text(self, messages: list[dict], model: str = None, max_tokens: int = 1000):
+        url, headers, body = self.text_request(messages, model, max_tokens)
+        start = time.time()
+        data, leader = await self._post(model, url, headers, body, "Failed to generate text", "text")
+        text = self.parse_text(data)
+        if leader:
+            self.record_usage("text", model, body, data, start, text)
+        return text
+
+    async def stream_text(self, messages: list[dict], model: str = None, max_tokens: int = 1000):
+        """
+        Yields the answer in pieces (text deltas) as the provider sends them.
+        """
+        url, headers, body = self.text_request(messages, model, max_tokens, stream=True)
+        await self.acquire_rate_limit_async(model, body)
+
+        start = time.time()
+        client = http.get_async_client(url)
+        # the timeout is per read, so a long answer is fine as long as tokens keep coming
+        async with client.stream("POST", url, headers=headers, json=body, timeout=request_timeout(self.timeout)) as response:
+            if response.status_code != 200:
+                await response.aread()
+                metrics.registry.record_error(self.provider, self.model_for(model), "stream")
+                raise LLMError.from_response("Failed to generate text", response)
+
+            text = ""
+            # usage comes with the last events
+            usage_data = None
+            async for data in sse_events(response.aiter_lines()):
+                if self.parse_usage(data)[0] is not None:
+                    usage_data = data
+                delta = self.parse_text_delta(data)
+                if delta:
+                    text += delta
+                    yield delta
+
+        self.record_usage("stream", model, body, usage_data, start, text)
+
+    async def generate_embeddings(self, text: str, model: str = None):
+        url, headers, body = self.embeddings_request(text, model)
+        start = time.time()
+        data, leader = await self._post(model, url, headers, body, "Failed to generate embeddings", "embeddings")
+        if leader:
+            self.record_usage("embeddings", model, body, data, start)
+        return self.parse_embeddings(data)
+
+    async def generate_embeddings_batch(self, texts: list[str], model: str = None):
+        embeddings = []
+        for url, headers, body in self.embeddings_batch_requests(texts, model):
+            start = time.time()
+            data, leader = await self._post(model, url, headers, body, "Failed to generate embeddings", "embeddings")
+            if leader:
+                self.record_usage("embeddings", model, body, data, start)
+            embeddings.extend(self.parse_embeddings_batch(data))
+        return embeddings
+
+
+class AsyncMistral(AsyncLLM, Mistral):
+    pass
+
+
+class AsyncGemini(AsyncLLM, Gemini):
+    pass
+
+
+class RouteStats:
+    def __init__(self):
+        # ewma of successful call latency in seconds (time to first token for streams), None until the first success
+        self.latency = None
+        # ewma of failures, 0..1
+        self.error_rate = 0.0
+        # rate limited (429) until this time
+        self.cooldown_until = 0.0
+        self.calls = 0
+        self.errors = 0
+
+
+# "provider:model:operation" -> RouteStats, per model the call actually used (a client can serve several), shared by every router in the process so they all learn from each call
+_route_stats = {}
+_route_stats_lock = threading.Lock()
+
+
+class Router:
+    """
+    Sends each text request to the best provider out of several clients and fails over to the next one on errors:
+        llm = Router([Gemini(gemini_key, "gemini-2.0-flash"), Mistral(mistral_key, "mistral-large-latest")])
+        llm.generate_text(messages)
+    Providers are ranked by the ewma of their latency, weighted up by their recent error rate. Ones that were rate
+    limited (429) are skipped until their Retry-After (or cooldown seconds) passed, and ones never tried go first.
+    Each client uses its own default model unless the call's model is one of its models. Clients without an api key
+    are left out.
+    hedge_after: if the first provider hasn't answered after this many seconds, the request is sent to the next one too
+    and the first answer wins. Cuts tail latency at the price of some duplicate requests.
+    Only text generation is routed: embeddings from different models live in different vector spaces.
+    """
+    def __init__(self, llms: list, hedge_after: float = None, alpha: float = 0.2, cooldown: float = 30, error_weight: float = 4):
+        self.llms = [llm for llm in llms if llm.api_key] or list(llms)
+        self.hedge_after = hedge_after
+        # weight of the newest observation in the ewmas
+        self.alpha = alpha
+        # seconds a rate limited provider is skipped when the 429 has no Retry-After
+        self.cooldown = cooldown
+        # latency multiplier per unit of error rate. a provider failing half the time ranks like one 3x as slow
+        self.error_weight = error_weight
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # parse_response, format_messages etc from the first client. private names and llms itself are not passed on,
+        # copy / pickle look them up before __init__ has run and would recurse
+        if name.startswith("_") or name == "llms":
+            raise AttributeError(name)
+        return getattr(self.llms[0], name)
+
+    def max_image_side(self, model: str = None):
+        # the smallest of the clients that take images, any of them may end up answering
+        sides = [llm.max_image_side(model) for llm in self.llms if llm.models.get(llm.model_for(model), {}).get("supportsImages")]
+        sides = [side for side in sides if side]
+        return min(sides) if sides else None
+
+    def stats(self, llm, operation: str, model: str = None):
+        key = f"{llm.provider}:{llm.model_for(model)}:{operation}"
+        with _route_stats_lock:
+            stats = _route_stats.get(key)
+            if stats is None:
+                stats = _route_stats[key] = RouteStats()
+        return stats
+
+    def ranked(self, operation: str, model: str = None):
+        now = time.time()
+
+        def rank(llm):
+            stats = self.stats(llm, operation, model)
+            cooling_down = stats.cooldown_until > now
+            if stats.latency is None:
+                return (cooling_down, 0.0)
+            return (cooling_down, stats.latency * (1 + self.error_weight * stats.error_rate))
+
+        return sorted(self.llms, key=rank)
+
+    def record(self, llm, operation: str, model: str = None, latency: float = None, error: Exception = None):
+        stats = self.stats(llm, operation, model)
+        with _route_stats_lock:
+            stats.calls += 1
+            stats.error_rate = (1 - self.alpha) * stats.error_rate + self.alpha * (1 if error is not None else 0)
+            if error is None:
+                stats.latency = latency if stats.latency is None else (1 - self.alpha) * stats.latency + self.alpha * latency
+                return
+            stats.errors += 1
+            if get_status_code(error) == 429:
+                retry_after = get_retry_after(error)
+                stats.cooldown_until = time.time() + (retry_after if retry_after is not None else self.cooldown)
+
+    def _fail_over(self, llm, error: Exception, model: str = None):
+        # out of time is out of time on every provider
+        if isinstance(error, DeadlineExceeded):
+            return False
+        print(f"Router: {llm.provider} ({llm.model_for(model)}) failed: {error}")
+        return True
+
+    def generate_text(self, messages: list[dict], model: str = None, max_tokens: int = 1000):
+        return self._call("text", lambda llm: llm.generate_text(messages, model, max_tokens), model)
+
+    def _timed(self, llm, operation: str, call, model: str = None):
+        start = time.time()
+        try:
+            result = call(llm)
+        except Exception as e:
+            self.record(llm, operation, model, error=e)
+            raise
+        self.record(llm, operation, model, latency=time.time() - start)
+        return result
+
+    def _call(self, operation: str, call, model: str = None):
+        routes = self.ranked(operation, model)
+        if self.hedge_after is not None and len(routes) > 1:
+            return self._call_hedged(operation, call, routes, model)
+
+        error = None
+        for llm in routes:
+            check_deadline()
+            try:
+                return self._timed(llm, operation, call, model)
+            except Exception as e:
+                error = e
+                if not self._fail_over(llm, e, model):
+                    raise
+        raise error
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(2, 2 * len(self.llms)), thread_name_prefix="router")
+        return self._executor
+
+    def _call_hedged(self, operation: str, call, routes: list, model: str = None):
+        executor = self._get_executor()
+        routes = list(routes)
+        pending = {}
+
+        def start(llm):
+            # the deadline contextvar has to follow the call into the pool thread
+            context = contextvars.copy_context()
+            pending[executor.submit(context.run, self._timed, llm, operation, call, model)] = llm
+
+        start(routes.pop(0))
+        error = None
+        while pending:
+            timeout = self.hedge_after if routes else None
+            left = remaining()
+            if left is not None:
+                timeout = left if timeout is None else min(timeout, left)
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                if not routes:
+                    check_deadline()
+                    continue
+                start(routes.pop(0))
+                continue
+            for future in done:
+                llm = pending.pop(future)
+                try:
+                    # the slower requests are left to finish in the background, they still count for the stats
+                    return future.result()
+                except Exception as e:
+                    error = e
+                    if not self._fail_over(llm, e, model):
+                        raise
+            if not pending and routes:
+                start(routes.pop(0))
+        raise error
+
+
+class AsyncRouter(Router):
+    """
+    Router over async clients (AsyncGemini, AsyncMistral). Hedged requests cancel the slower ones once an answer is in.
+    stream_text fails over only until the first piece of the answer arrived and ranks providers by time to first token.
+    """
+
+    async def generate_text(self, messages: list[dict], model: str = None, max_tokens: int = 1000):
+        return await self._call_async("text", lambda llm: llm.generate_text(messages, model, max_tokens), model)
+
+    async def _timed_async(self, llm, operation: str, call, model: str = None):
+        start = time.time()
+        try:
+            result = await call(llm)
+        except Exception as e:
+            self.record(llm, operation, model, error=e)
+            raise
+        self.record(llm, operation, model, latency=time.time() - start)
+        return result
+
+    async def _call_async(self, operation: str, call, model: str = None):
+        routes = self.ranked(operation, model)
+        pending = {}
+
+        def start(llm):
+            pending[asyncio.ensure_future(self._timed_async(llm, operation, call, model))] = llm
+
+        start(routes.pop(0))
+        error = None
+        try:
+            while pending:
+                timeout = self.hedge_after if routes and self.hedge_after is not None else None
+                left = remaining()
+                if left is not None:
+                    timeout = left if timeout is None else min(timeout, left)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if self.hedge_after is None or not routes:
+                        check_deadline()
+                        continue
+                    start(routes.pop(0))
+                    continue
+                for task in done:
+                    llm = pending.pop(task)
+                    try:
+                        return task.result()
+                    except Exception as e:
+                        error = e
+                        if not self._fail_over(llm, e, model):
+                            raise
+                if not pending and routes:
+                    start(routes.pop(0))
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream_text(self, messages: list[dict], model: str = None, max_tokens: int = 1000):
+        error = None
+        for llm in self.ranked("stream", model):
+            check_deadline()
+            start = time.time()
+            started = False
+            try:
+                async for delta in llm.stream_text(messages, model, max_tokens):
+                    if not started:
+                        started = True
+                        self.record(llm, "stream", model, latency=time.time() - start)
+                    yield delta
+            except Exception as e:
+                self.record(llm, "stream", model, error=e)
+                # half an answer can't be continued by another provider
+                if started or not self._fail_over(llm, e, model):
+                    raise
+                error = e
+                continue
+            if not started:
+                self.record(llm, "stream", model, latency=time.time() - start)
+            return
+        raise error
+
+
+_llm_cache = None
+
+
+def default_llm_cache():
+    """
+    The response cache CachedLLM uses unless it gets one: SQLite on disk, plus Redis in front of it when LLM_CACHE_REDIS=1
+    so all workers share their answers. None when LLM_CACHE=0.
+    Env: LLM_CACHE_PATH (default .cache/llm.sqlite3), LLM_CACHE_TTL seconds (default 30 days), LLM_CACHE_MAX_ENTRIES
+    (default 200000, least recently used entries are evicted above it).
+    """
+    global _llm_cache
+    if os.getenv("LLM_CACHE", "1") == "0":
+        return None
+    if _llm_cache is None:
+        # built on first use, so every forked RQ work horse opens its own sqlite connection
+        ttl = float(os.getenv("LLM_CACHE_TTL", str(30 * 24 * 3600)))
+        caches = [SQLiteCache(
+            path=os.getenv("LLM_CACHE_PATH", os.path.join(".cache", "llm.sqlite3")),
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "200000")),
+            ttl=ttl
+        )]
+        if os.getenv("LLM_CACHE_REDIS", "0") == "1":
+            caches.insert(0, RedisCache(prefix="llm-cache:", ttl=ttl))
+        _llm_cache = TieredCache(caches, ttl=ttl)
+    return _llm_cache
+
+
+def _forget_llm_cache():
+    global _llm_cache
+    _llm_cache = None
+
+
+os.register_at_fork(after_in_child=_forget_llm_cache)
+
+
+class CachedLLM:
+    """
+    Wraps a (sync) client and answers repeated requests from a cache instead of the provider:
+        gemini = CachedLLM(Gemini(api_key))
+    The key is a hash of the provider, endpoint and request body (model, messages, generationConfig / max_tokens), so
+    any change to the prompt or the sampling settings is a miss. Embeddings are cached per text, a batch only sends the
+    texts that were not seen before.
+    Sampling is not deterministic (temperature > 0), so a cached answer is one possible answer. Pass bypass_cache=True
+    for calls that need a fresh sample, or cache_text=False to only cache embeddings.
+    Everything else (models, parse_response, ...) is passed through to the wrapped client.
+    """
+    def __init__(self, llm: LLM, cache: Cache = None, ttl: float = None, cache_text: bool = True):
+        self.llm = llm
+        self._cache = cache
+        self.ttl = ttl
+        self.cache_text = cache_text
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # private names and llm itself are not passed on, copy / pickle look them up before __init__ has run
+        if name.startswith("_") or name == "llm":
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+    @property
+    def cache(self):
+        return self._cache if self._cache is not None else default_llm_cache()
+
+    def _key(self, url: str, body: dict):
+        # the query string can carry the api key (gemini), never part of the key
+        return stable_hash(type(self.llm).__name__, url.split("?")[0], body)
+
+    def _get(self, cache, key: str):
+        try:
+            hit, value = cache.get(key)
+        except Exception as e:
+            # a broken cache should never fail the call. treat it as a miss
+            print(f"LLM cache get failed: {e}")
+            hit, value = False, None
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return hit, value
+
+    def _set(self, cache, key: str, value):
+        try:
+            cache.set(key, value, self.ttl)
+        except Exception as e:
+            print(f"LLM cache set failed: {e}")
+
+    def generate_text(self, messages: list[dict], model: str = None, max_tokens: int = 1000, bypass_cache: bool = False):
+        cache = self.cache
+        if cache is None or bypass_cache or not self.cache_text:
+            return self.llm.generate_text(messages, model, max_tokens)
+
+        key = self._key(*self.llm.text_request(messages, model, max_tokens)[::2])
+        hit, text = self._get(cache, key)
+        if hit:
+            return text
+        text = self.llm.generate_text(messages, model, max_tokens)
+        self._set(cache, key, text)
+        return text
+
+    def generate_embeddings(self, text: str, model: str = None, bypass_cache: bool = False):
+        cache = self.cache
+        if cache is None or bypass_cache:
+            return self.llm.generate_embeddings(text, model)
+
+        key = self._key(*self.llm.embeddings_request(text, model)[::2])
+        hit, embedding = self._get(cache, key)
+        if hit:
+            return embedding
+        embedding = self.llm.generate_embeddings(text, model)
+        self._set(cache, key, embedding)
+        return embedding
+
+    def generate_embeddings_batch(self, texts: list[str], model: str = None, bypass_cache: bool = False):
+        cache = self.cache
+        if cache is None or bypass_cache:
+            return self.llm.generate_embeddings_batch(texts, model)
+
+        # same key as a single generate_embeddings call for the text, so both share entries
+        keys = [self._key(*self.llm.embeddings_request(text, model)[::2]) for text in texts]
+        embeddings = [None] * len(texts)
+        missing = []
+        for index, key in enumerate(keys):
+            hit, embedding = self._get(cache, key)
+            if hit:
+                embeddings[index] = embedding
+            else:
+                missing.append(index)
+
+        if missing:
+            fresh = self.llm.generate_embeddings_batch([texts[index] for index in missing], model)
+            for index, embedding in zip(missing, fresh):
+                embeddings[index] = embedding
+                self._set(cache, keys[index], embedding)
 
-        return response.json()["embedding"]["values"]
+        return embeddings
 
 
+async def sse_events(lines):
+    """
+    JSON payloads of the data: lines of a server sent event stream. Stops at Mistral's [DONE].
+    """
+    async for line in lines:
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if not data:
+            continue
+        if data == "[DONE]":
+            break
+        yield json.loads(data)
@@ -0,0 +1,166 @@
+# Token usage and LLM call metrics
+# Every provider call made by utils/llm.py is recorded with its prompt / completion tokens (from the response's usage
+# fields, estimated with tiktoken when the provider doesn't send them), latency and estimated cost:
+# - per block: Block.run opens a usage_scope, the totals end up in context['timing'][block] as llm_calls,
+#   prompt_tokens, completion_tokens, llm_ms and cost_usd. Scopes nest, a chain's entry includes its blocks' usage
+# - per provider / model / operation in the process wide registry. RQ forks a work horse per job, so with
+#   METRICS_REDIS=1 every call is also added to Redis hashes (llm-metrics:<provider>:<model>:<operation>) and
+#   registry.snapshot(source="redis") reads the totals of all workers
+#   registry.snapshot()  -> [{"provider": "gemini", "model": "gemini-2.0-flash", "operation": "text", "calls": 12, ...}]
+
+import contextvars
+import os
+import threading
+from contextlib import contextmanager
+
+_usage = contextvars.ContextVar("llm_usage", default=None)
+
+USAGE_FIELDS = ("llm_calls", "prompt_tokens", "completion_tokens", "llm_ms", "cost_usd")
+
+_encoding = None
+
+
+def estimate_tokens(text: str):
+    """
+    Token count of text with tiktoken's cl100k_base. Not the providers' tokenizers, but close enough for accounting.
+    Falls back to ~4 characters a token when tiktoken is not installed.
+    """
+    global _encoding
+    if not text:
+        return 0
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    if _encoding is False:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+class Usage:
+    def __init__(self, parent: "Usage" = None):
+        self.parent = parent
+        self.totals = dict.fromkeys(USAGE_FIELDS, 0)
+        self._lock = threading.Lock()
+
+    def add(self, prompt_tokens: int, completion_tokens: int, latency_ms: float, cost_usd: float = 0.0):
+        usage = self
+        while usage is not None:
+            with usage._lock:
+                usage.totals["llm_calls"] += 1
+                usage.totals["prompt_tokens"] += prompt_tokens
+                usage.totals["completion_tokens"] += completion_tokens
+                usage.totals["llm_ms"] += latency_ms
+                usage.totals["cost_usd"] += cost_usd
+            usage = usage.parent
+
+    def as_timing(self):
+        # nothing for blocks that never called an llm, keeps their timing entries as they were
+        if not self.totals["llm_calls"]:
+            return {}
+        return {
+            **self.totals,
+            "llm_ms": round(self.totals["llm_ms"], 2),
+            "cost_usd": round(self.totals["cost_usd"], 6)
+        }
+
+
+def current_usage():
+    return _usage.get()
+
+
+@contextmanager
+def usage_scope():
+    usage = Usage(parent=_usage.get())
+    token = _usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage.reset(token)
+
+
+class MetricsRegistry:
+    def __init__(self, redis_prefix: str = "llm-metrics:"):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.redis_prefix = redis_prefix
+        self.use_redis = os.getenv("METRICS_REDIS", "0") == "1"
+
+    def _add(self, key: tuple, values: dict):
+        with self._lock:
+            metrics = self._metrics.setdefault(key, {"calls": 0, "errors": 0, "estimated_calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_ms": 0.0, "cost_usd": 0.0})
+            for name, value in values.items():
+                metrics[name] += value
+        if self.use_redis:
+            try:
+                from database import redis_conn
+                pipeline = redis_conn.pipeline(transaction=False)
+                for name, value in values.items():
+                    pipeline.hincrbyfloat(self.redis_prefix + ":".join(key), name, value)
+                pipeline.execute()
+            except Exception as e:
+                # metrics should never fail a call
+                print(f"Metrics: redis update failed: {e}")
+
+    def record_call(self, provider: str, model: str, operation: str, prompt_tokens: int, completion_tokens: int, latency_ms: float, cost_usd: float = 0.0, estimated: bool = False):
+        self._add((provider, model, operation), {
+            "calls": 1,
+            "estimated_calls": 1 if estimated else 0,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "latency_ms": latency_ms,
+            "cost_usd": cost_usd
+        })
+
+    def record_error(self, provider: str, model: str, operation: str):
+        self._add((provider, model, operation), {"errors": 1})
+
+    def snapshot(self, source: str = "local"):
+        """
+        Totals per provider / model / operation, plus average latency and tokens per second. source="redis" reads the
+        totals of every process (needs METRICS_REDIS=1 in the workers).
+        """
+        if source == "redis":
+            from database import redis_conn
+            rows = {}
+            for key in redis_conn.scan_iter(match=self.redis_prefix + "*"):
+                key = key.decode() if isinstance(key, bytes) else key
+                values = redis_conn.hgetall(key)
+                rows[tuple(key[len(self.redis_prefix):].split(":", 2))] = {
+                    (name.decode() if isinstance(name, bytes) else name): float(value) for name, value in values.items()
+                }
+        else:
+            with self._lock:
+                rows = {key: dict(values) for key, values in self._metrics.items()}
+
+        snapshot = []
+        for (provider, model, operation), values in sorted(rows.items()):
+            calls = values.get("calls", 0)
+            latency_ms = values.get("latency_ms", 0)
+            completion_tokens = values.get("completion_tokens", 0)
+            snapshot.append({
+                "provider": provider,
+                "model": model,
+                "operation": operation,
+                **values,
+                "avg_latency_ms": round(latency_ms / calls, 2) if calls else None,
+                "completion_tokens_per_s": round(completion_tokens / (latency_ms / 1000), 2) if latency_ms else None
+            })
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+
+# shared by all clients in the process
+registry = MetricsRegistry()
+
+
+def record_llm_call(provider: str, model: str, operation: str, prompt_tokens: int, completion_tokens: int, latency_ms: float, cost_usd: float = 0.0, estimated: bool = False):
+    registry.record_call(provider, model, operation, prompt_tokens, completion_tokens, latency_ms, cost_usd, estimated)
+    usage = _usage.get()
+    if usage is not None:
+        usage.add(prompt_tokens, completion_tokens, latency_ms, cost_usd)
@@ -0,0 +1,161 @@
+# Rate limiting for provider calls, shared by every worker process
+# Token buckets per key (e.g. "gemini:gemini-2.0-flash"): one for requests per minute, one for tokens per minute. Both
+# refill continuously, a call takes 1 request and its (estimated) tokens and waits until both buckets have enough.
+# The buckets live in Redis (the connection from database.py) and are updated by a Lua script, so all RQ workers
+# together stay at the quota: not above it (429s) and not far below it (sleeps "just in case").
+# The script reads the time from Redis, so clocks that differ between hosts can't refill or drain the shared buckets.
+# With RATE_LIMIT_BACKEND=local the same buckets are kept in process. Then every process gets the full quota, so set the
+# limits per process in that case. If Redis can't be reached the local buckets stand in for REDIS_RETRY seconds, then
+# Redis is tried again.
+# RATE_LIMIT=0 turns it off.
+#   limiter.acquire("gemini:gemini-2.0-flash", rpm=2000, tpm=4000000, tokens=1200)
+# utils/llm.py calls this before every request, with the limits from the model tables (or LLM_RATE_LIMITS).
+
+import os
+import asyncio
+import threading
+import time
+
+from utils.deadline import remaining, DeadlineExceeded
+
+# wait in steps of at most this many seconds, so other processes get their turn in between
+MAX_SLEEP = 1.0
+
+# seconds the in process buckets are used after a Redis error before Redis is tried again
+REDIS_RETRY = 5.0
+
+# KEYS[1] = bucket hash, ARGV = rpm, tpm, tokens. 0 = no limit
+# returns the seconds to wait before trying again, "0" when the call may go ahead (and the buckets were charged)
+TOKEN_BUCKET_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local rpm = tonumber(ARGV[1])
+local tpm = tonumber(ARGV[2])
+local cost = math.min(tonumber(ARGV[3]), tpm)
+local state = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'updated')
+local requests = tonumber(state[1])
+local tokens = tonumber(state[2])
+local updated = tonumber(state[3])
+if updated == nil then
+    requests = rpm
+    tokens = tpm
+    updated = now
+end
+local elapsed = math.max(0, now - updated)
+requests = math.min(rpm, requests + elapsed * rpm / 60)
+tokens = math.min(tpm, tokens + elapsed * tpm / 60)
+local wait = 0
+if rpm > 0 and requests < 1 then
+    wait = (1 - requests) * 60 / rpm
+end
+if tpm > 0 and tokens < cost then
+    wait = math.max(wait, (cost - tokens) * 60 / tpm)
+end
+if wait == 0 then
+    if rpm > 0 then requests = requests - 1 end
+    if tpm > 0 then tokens = tokens - cost end
+end
+redis.call('HSET', KEYS[1], 'requests', requests, 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], 120)
+return tostring(wait)
+"""
+
+
+class LocalBuckets:
+    """
+    In process version of TOKEN_BUCKET_SCRIPT.
+    """
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, now: float, rpm: float, tpm: float, tokens: float):
+        cost = min(tokens, tpm)
+        with self._lock:
+            requests, bucket_tokens, updated = self._buckets.get(key, (rpm, tpm, now))
+            elapsed = max(0, now - updated)
+            requests = min(rpm, requests + elapsed * rpm / 60)
+            bucket_tokens = min(tpm, bucket_tokens + elapsed * tpm / 60)
+            wait = 0
+            if rpm > 0 and requests < 1:
+                wait = (1 - requests) * 60 / rpm
+            if tpm > 0 and bucket_tokens < cost:
+                wait = max(wait, (cost - bucket_tokens) * 60 / tpm)
+            if wait == 0:
+                if rpm > 0:
+                    requests -= 1
+                if tpm > 0:
+                    bucket_tokens -= cost
+            self._buckets[key] = (requests, bucket_tokens, now)
+        return wait
+
+
+class RateLimiter:
+    def __init__(self, connection=None, prefix: str = "ratelimit:", backend: str = None):
+        self._connection = connection
+        self.prefix = prefix
+        # "redis" or "local"
+        self.backend = backend or os.getenv("RATE_LIMIT_BACKEND", "redis")
+        self.enabled = os.getenv("RATE_LIMIT", "1") != "0"
+        self.local = LocalBuckets()
+        self._script = None
+        # time.time() until which the in process buckets stand in for an unreachable Redis
+        self._redis_retry_at = 0
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            # imported lazily, database.py sets up postgres/qdrant/redis clients on import
+            from database import redis_conn
+            self._connection = redis_conn
+        return self._connection
+
+    def _take(self, key: str, rpm: float, tpm: float, tokens: float):
+        now = time.time()
+        if self.backend == "redis" and now >= self._redis_retry_at:
+            try:
+                if self._script is None:
+                    self._script = self.connection.register_script(TOKEN_BUCKET_SCRIPT)
+                return float(self._script(keys=[self.prefix + key], args=[rpm, tpm, tokens]))
+            except Exception as e:
+                print(f"Rate limiter: redis unavailable ({e}), using in process buckets for {REDIS_RETRY}s")
+                self._redis_retry_at = now + REDIS_RETRY
+        return self.local.take(key, now, rpm, tpm, tokens)
+
+    def _next_wait(self, key: str, rpm: float = None, tpm: float = None, tokens: float = 0):
+        wait = self._take(key, rpm or 0, tpm or 0, tokens or 0)
+        if wait <= 0:
+            return 0
+        left = remaining()
+        if left is not None and wait >= left:
+            raise DeadlineExceeded(f"Deadline exceeded waiting for rate limit {key} ({wait:.2f}s wait)")
+        return min(wait, MAX_SLEEP)
+
+    def acquire(self, key: str, rpm: float = None, tpm: float = None, tokens: float = 0):
+        """
+        Blocks until a call with this many tokens fits into the key's limits. Returns the seconds waited.
+        """
+        if not self.enabled or (not rpm and not tpm):
+            return 0
+        waited = 0
+        while True:
+            wait = self._next_wait(key, rpm, tpm, tokens)
+            if wait == 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self, key: str, rpm: float = None, tpm: float = None, tokens: float = 0):
+        if not self.enabled or (not rpm and not tpm):
+            return 0
+        waited = 0
+        while True:
+            wait = self._next_wait(key, rpm, tpm, tokens)
+            if wait == 0:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+
+# shared by all clients in the process
+limiter = RateLimiter()
@@ -0,0 +1,115 @@
+# Retry policies for Block.execute (Block(..., retry_policy=RetryPolicy(...)))
+# - exponential backoff with full jitter, capped by max_delay
+# - max_elapsed bounds the total time spent retrying
+# - errors are classified: 429 / 5xx / timeouts / connection errors are retried, other 4xx (bad request, auth etc)
+#   fail right away since another attempt would fail the same way
+# - a Retry-After from the server (LLMError.retry_after, or the header of an HTTP error response) is honoured
+# - no retry is scheduled past the chain deadline (utils/deadline.py), and DeadlineExceeded is never retried
+# Blocks that don't declare a policy get RetryPolicy.fixed(retries, retry_delay), which is the old behaviour:
+# retry every error (except DeadlineExceeded) with a constant delay, no classification by status code.
+
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from utils.deadline import DeadlineExceeded, remaining
+
+RETRYABLE_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+
+# exception class names (anywhere in the MRO) that mean the request never got a proper answer. matched by name so
+# requests / httpx don't have to be imported here
+NETWORK_ERROR_NAMES = ("ConnectionError", "ConnectTimeout", "ReadTimeout", "Timeout", "TimeoutError", "TimeoutException", "TransportError")
+
+
+def get_status_code(error: Exception):
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        response = getattr(error, "response", None)
+        status_code = getattr(response, "status_code", None)
+    return status_code
+
+
+def parse_retry_after(value):
+    """
+    Retry-After header value -> seconds to wait. Accepts both forms: delta seconds and an HTTP date.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def get_retry_after(error: Exception):
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        return retry_after
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is not None:
+        return parse_retry_after(headers.get("Retry-After"))
+    return None
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts: int = 3, base_delay: float = 1.0, max_delay: float = 30.0, multiplier: float = 2.0, jitter: bool = True, max_elapsed: float = None, retry_unknown_errors: bool = True, classify_errors: bool = True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_elapsed = max_elapsed
+        # errors we can't classify (no status code, not a network error). retried by default like before
+        self.retry_unknown_errors = retry_unknown_errors
+        # False: every error is retried, whatever its status code
+        self.classify_errors = classify_errors
+
+    @classmethod
+    def fixed(cls, retries: int, retry_delay: float = 0):
+        # the old Block behaviour: `retries` attempts, constant delay, every error is retried (a 400 or 404 too)
+        return cls(max_attempts=retries, base_delay=retry_delay, max_delay=retry_delay, multiplier=1.0, jitter=False, classify_errors=False)
+
+    def is_retryable(self, error: Exception):
+        if isinstance(error, DeadlineExceeded):
+            return False
+        if not self.classify_errors:
+            return True
+        status_code = get_status_code(error)
+        if status_code is not None:
+            return status_code in RETRYABLE_STATUS_CODES
+        if any(cls.__name__ in NETWORK_ERROR_NAMES for cls in type(error).__mro__):
+            return True
+        return self.retry_unknown_errors
+
+    def backoff(self, attempt: int):
+        # attempt is the number of failed attempts so far (1 after the first failure)
+        delay = min(self.max_delay, self.base_delay * (self.multiplier ** (attempt - 1)))
+        if self.jitter:
+            # full jitter, spreads retries of concurrent callers so they don't hit the provider in lockstep
+            delay = random.uniform(0, delay)
+        return delay
+
+    def next_delay(self, attempt: int, error: Exception, elapsed: float = 0.0):
+        """
+        Seconds to sleep before the next attempt, or None if we should give up.
+        """
+        if attempt >= self.max_attempts or not self.is_retryable(error):
+            return None
+
+        retry_after = get_retry_after(error)
+        delay = retry_after if retry_after is not None else self.backoff(attempt)
+
+        if self.max_elapsed is not None and elapsed + delay > self.max_elapsed:
+            return None
+        left = remaining()
+        if left is not None and delay >= left:
+            # we'd wake up with no time left for the attempt itself
+            return None
+        return delay
@@ -1,6 +1,7 @@
 
 import requests
 from ddgs import DDGS
+from utils.deadline import request_timeout
 
 class Search:
     def __init__(self, api_key: str):
@@ -26,7 +27,7 @@ class BraveSearch(Search):
             "x-subscription-token": self.api_key,
             "accept": "application/json",
         }
-        response = requests.get(f"https://api.search.brave.com/api/v2/search?q={query}", headers=headers)
+        response = requests.get(f"https://api.search.brave.com/api/v2/search?q={query}", headers=headers, timeout=request_timeout(15))
 
         if response.status_code != 200:
             raise Exception(f"Error: {response.status_code} {response.text}")
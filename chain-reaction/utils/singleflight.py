@@ -0,0 +1,160 @@
+# Single flight: identical calls that are in flight at the same time share one upstream call
+# The first caller for a key (the leader) runs the call, everyone asking for the same key meanwhile waits for it and
+# gets a copy of its result (or its error). Nothing is kept once the call is done, this is not a cache.
+#   value, leader = flights.do(key, lambda: post(...))
+# With redis=True (SINGLEFLIGHT_REDIS=1 for the shared instance) processes coalesce too: the leader holds a Redis lock
+# for the key and publishes the result under it for a few seconds, the other processes poll for it. Results have to be
+# JSON serializable for that. If Redis fails, every process just makes its own call.
+# SINGLEFLIGHT=0 turns it off.
+
+import asyncio
+import copy
+import json
+import os
+import threading
+import time
+import uuid
+import weakref
+
+from utils.deadline import DeadlineExceeded, check_deadline, remaining
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, redis: bool = False, connection=None, prefix: str = "singleflight:", lock_ttl: float = 120, result_ttl: float = 10, poll_interval: float = 0.05):
+        self.enabled = os.getenv("SINGLEFLIGHT", "1") != "0"
+        self.redis = redis
+        self._connection = connection
+        self.prefix = prefix
+        # a leader that dies keeps the others waiting at most this long
+        self.lock_ttl = lock_ttl
+        # how long a finished result stays readable for processes still polling
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._lock = threading.Lock()
+        # event loop -> {key: asyncio.Future}
+        self._async_calls = weakref.WeakKeyDictionary()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            # imported lazily, database.py sets up postgres/qdrant/redis clients on import
+            from database import redis_conn
+            self._connection = redis_conn
+        return self._connection
+
+    def do(self, key: str, fn):
+        """
+        fn() once for all concurrent callers with this key. Returns (value, leader), leader is True for the caller
+        whose fn actually ran.
+        """
+        if not self.enabled:
+            return fn(), True
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(timeout=remaining()):
+                check_deadline()
+            if call.error is not None:
+                raise call.error
+            # callers get their own copy, the leader's result may be mutated by its caller
+            return copy.deepcopy(call.result), False
+
+        try:
+            call.result, leader = self._do_redis(key, fn) if self.redis else (fn(), True)
+            return call.result, leader
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def _do_redis(self, key: str, fn):
+        lock_key, result_key = f"{self.prefix}lock:{key}", f"{self.prefix}result:{key}"
+        token = uuid.uuid4().hex
+        try:
+            while True:
+                payload = self.connection.get(result_key)
+                if payload is not None:
+                    return json.loads(payload), False
+                if self.connection.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000)):
+                    break
+                check_deadline()
+                time.sleep(self.poll_interval)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print(f"Single flight: redis unavailable ({e}), calling directly")
+            return fn(), True
+
+        try:
+            result = fn()
+            try:
+                self.connection.set(result_key, json.dumps(result), px=int(self.result_ttl * 1000))
+            except Exception as e:
+                print(f"Single flight: could not publish result ({e})")
+            return result, True
+        finally:
+            try:
+                # only our own lock, it may have expired and been taken by someone else
+                if self.connection.get(lock_key) in (token, token.encode()):
+                    self.connection.delete(lock_key)
+            except Exception:
+                pass
+
+    async def do_async(self, key: str, fn):
+        """
+        do() for coroutines: await fn() once for all concurrent callers on this event loop. In process only.
+        """
+        if not self.enabled:
+            return await fn(), True
+
+        calls = self._async_calls.setdefault(asyncio.get_running_loop(), {})
+        future = calls.get(key)
+        if future is not None:
+            # shield, so a cancelled follower doesn't cancel the leader's call
+            return copy.deepcopy(await asyncio.shield(future)), False
+
+        future = calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+        except Exception as e:
+            future.set_exception(e)
+            # marks the exception as retrieved, there may be no followers to do it
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(result)
+            return result, True
+        finally:
+            calls.pop(key, None)
+
+
+# shared by all clients in the process
+flights = SingleFlight(redis=os.getenv("SINGLEFLIGHT_REDIS", "0") == "1")
+
+
+def _forget_calls():
+    # calls in flight in the parent never finish in a forked child
+    flights._calls.clear()
+    flights._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_calls)
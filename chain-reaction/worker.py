@@ -4,9 +4,12 @@ import sys
 import multiprocessing
 from rq import Worker, Queue
 from database import redis_conn
+from utils.hooks import install_hooks_from_env
 
 def start_worker(queues):
     """Start a worker for the given queues"""
+    # profiling / tracemalloc / span export, only when switched on through CHAIN_* env vars
+    install_hooks_from_env()
     worker = Worker(queues, connection=redis_conn)
     worker.work()
 